@@ -0,0 +1,117 @@
+"""Engagement stats computed from an analytics export (see export.py).
+
+Everything here works on the memory-mapped column arrays with vectorized
+numpy operations; nothing queries the database. Per-user results are
+arrays indexed by user id.
+"""
+
+import json
+import os
+
+import numpy as np
+
+DAY = np.timedelta64(1, 'D')
+
+
+class Export:
+    """The column arrays of an export, mapped read-only."""
+
+    def __init__(self, export_dir):
+        with open(os.path.join(export_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+
+        self.exported_at = np.datetime64(manifest['exported_at'], 'us')
+        self.rows = manifest['rows']
+
+        tables = {}
+        for name in self.rows:
+            table_dir = os.path.join(export_dir, name)
+            tables[name] = {
+                file[:-len('.npy')]: np.load(os.path.join(table_dir, file),
+                                             mmap_mode='r')
+                for file in os.listdir(table_dir) if file.endswith('.npy')}
+
+        self.messages = tables['messages']
+        self.likes = tables['likes']
+        self.follows = tables['follows']
+
+        user_columns = (self.messages['user_id'], self.likes['user_id'],
+                        self.follows['user_following_id'],
+                        self.follows['user_being_followed_id'])
+        self.num_users = 1 + max((int(ids.max()) for ids in user_columns if len(ids)),
+                                 default=0)
+
+    def _since(self, days, now):
+        now = self.exported_at if now is None else np.datetime64(now, 'us')
+        return now - days * DAY
+
+
+def posting_rates(data, days=30, now=None):
+    """Messages per day of each user over the `days` days before `now`
+    (default: the export time)."""
+
+    recent = data.messages['timestamp'] >= data._since(days, now)
+    posted = np.bincount(data.messages['user_id'][recent],
+                         minlength=data.num_users)
+    return posted / days
+
+
+def like_ratios(data):
+    """Likes received per message posted, for each user (0 without messages)."""
+
+    posted = np.bincount(data.messages['user_id'], minlength=data.num_users)
+    ratios = np.zeros(data.num_users)
+    if not len(data.messages['id']):
+        return ratios
+
+    # find each liked message's author by binary search over sorted ids
+    order = np.argsort(data.messages['id'], kind='stable')
+    ids = data.messages['id'][order]
+    liked = data.likes['message_id']
+
+    at = np.minimum(np.searchsorted(ids, liked), len(ids) - 1)
+    found = ids[at] == liked
+    authors = data.messages['user_id'][order[at[found]]]
+
+    received = np.bincount(authors, minlength=data.num_users)
+    return np.divide(received, posted, out=ratios, where=posted > 0)
+
+
+def follower_growth(data, days=7, now=None):
+    """(new followers in the last `days` days, growth over the followers the
+    user had before them) for each user."""
+
+    followed = data.follows['user_being_followed_id']
+    recent = data.follows['timestamp'] >= data._since(days, now)
+
+    total = np.bincount(followed, minlength=data.num_users)
+    new = np.bincount(followed[recent], minlength=data.num_users)
+    before = total - new
+
+    growth = np.divide(new, before, out=np.zeros(data.num_users), where=before > 0)
+    return new, growth
+
+
+def follower_history(data, user_id, bucket_days=7, buckets=12, now=None):
+    """Followers `user_id` gained in each of the last `buckets` periods of
+    `bucket_days`, oldest first."""
+
+    end = data._since(0, now)
+    mine = data.follows['timestamp'][data.follows['user_being_followed_id'] == user_id]
+
+    age = (end - mine) // (bucket_days * DAY)
+    age = age[(age >= 0) & (age < buckets)]
+    return np.bincount(buckets - 1 - age, minlength=buckets)
+
+
+def top(values, n=10):
+    """[(user_id, value)] of the `n` largest nonzero values, largest first."""
+
+    n = min(n, len(values))
+    if not n:
+        return []
+
+    user_ids = np.argpartition(values, -n)[-n:]
+    user_ids = user_ids[np.argsort(values[user_ids])[::-1]]
+    return [(int(user_id), values[user_id].item())
+            for user_id in user_ids if values[user_id]]
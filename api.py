@@ -0,0 +1,436 @@
+"""JSON API, version 1, for the mobile client.
+
+Everything is under /api/v1 and uses the site's login session. Responses
+are compact: messages carry their author's id, and the authors' cards
+come once per response in "users" (keyed by id) instead of once per
+message. Lists page with an opaque "next" cursor; pass it back as
+`before` (timeline, tags, mentions) or `after` (followers, following, threads). /batch resolves
+many user and message ids in one request.
+
+Errors are {"error": description} with the HTTP status.
+"""
+
+import json
+from operator import attrgetter
+
+from flask import Blueprint, Response, g, request, abort, current_app
+from sqlalchemy.orm import load_only
+from werkzeug.exceptions import HTTPException
+
+from follow_graph import follow_graph
+from follows import (follow_users, unfollow_users, follow_page, followed_among,
+                     encode_cursor, decode_cursor, CARD_COLUMNS, FOLLOW_PAGE_SIZE)
+from like_buffer import like_buffer
+from models import db, User, Follows
+from notifications import inbox_page, mark_read, NOTIFICATIONS_PAGE_SIZE
+from partitions import find_archived_message
+from sharding import shards
+from tags import normalize_tag, tag_page, mentions_page
+from threads import ancestor_ids, THREAD_BRANCHES
+from timeline_markers import timeline_newest
+
+bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+TIMELINE_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# most users and most messages one /batch request may ask for
+BATCH_LIMIT = 200
+
+PROFILE_COLUMNS = CARD_COLUMNS + ('location', 'followers_count', 'following_count')
+
+_card_values = attrgetter(*CARD_COLUMNS)
+_profile_values = attrgetter(*PROFILE_COLUMNS)
+
+
+##############################################################################
+# Serialization
+
+
+def card_json(user):
+    return dict(zip(CARD_COLUMNS, _card_values(user)))
+
+
+def message_json(msg, liked_ids=()):
+    return {'id': msg.id, 'user_id': msg.user_id, 'text': msg.text,
+            'timestamp': msg.timestamp.isoformat(), 'liked': msg.id in liked_ids,
+            'parent_id': msg.parent_id, 'reply_count': msg.reply_count or 0}
+
+
+def cards_by_id(user_ids):
+    """{id: card} of the active users among `user_ids` (one query)."""
+
+    user_ids = set(user_ids)
+    if not user_ids:
+        return {}
+    users = (User.query
+             .options(load_only(*CARD_COLUMNS))
+             .filter(User.id.in_(user_ids), User.deleted_at.is_(None)))
+    return {user.id: card_json(user) for user in users}
+
+
+def messages_json(messages, viewer_id=None):
+    """The messages plus their authors' cards: ([message], {id: card})."""
+
+    liked_ids = ()
+    if viewer_id:
+        liked_ids = like_buffer.overlay(viewer_id, shards.liked_message_ids(viewer_id))
+    return ([message_json(msg, liked_ids) for msg in messages],
+            cards_by_id(msg.user_id for msg in messages))
+
+
+def api_response(payload, status=200):
+    """`payload` as compact JSON (no spaces, no sorting)."""
+
+    return Response(json.dumps(payload, separators=(',', ':')), status,
+                    mimetype='application/json')
+
+
+@bp.errorhandler(HTTPException)
+def api_error(error):
+    return api_response({'error': error.description}, error.code)
+
+
+##############################################################################
+# Helpers
+
+
+def require_user():
+    if not g.user:
+        abort(401, "Log in first.")
+    return g.user
+
+
+def page_size(default):
+    try:
+        limit = int(request.args.get('limit', default))
+    except ValueError:
+        abort(400, "limit must be a number.")
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        abort(400, f"limit must be between 1 and {MAX_PAGE_SIZE}.")
+    return limit
+
+
+def cursor_arg(name):
+    """The decoded cursor in request arg `name`, or None."""
+
+    cursor = request.args.get(name)
+    if not cursor:
+        return None
+    try:
+        return decode_cursor(cursor)
+    except ValueError:
+        abort(400, f"Bad {name} cursor.")
+
+
+def active_user_or_404(user_id, *columns):
+    user = (User.query
+            .options(load_only(*columns))
+            .filter(User.id == user_id, User.deleted_at.is_(None))
+            .first())
+    if user is None:
+        abort(404, "No such user.")
+    return user
+
+
+def ids_arg(data, name):
+    ids = data.get(name) or []
+    if not isinstance(ids, list):
+        abort(400, f"{name} must be a list.")
+    if len(ids) > BATCH_LIMIT:
+        abort(400, f"At most {BATCH_LIMIT} {name} at a time.")
+    try:
+        return [int(i) for i in ids]
+    except (TypeError, ValueError):
+        abort(400, f"{name} must be integers.")
+
+
+def message_page(page, key):
+    """`page(key, before, limit)` (tag_page, mentions_page) as a response."""
+
+    limit = page_size(TIMELINE_PAGE_SIZE)
+    try:
+        messages, next_cursor = page(key, request.args.get('before'), limit)
+    except ValueError:
+        abort(400, "Bad before cursor.")
+    payload, users = messages_json(messages, g.user.id if g.user else None)
+
+    return api_response({'messages': payload, 'users': users, 'next': next_cursor})
+
+
+##############################################################################
+# Timeline and messages
+
+
+@bp.route('/timeline')
+def timeline():
+    """Newest messages by the user and everyone they follow.
+
+    Pass the response's "next" as `before` for the following page.
+
+    To poll, pass the id of the newest message you have as `since_id`
+    instead: the answer is 304 if there is nothing newer, else only the
+    newer messages, with "gap": true if there were more than `limit` of
+    them (reload then). 404 means that message is gone; reload too.
+    """
+
+    user = require_user()
+    limit = page_size(TIMELINE_PAGE_SIZE)
+    if 'since_id' in request.args:
+        return timeline_since(user, limit)
+
+    before = cursor_arg('before')
+
+    messages = shards.messages_for(timeline_user_ids(user), limit=limit, before=before)
+    payload, users = messages_json(messages, user.id)
+
+    last = messages[-1] if len(messages) == limit else None
+    return api_response({'messages': payload, 'users': users,
+                         'next': last and encode_cursor(last.timestamp, last.id)})
+
+
+def timeline_since(user, limit):
+    try:
+        since_id = int(request.args['since_id'])
+    except ValueError:
+        abort(400, "since_id must be a number.")
+
+    # the common case, nothing new, costs one cache lookup
+    newest = timeline_newest(user.id)
+    if newest is None or newest[1] == since_id:
+        return Response(status=304)
+
+    since = shards.get_message(since_id)
+    if since is None:
+        abort(404, "No such message.")
+
+    messages = shards.messages_for(timeline_user_ids(user), limit=limit + 1,
+                                   after=(since.timestamp, since.id))
+    payload, users = messages_json(messages[:limit], user.id)
+
+    return api_response({'messages': payload, 'users': users,
+                         'gap': len(messages) > limit})
+
+
+def timeline_user_ids(user):
+    """The user and everyone they follow."""
+
+    user_ids = [followed_id for (followed_id,) in
+                db.session.query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == user.id)]
+    user_ids.append(user.id)
+    return user_ids
+
+
+@bp.route('/messages/<int:message_id>')
+def show_message(message_id):
+    msg = shards.get_message(message_id)
+
+    if msg is None:
+        # old months only live in the archive
+        msg = find_archived_message(current_app.config['MESSAGE_ARCHIVE_DIR'], message_id)
+
+    if msg is None:
+        abort(404, "No such message.")
+
+    (payload,), users = messages_json([msg], g.user.id if g.user else None)
+    return api_response({'message': payload, 'users': users})
+
+
+@bp.route('/messages/<int:message_id>/thread')
+def show_thread(message_id):
+    """A message, the messages it replies to (thread starter first) and a
+    page of its replies in thread order, each with its depth below the
+    message. `limit` counts direct replies, each sent with everything
+    under it; pass "next" as `after`."""
+
+    branches = page_size(THREAD_BRANCHES)
+    msg = shards.get_message(message_id)
+    if msg is None:
+        abort(404, "No such message.")
+
+    ancestors = shards.messages_by_id(ancestor_ids(msg))
+    replies, next_start = shards.thread(msg, request.args.get('after', type=int), branches)
+
+    payload, users = messages_json([msg] + ancestors + [reply for reply, depth in replies],
+                                   g.user.id if g.user else None)
+    for reply, (_, depth) in zip(payload[1 + len(ancestors):], replies):
+        reply['depth'] = depth
+
+    return api_response({'message': payload[0], 'ancestors': payload[1:1 + len(ancestors)],
+                         'replies': payload[1 + len(ancestors):], 'users': users,
+                         'next': next_start})
+
+
+@bp.route('/messages/<int:message_id>/like', methods=['POST'])
+def toggle_like(message_id):
+    """Like the message, or unlike it if already liked: {"liked": bool}."""
+
+    user = require_user()
+
+    if shards.get_message(message_id) is None:
+        abort(404, "No such message.")
+
+    liked = like_buffer.toggle(user.id, message_id)
+    return api_response({'liked': liked})
+
+
+@bp.route('/tags/<tag>')
+def show_tag(tag):
+    """Newest messages with the hashtag; pass "next" as `before` for more."""
+
+    tag = normalize_tag(tag)
+    if not tag:
+        abort(404, "Not a hashtag.")
+    return message_page(tag_page, tag)
+
+
+##############################################################################
+# Users
+
+
+@bp.route('/users/<int:user_id>')
+def show_user(user_id):
+    """A profile card with counts, and whether the viewer follows them."""
+
+    user = active_user_or_404(user_id, *PROFILE_COLUMNS)
+
+    profile = dict(zip(PROFILE_COLUMNS, _profile_values(user)))
+    profile['likes_count'] = shards.count_likes(user_id)
+    if g.user:
+        profile['followed'] = bool(followed_among(g.user.id, [user_id]))
+
+    return api_response({'user': profile})
+
+
+@bp.route('/users/<int:user_id>/mentions')
+def show_mentions(user_id):
+    """Newest messages that @mention the user; pass "next" as `before`."""
+
+    require_user()
+    active_user_or_404(user_id, 'id')
+    return message_page(mentions_page, user_id)
+
+
+@bp.route('/users/<int:user_id>/followers', defaults={'direction': 'followers'})
+@bp.route('/users/<int:user_id>/following', defaults={'direction': 'following'})
+def list_follows(user_id, direction):
+    """One page of followers or followed users, most recent first.
+
+    Each card says whether the viewer follows that user; pass the
+    response's "next" as `after` for the following page.
+    """
+
+    viewer = require_user()
+    limit = page_size(FOLLOW_PAGE_SIZE)
+    active_user_or_404(user_id, 'id')
+
+    try:
+        users, next_cursor = follow_page(user_id, direction, request.args.get('after'), limit)
+    except ValueError:
+        abort(400, "Bad after cursor.")
+    followed_ids = followed_among(viewer.id, [user.id for user in users])
+
+    cards = []
+    for user in users:
+        card = card_json(user)
+        card['followed'] = user.id in followed_ids
+        cards.append(card)
+
+    return api_response({'users': cards, 'next': next_cursor})
+
+
+@bp.route('/users/<int:user_id>/follow', methods=['POST'])
+def toggle_follow(user_id):
+    """Follow the user, or unfollow if already following: {"followed": bool}."""
+
+    viewer = require_user()
+    active_user_or_404(user_id, 'id')
+    if user_id == viewer.id:
+        abort(400, "You can't follow yourself.")
+
+    if followed_among(viewer.id, [user_id]):
+        unfollow_users(viewer.id, [user_id])
+        db.session.commit()
+        follow_graph.stop_following(viewer.id, user_id)
+        return api_response({'followed': False})
+
+    follow_users(viewer.id, [user_id])
+    db.session.commit()
+    follow_graph.add_follow(viewer.id, user_id)
+    return api_response({'followed': True})
+
+
+##############################################################################
+# Notifications
+
+
+@bp.route('/notifications')
+def list_notifications():
+    """The viewer's notifications, most recently updated first, and the
+    unread count. Doesn't mark them read; POST /notifications/read does.
+
+    Likes and follows are aggregated: "actor_id" is the most recent of
+    "actor_count" users. Pass "next" as `before` for the following page.
+    """
+
+    user = require_user()
+    limit = page_size(NOTIFICATIONS_PAGE_SIZE)
+    try:
+        items, next_cursor = inbox_page(user.id, request.args.get('before'), limit)
+    except ValueError:
+        abort(400, "Bad before cursor.")
+
+    messages, users = messages_json([msg for notification, msg in items if msg], user.id)
+    users.update({notification.actor_id: card_json(notification.actor)
+                  for notification, msg in items if notification.actor})
+
+    return api_response({
+        'notifications': [{'id': notification.id, 'kind': notification.kind,
+                           'message_id': notification.message_id or None,
+                           'actor_id': notification.actor_id,
+                           'actor_count': notification.actor_count,
+                           'updated_at': notification.updated_at.isoformat(),
+                           'read': notification.read_at is not None}
+                          for notification, msg in items],
+        'messages': {msg['id']: msg for msg in messages},
+        'users': users,
+        'unread': user.unread_notifications,
+        'next': next_cursor})
+
+
+@bp.route('/notifications/read', methods=['POST'])
+def read_notifications():
+    user = require_user()
+    mark_read(user.id)
+    db.session.commit()
+    return api_response({'unread': 0})
+
+
+##############################################################################
+# Batch
+
+
+@bp.route('/batch', methods=['POST'])
+def batch():
+    """Resolve many ids at once.
+
+    Takes {"users": [ids], "messages": [ids]} (at most BATCH_LIMIT of
+    each) and returns {"users": {id: card}, "messages": {id: message}}.
+    The authors of the messages are included in "users"; unknown or
+    deleted ids are left out.
+    """
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        abort(400, "Send a JSON object.")
+
+    user_ids = ids_arg(data, 'users')
+    messages = shards.messages_by_id(ids_arg(data, 'messages'))
+
+    payload, authors = messages_json(messages, g.user.id if g.user else None)
+    users = cards_by_id(user_ids)
+    users.update(authors)
+
+    return api_response({'users': users,
+                         'messages': {msg['id']: msg for msg in payload}})
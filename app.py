@@ -1,438 +1,141 @@
-from crypt import methods
-import os
-from turtle import update
-
-from flask import Flask, render_template, request, flash, redirect, session, g, request
-from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
-
-from forms import UpdateUserForm, UserAddForm, LoginForm, MessageForm
-from models import db, connect_db, User, Message, Likes
-from flask_bcrypt import Bcrypt
-
-CURR_USER_KEY = "curr_user"
-
-# https://upload.wikimedia.org/wikipedia/commons/thumb/7/7d/NaPali_overlook_Kalalau_Valley.jpg/1024px-NaPali_overlook_Kalalau_Valley.jpg
-
-app = Flask(__name__)
-bcrypt = Bcrypt(app)
-
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
-
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
-
-connect_db(app)
-
-
-##############################################################################
-# User signup/login/logout
-
-
-@app.before_request
-def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
-
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
-
-    else:
-        g.user = None
-
-
-def do_login(user):
-    """Log in user."""
-
-    session[CURR_USER_KEY] = user.id
-
-
-def do_logout():
-    """Logout user."""
-
-    if CURR_USER_KEY in session:
-        del session[CURR_USER_KEY]
-        return True
-    return False
-
-
-@app.route('/signup', methods=["GET", "POST"])
-def signup():
-    """Handle user signup.
-
-    Create new user and add to DB. Redirect to home page.
-
-    If form not valid, present form.
-
-    If the there already is a user with that username: flash message
-    and re-present form.
-    """
-    if CURR_USER_KEY in session:
-        del session[CURR_USER_KEY]
-
-    form = UserAddForm()
-
-    if form.validate_on_submit():
-        try:
-            user = User.signup(
-                username=form.username.data,
-                password=form.password.data,
-                email=form.email.data,
-                image_url=form.image_url.data or User.image_url.default.arg,
-            )
-            db.session.commit()
-
-        except IntegrityError:
-            flash("Username already taken", 'danger')
-            return render_template('users/signup.html', form=form)
-
-        do_login(user)
-
-        return redirect("/")
-
-    else:
-        return render_template('users/signup.html', form=form)
-
-
-@app.route('/login', methods=["GET", "POST"])
-def login():
-    """Handle user login."""
-
-    form = LoginForm()
-
-    if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
-
-        if user:
-            do_login(user)
-            flash(f"Hello, {user.username}!", "success")
-            return redirect("/")
-
-        flash("Invalid credentials.", 'danger')
-
-    return render_template('users/login.html', form=form)
-
-
-@app.route('/logout')
-def logout():
-    """Handle logout of user."""
-
-    logout_result = do_logout()
-
-    if logout_result:
-        flash('User logout successful')
-
-    return redirect('/login')
-
-    
-
-
-##############################################################################
-# General user routes:
-
-@app.route('/users')
-def list_users():
-    """Page with listing of users.
-
-    Can take a 'q' param in querystring to search by that username.
-    """
-
-    search = request.args.get('q')
-
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
-
-    return render_template('users/index.html', users=users)
-
-
-@app.route('/users/<int:user_id>')
-def users_show(user_id):
-    """Show user profile."""
-
-    # if not g.user:
-    #     flash("Access unauthorized.", "danger")
-    #     return redirect("/")
-
-    user = User.query.get_or_404(user_id)
-
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    likes = Likes.query.filter_by(user_id=user.id)
-    liked_messages = [like.messages for like in likes]
-
-    like_count = len([like.id for like in likes])
-
-    return render_template('users/show.html', user=user, messages=messages, like_count=like_count)
-
-@app.route('/users/<int:user_id>/likes')
-def show_user_likes(user_id):
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    user = User.query.get_or_404(user_id)
-
-    likes = Likes.query.filter_by(user_id=user.id)
-    # can do a message query but filter based on user likes 
-    # then messages will be connected to the user
-
-    liked_messages = [like.messages for like in likes]
-    like_count = len(liked_messages)
-
-    # map the user info with the message
-
-    return render_template('users/likes.html', user=user, like_count=like_count, liked_messages=liked_messages)
-
-@app.route('/users/<int:user_id>/following')
-def show_following(user_id):
-    """Show list of people this user is following."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    user = User.query.get_or_404(user_id)
-
-    likes = Likes.query.filter_by(user_id=user.id)
-    liked_messages = [like.messages for like in likes]
-    like_count = len(liked_messages)
+"""Warbler.
 
-    return render_template('users/following.html', user=user, like_count=like_count)
+`create_app(config)` builds the Flask app: configuration from the
+environment (overridden by `config`), the database, caches and shared
+files, then one blueprint per part of the site. Nothing is built when
+this module is imported; `from app import app` (tests, `FLASK_APP=app`)
+builds the app from the environment on first use.
+"""
 
+import os
 
-@app.route('/users/<int:user_id>/followers')
-def users_followers(user_id):
-    """Show list of followers of this user."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    user = User.query.get_or_404(user_id)
-
-    likes = Likes.query.filter_by(user_id=user.id)
-    liked_messages = [like.messages for like in likes]
-    like_count = len(liked_messages)
-    return render_template('users/followers.html', user=user, like_count=like_count)
-
-
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
-def add_follow(follow_id):
-    """Add a follow for the currently-logged-in user."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
-
-    return redirect(f"/users/{g.user.id}/following")
-
-
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
-def stop_following(follow_id):
-    """Have currently-logged-in-user stop following this user."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
-
-    return redirect(f"/users/{g.user.id}/following")
-
-
-@app.route('/users/profile', methods=["GET", "POST"])
-def profile():
-    """Update profile for current user."""
-
-    add_user_to_g()
-    user = g.user
-
-    form = UpdateUserForm()
-
-    if form.validate_on_submit():
-
-        username = form.username.data
-        user = User.query.filter_by(username=username)
-
-        hashed_password = user[0].password
-        submitted_password = form.password.data
-
-        password_check = bcrypt.check_password_hash(hashed_password,submitted_password)
-
-        if not password_check:
-            flash('Username/password combination incorrect')
-            return redirect('/')
-
-        user[0].email = form.email.data
-        user[0].image_url = form.image_url.data
-        user[0].header_image_url = form.header_image_url.data
-        user[0].bio = form.bio.data
-
-        db.session.add(user[0])
-        db.session.commit()
-
-        return redirect(f'/users/{user[0].id}')
-
-    # auto populate the fields if data exists
-    form.username.data = user.username
-    form.email.data = user.email
-    form.image_url.data = user.image_url
-    form.header_image_url.data = user.header_image_url
-    form.bio.data = user.bio
-
-    return render_template('/users/edit.html', form=form, user=g.user)
-
-
-@app.route('/users/delete', methods=["POST"])
-def delete_user():
-    """Delete user."""
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    do_logout()
-
-    db.session.delete(g.user)
-    db.session.commit()
-
-    return redirect("/signup")
-
-
-##############################################################################
-# Messages routes:
-
-@app.route('/messages/new', methods=["GET", "POST"])
-def messages_add():
-    """Add a message:
-
-    Show form if GET. If valid, update message and redirect to user page.
-    """
-    if not g.user or request.form['user_id'] != g.user.id:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    form = MessageForm()
-
-    if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
-
-        return redirect(f"/users/{g.user.id}")
-
-    return render_template('messages/new.html', form=form)
-
-
-@app.route('/messages/<int:message_id>', methods=["GET"])
-def messages_show(message_id):
-    """Show a message."""
-
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
-
-
-@app.route('/messages/<int:message_id>/delete', methods=["GET","POST"])
-def messages_destroy(message_id):
-    """Delete a message."""
-    msg = Message.query.get(message_id)
-
-    if not g.user or msg.user_id != g.user.id:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-
-    db.session.delete(msg)
-    db.session.commit()
-
-    return redirect(f"/users/{g.user.id}")
-
-
-##############################################################################
-# Homepage and error pages
-
-
-@app.route('/')
-def homepage():
-    """Show homepage:
-
-    - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
-    """
-
-    if g.user:
-        # get list of users being following
-        user = g.user
-        followed_users = [followed_user.id for followed_user in user.following]
-        followed_users.append(user.id)
-
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(followed_users))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        likes = Likes.query.all()
-        like_message_ids = [like.message_id for like in likes]
-            
-        return render_template('home.html', messages=messages, likes=likes, like_message_ids=like_message_ids, user=user)
-
-    else:
-        return render_template('home-anon.html')
-
-@app.route('/users/handle_like/<int:msg_id>', methods=["POST"])
-def handle_like(msg_id):
-
-    if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
-
-    curr_user_id = g.user.id
-
-    likes = Likes.query.filter_by(user_id=curr_user_id)
-    like = [like for like in likes if msg_id == like.message_id]
+from flask import Flask
 
-    if len(like) != 0 and like[0].user_id != g.user.id:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
+from auth import CURR_USER_KEY  # noqa: F401 (tests log in through it)
 
+# https://upload.wikimedia.org/wikipedia/commons/thumb/7/7d/NaPali_overlook_Kalalau_Valley.jpg/1024px-NaPali_overlook_Kalalau_Valley.jpg
 
-    if (len(like)!=0):
-        # Delete message from likes
-        like_to_delete = Likes.query.get(like[0].user_id)
-        
-        db.session.delete(like_to_delete)
-        db.session.commit()
-    else:
-        # Add message to likes 
-        new_like = Likes(user_id = curr_user_id, message_id = msg_id)
 
-        db.session.add(new_like)
-        db.session.commit()
+def default_config(app):
+    """Settings from the environment, with development defaults."""
+
+    return {
+        # Get DB_URI from environ variable (useful for production/testing) or,
+        # if not set there, use development local db.
+        'SQLALCHEMY_DATABASE_URI': os.environ.get('DATABASE_URL', 'postgresql:///warbler'),
+
+        # Comma-separated read replicas; GET requests are spread over them.
+        'SQLALCHEMY_REPLICA_URIS': [
+            uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if uri],
+        'READ_YOUR_WRITES_SECONDS': 5,
+
+        # Comma-separated shard databases for messages/likes; unset keeps them
+        # on the primary.
+        'SHARD_URIS': [
+            uri for uri in os.environ.get('DATABASE_SHARD_URLS', '').split(',') if uri],
+
+        'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+        'SQLALCHEMY_ECHO': False,
+        'DEBUG_TB_INTERCEPT_REDIRECTS': False,
+        'SECRET_KEY': os.environ.get('SECRET_KEY', "it's a secret"),
+
+        # Old months of messages are moved here by `flask archive-messages`.
+        'MESSAGE_ARCHIVE_DIR': os.environ.get(
+            'MESSAGE_ARCHIVE_DIR', os.path.join(app.instance_path, 'archive')),
+
+        # Column files written by `flask export-analytics`, read by reports.
+        'ANALYTICS_DIR': os.environ.get(
+            'ANALYTICS_DIR', os.path.join(app.instance_path, 'analytics')),
+
+        # Follow graph snapshot and change journal, shared by the workers.
+        'FOLLOW_GRAPH_DIR': os.environ.get(
+            'FOLLOW_GRAPH_DIR', os.path.join(app.instance_path, 'follow_graph')),
+
+        # Fixed-size trending sketch file, shared by the workers.
+        'TRENDING_PATH': os.environ.get(
+            'TRENDING_PATH', os.path.join(app.instance_path, 'trending.bin')),
+
+        # SQLite file holding the background job queue (see jobs.py).
+        'JOBS_DB_PATH': os.environ.get(
+            'JOBS_DB_PATH', os.path.join(app.instance_path, 'jobs.sqlite')),
+
+        # Compiled templates, shared by the workers (see template_cache.py).
+        'TEMPLATE_CACHE_DIR': os.environ.get(
+            'TEMPLATE_CACHE_DIR', os.path.join(app.instance_path, 'templates')),
+
+        # Where workers publish new messages for live.py: unix:///path/to.sock
+        # (one host) or notify:// (Postgres NOTIFY); empty turns it off.
+        'LIVE_TRANSPORT_URL': os.environ.get(
+            'LIVE_TRANSPORT_URL', 'unix://' + os.path.join(app.instance_path, 'live.sock')),
+
+        # Where pages open the live timeline stream (routed to live.py); empty
+        # means they don't.
+        'LIVE_URL': os.environ.get('LIVE_URL', ''),
+
+        # Per-worker logs of like toggles not yet written (see like_buffer.py);
+        # written every LIKE_FLUSH_MS, or once LIKE_FLUSH_EVENTS are waiting.
+        'LIKE_BUFFER_DIR': os.environ.get(
+            'LIKE_BUFFER_DIR', os.path.join(app.instance_path, 'likes')),
+        'LIKE_FLUSH_MS': 50,
+        'LIKE_FLUSH_EVENTS': 500,
+
+        # lru:// (per process), shm:///path (shared by workers) or redis://host:port/db
+        'CACHE_URL': os.environ.get('CACHE_URL', 'lru://'),
+
+        # Bearer token for the stats endpoints in ops.py; empty turns them off.
+        'OPS_TOKEN': os.environ.get('OPS_TOKEN', ''),
+    }
+
+
+def create_app(config=None):
+    """Build the app; `config` overrides settings from the environment."""
+
+    app = Flask(__name__)
+    app.config.update(default_config(app))
+    app.config.update(config or {})
+
+    if app.debug:
+        # development only, and slow to import
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    from models import connect_db
+    from cache import connect_cache
+    from sharding import connect_shards
+    from follow_graph import connect_follow_graph
+    from trending import connect_trending
+    from jobs import connect_jobs
+    from fragments import connect_fragment_cache
+    from template_cache import connect_template_cache
+    from live import connect_live
+    from like_buffer import connect_like_buffer
+
+    connect_db(app)
+    connect_cache(app)
+    connect_shards(app)
+    connect_follow_graph(app)
+    connect_trending(app)
+    connect_jobs(app)
+    connect_fragment_cache(app)
+    connect_template_cache(app)
+    connect_live(app)
+    connect_like_buffer(app)
+
+    import auth
+    import user_views
+    import message_views
+    import ops
+    import api
+
+    for blueprint in (auth.bp, user_views.bp, message_views.bp, ops.bp, api.bp):
+        app.register_blueprint(blueprint)
+    for command in ops.cli.commands.values():
+        app.cli.add_command(command)
+
+    app.after_request(add_header)
+
+    return app
 
-    return redirect('/')
 
 ##############################################################################
 # Turn off all caching in Flask
@@ -441,7 +144,6 @@ def handle_like(msg_id):
 #
 # https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
 
-@app.after_request
 def add_header(req):
     """Add non-caching headers on every request."""
 
@@ -450,3 +152,18 @@ def add_header(req):
     req.headers["Expires"] = "0"
     req.headers['Cache-Control'] = 'public, max-age=0'
     return req
+
+
+_app = None
+
+
+def __getattr__(name):
+    """`app`: the app built from the environment, created on first use."""
+
+    global _app
+
+    if name != 'app':
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    if _app is None:
+        _app = create_app()
+    return _app
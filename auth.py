@@ -0,0 +1,118 @@
+"""Signup, login and logout, and the logged-in user on `g`.
+
+Forms are imported by the views that show them: WTForms is one of the
+slower imports, and most requests never need it.
+"""
+
+from flask import Blueprint, render_template, flash, redirect, session, g
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User
+
+CURR_USER_KEY = "curr_user"
+
+bp = Blueprint('auth', __name__)
+
+
+@bp.before_app_request
+def add_user_to_g():
+    """If we're logged in, add curr user to Flask global."""
+
+    if CURR_USER_KEY in session:
+        g.user = User.query.get(session[CURR_USER_KEY])
+
+        if g.user is None or g.user.deleted_at:
+            g.user = None
+            del session[CURR_USER_KEY]
+
+    else:
+        g.user = None
+
+
+def do_login(user):
+    """Log in user."""
+
+    session[CURR_USER_KEY] = user.id
+
+
+def do_logout():
+    """Logout user."""
+
+    if CURR_USER_KEY in session:
+        del session[CURR_USER_KEY]
+        return True
+    return False
+
+
+@bp.route('/signup', methods=["GET", "POST"])
+def signup():
+    """Handle user signup.
+
+    Create new user and add to DB. Redirect to home page.
+
+    If form not valid, present form.
+
+    If the there already is a user with that username: flash message
+    and re-present form.
+    """
+    if CURR_USER_KEY in session:
+        del session[CURR_USER_KEY]
+
+    from forms import UserAddForm
+
+    form = UserAddForm()
+
+    if form.validate_on_submit():
+        try:
+            user = User.signup(
+                username=form.username.data,
+                password=form.password.data,
+                email=form.email.data,
+                image_url=form.image_url.data or User.image_url.default.arg,
+            )
+            db.session.commit()
+
+        except IntegrityError:
+            flash("Username already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
+        do_login(user)
+
+        return redirect("/")
+
+    else:
+        return render_template('users/signup.html', form=form)
+
+
+@bp.route('/login', methods=["GET", "POST"])
+def login():
+    """Handle user login."""
+
+    from forms import LoginForm
+
+    form = LoginForm()
+
+    if form.validate_on_submit():
+        user = User.authenticate(form.username.data,
+                                 form.password.data)
+
+        if user:
+            do_login(user)
+            flash(f"Hello, {user.username}!", "success")
+            return redirect("/")
+
+        flash("Invalid credentials.", 'danger')
+
+    return render_template('users/login.html', form=form)
+
+
+@bp.route('/logout')
+def logout():
+    """Handle logout of user."""
+
+    logout_result = do_logout()
+
+    if logout_result:
+        flash('User logout successful')
+
+    return redirect('/login')
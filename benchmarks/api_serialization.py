@@ -0,0 +1,102 @@
+"""Cost of serializing 100 timeline messages, per format.
+
+    python benchmarks/api_serialization.py [--messages 100] [--authors 30] [--runs 200]
+
+Builds the messages and their authors in memory (no database), then times:
+
+- api: what /api/v1/timeline does, compact messages plus one card per
+  author, dumped without whitespace
+- nested: the obvious alternative, every message embedding its author's
+  full row, dumped with Flask's default formatting
+- html: rendering home.html for the same messages (what the mobile client
+  scraped), with the fragment cache emptied each run
+
+Prints the best time per run and the size of the body.
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def best_ms(fn, runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100)
+    parser.add_argument('--authors', type=int, default=30)
+    parser.add_argument('--runs', type=int, default=200)
+    args = parser.parse_args()
+
+    # nothing here queries it
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    os.environ['FLASK_ENV'] = 'production'
+
+    from flask import g, jsonify, render_template
+
+    from api import message_json, card_json, api_response
+    from app import create_app
+    from fragments import clear_fragment_cache
+    from models import User, Message
+
+    app = create_app()
+
+    authors = [User(id=i, username=f"user{i}", email=f"user{i}@bench.test",
+                    password="x" * 60, image_url='/static/images/default-pic.png',
+                    header_image_url='/static/images/warbler-hero.jpg',
+                    bio="Just another warbler.", location="Somewhere",
+                    followers_count=100, following_count=50)
+               for i in range(1, args.authors + 1)]
+    start = datetime(2020, 1, 1)
+    messages = [Message(id=i, text=f"message number {i}, with a bit of text to it",
+                        timestamp=start - timedelta(minutes=i),
+                        user_id=authors[i % len(authors)].id, user=authors[i % len(authors)])
+                for i in range(args.messages)]
+    liked_ids = {msg.id for msg in messages[::3]}
+
+    def api():
+        by_id = {msg.user_id: msg.user for msg in messages}
+        return api_response({
+            'messages': [message_json(msg, liked_ids) for msg in messages],
+            'users': {user_id: card_json(user) for user_id, user in by_id.items()},
+            'next': None}).get_data()
+
+    user_columns = [column.name for column in User.__table__.columns
+                    if column.name != 'password']
+
+    def nested():
+        with app.app_context():
+            return jsonify(messages=[
+                {'id': msg.id, 'text': msg.text, 'timestamp': msg.timestamp,
+                 'liked': msg.id in liked_ids,
+                 'user': {name: getattr(msg.user, name) for name in user_columns}}
+                for msg in messages]).get_data()
+
+    def html():
+        clear_fragment_cache()
+        with app.test_request_context('/'):
+            g.user = authors[0]
+            return render_template('home.html', messages=messages, likes=liked_ids,
+                                   like_message_ids=liked_ids, user=authors[0],
+                                   suggestions=[]).encode()
+
+    print(f"{args.messages} messages by {args.authors} authors")
+    for label, fn in (('api', api), ('nested', nested), ('html', html)):
+        size = len(fn())
+        print(f"{label:<8} {best_ms(fn, args.runs):7.3f} ms  {size:7d} bytes")
+
+
+if __name__ == '__main__':
+    main()
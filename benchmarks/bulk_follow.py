@@ -0,0 +1,80 @@
+"""Follows per second: set-based bulk follows vs. the ORM collection.
+
+    DATABASE_URL=postgresql:///warbler-bench python benchmarks/bulk_follow.py [--follows 10000]
+
+Creates --follows fresh accounts plus a few followers in the database
+named by DATABASE_URL (drop and recreate it afterwards), then has one
+follower follow all of them in BULK_FOLLOW_LIMIT-sized transactions with
+follow_users, and another one at a time through `user.following.append`,
+committing each, the way add_follow used to.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app  # noqa: E402
+from follows import follow_users, unfollow_users, BULK_FOLLOW_LIMIT  # noqa: E402
+from models import db, User  # noqa: E402
+
+
+def make_users(prefix, count):
+    db.session.bulk_insert_mappings(User, [
+        {'username': f"{prefix}{i}", 'email': f"{prefix}{i}@bench.test",
+         'password': 'x', 'image_url': '/static/images/default-pic.png',
+         'header_image_url': '/static/images/warbler-hero.jpg'}
+        for i in range(count)])
+    db.session.commit()
+    return [user_id for (user_id,) in db.session.query(User.id)
+            .filter(User.username.like(f"{prefix}%")).order_by(User.id)]
+
+
+def report(label, count, seconds):
+    print(f"{label:<28} {count:>7} follows  {seconds:7.2f} s  "
+          f"{count / seconds:9.0f} follows/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--follows', type=int, default=10000)
+    parser.add_argument('--orm-follows', type=int, default=2000,
+                        help="follows for the (slow) ORM run")
+    args = parser.parse_args()
+
+    db.create_all()
+    stamp = int(time.time())
+    targets = make_users(f"bench{stamp}t", args.follows)
+    bulk_id, orm_id = make_users(f"bench{stamp}f", 2)
+
+    start = time.perf_counter()
+    for i in range(0, len(targets), BULK_FOLLOW_LIMIT):
+        follow_users(bulk_id, targets[i:i + BULK_FOLLOW_LIMIT])
+        db.session.commit()
+    report("follow_users (bulk)", len(targets), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(0, len(targets), BULK_FOLLOW_LIMIT):
+        unfollow_users(bulk_id, targets[i:i + BULK_FOLLOW_LIMIT])
+        db.session.commit()
+    report("unfollow_users (bulk)", len(targets), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for target_id in targets[:args.orm_follows]:
+        follow_users(bulk_id, [target_id])
+        db.session.commit()
+    report("follow_users (one each)", args.orm_follows, time.perf_counter() - start)
+
+    follower = User.query.get(orm_id)
+    start = time.perf_counter()
+    for target_id in targets[:args.orm_follows]:
+        follower.following.append(User.query.get(target_id))
+        db.session.commit()
+    report("following.append", args.orm_follows, time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        main()
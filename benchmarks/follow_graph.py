@@ -0,0 +1,104 @@
+"""Memory and latency of the CSR follow graph on a synthetic graph.
+
+    python benchmarks/follow_graph.py [--edges 10000000] [--users 1000000]
+
+Edges are drawn with a skewed (Zipf-like) followed side, so some users
+have very large follower rows, like a real follow graph. Needs no
+database; the snapshot goes to a temporary directory and is read back
+memory-mapped, the way workers use it.
+"""
+
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from follow_graph import FollowGraph  # noqa: E402
+
+
+def synthetic_edges(num_edges, num_users, seed=0):
+    rng = np.random.RandomState(seed)
+    followers = rng.randint(0, num_users, num_edges).astype(np.int32)
+    followed = ((rng.zipf(1.3, num_edges) - 1) % num_users).astype(np.int32)
+    return followers, followed
+
+
+def timed(label, fn, samples):
+    """Run fn on each sample; print mean and p99 in microseconds."""
+
+    times = np.empty(len(samples))
+    for i, sample in enumerate(samples):
+        start = time.perf_counter()
+        fn(*sample)
+        times[i] = time.perf_counter() - start
+
+    times *= 1e6
+    print(f"  {label:<28} mean {times.mean():9.1f} us   "
+          f"p99 {np.percentile(times, 99):9.1f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--edges', type=int, default=10000000)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=10000)
+    args = parser.parse_args()
+
+    followers, followed = synthetic_edges(args.edges, args.users)
+
+    start = time.perf_counter()
+    graph = FollowGraph.from_edges(followers, followed, args.users)
+    print(f"build     {time.perf_counter() - start:6.2f} s "
+          f"({args.edges:,} edges, {args.users:,} users)")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'snapshot')
+        start = time.perf_counter()
+        graph.save(path, {})
+        print(f"save      {time.perf_counter() - start:6.2f} s")
+
+        start = time.perf_counter()
+        graph, meta = FollowGraph.load(path)
+        print(f"load      {(time.perf_counter() - start) * 1000:6.2f} ms (mmap)")
+
+        arrays = (graph.out_indptr, graph.out_indices,
+                  graph.in_indptr, graph.in_indices)
+        size = sum(array.nbytes for array in arrays)
+        print(f"arrays    {size / 2**20:6.1f} MiB "
+              f"({size / args.edges:.1f} bytes/edge, both directions)")
+
+        rng = np.random.RandomState(1)
+        users = rng.randint(0, args.users, (args.queries, 2))
+        pairs = [(int(a), int(b)) for a, b in users]
+        singles = [(int(a),) for a, b in users]
+        edges = [(int(followers[i]), int(followed[i]))
+                 for i in rng.randint(0, args.edges, args.queries)]
+
+        print("latency")
+        timed("is_following (miss)", graph.is_following, pairs)
+        timed("is_following (hit)", graph.is_following, edges)
+        timed("following_count", graph.following_count, singles)
+        timed("follower_count", graph.follower_count, singles)
+        timed("mutuals", graph.mutuals, singles)
+        timed("common_following", graph.common_following, pairs)
+        timed("followers_of_followers", graph.followers_of_followers,
+              singles[:1000])
+
+        for a, b in edges[:1000]:
+            graph.apply(a, b, False)
+        timed("is_following (overlay)", graph.is_following, edges[:1000])
+        timed("following (overlay row)", graph.following,
+              [(a,) for a, b in edges[:1000]])
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"max rss   {rss / 1024:6.1f} MiB (includes the build)")
+
+
+if __name__ == '__main__':
+    main()
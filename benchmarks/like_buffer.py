@@ -0,0 +1,87 @@
+"""Likes on one hot message: a transaction per click, or buffered.
+
+    python benchmarks/like_buffer.py [--clicks 5000] [--users 1000]
+
+Seeds a scratch SQLite database with --users users and one message, then
+has random users toggle their like on it --clicks times: first with
+`shards.toggle_like` (what a click used to do), then with `like_buffer`
+and its flushing thread at the default LIKE_FLUSH_MS. Prints clicks/s,
+database commits, and that both end with the same likes. Set
+DATABASE_URL to run against Postgres instead (use a scratch database).
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy import event
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clicks', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        for name in ('FOLLOW_GRAPH_DIR', 'JOBS_DB_PATH', 'TRENDING_PATH', 'LIKE_BUFFER_DIR'):
+            os.environ[name] = os.path.join(tmp, name.lower())
+        os.environ['FLASK_ENV'] = 'production'
+
+        from app import create_app
+        from like_buffer import like_buffer
+        from models import db, User, Message, Likes
+        from sharding import shards
+
+        app = create_app()
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            db.session.bulk_insert_mappings(User, [
+                {'id': i, 'username': f"user{i}", 'email': f"user{i}@bench.test", 'password': 'x'}
+                for i in range(1, args.users + 1)])
+            db.session.add(Message(id=1, text="hot", user_id=1))
+            db.session.commit()
+
+            commits = []
+            event.listen(db.engine, 'commit', lambda conn: commits.append(1))
+            for engine in shards.engines:
+                event.listen(engine, 'commit', lambda conn: commits.append(1))
+
+            random.seed(1)
+            clickers = [random.randint(1, args.users) for _ in range(args.clicks)]
+
+            def run(name, toggle, finish):
+                Likes.query.delete()
+                db.session.commit()
+                del commits[:]
+
+                start = time.perf_counter()
+                for user_id in clickers:
+                    toggle(user_id, 1)
+                finish()
+                seconds = time.perf_counter() - start
+
+                liked = {user_id for (user_id,) in db.session.query(Likes.user_id)}
+                print(f"{name:>12}: {args.clicks / seconds:8.0f} clicks/s, "
+                      f"{len(commits):5} commits, {len(liked)} users like it")
+                return liked
+
+            direct = run("per click", shards.toggle_like, lambda: None)
+            buffered = run("buffered", like_buffer.toggle, like_buffer.flush)
+            assert direct == buffered
+
+            print(f"{like_buffer.stats['flushes']} flushes wrote "
+                  f"{like_buffer.stats['rows']} rows for {like_buffer.stats['toggles']} clicks")
+            like_buffer.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+"""Memory per idle live stream, and fan-out time to all of them.
+
+    python benchmarks/live_connections.py [--streams 5000]
+
+Seeds a scratch SQLite database where users 2..N+1 all follow user 1,
+starts live.py, and opens one stream per follower from a single asyncio
+client. Prints the live server's resident memory before and after (per
+stream), then publishes one message by user 1 and times until every
+stream has received it. That time includes COALESCE_SECONDS, the window
+the server waits to batch a burst.
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PORT = 8798
+
+
+def seed(streams):
+    """Users 2..streams+1 follow user 1; returns their session cookies."""
+
+    from app import create_app
+    from auth import CURR_USER_KEY
+    from models import db, User, Follows
+
+    app = create_app()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.bulk_insert_mappings(User, [
+            {'id': i, 'username': f"user{i}", 'email': f"user{i}@bench.test", 'password': 'x'}
+            for i in range(1, streams + 2)])
+        db.session.bulk_insert_mappings(Follows, [
+            {'user_following_id': i, 'user_being_followed_id': 1}
+            for i in range(2, streams + 2)])
+        db.session.commit()
+
+        serializer = app.session_interface.get_signing_serializer(app)
+        return [f"session={serializer.dumps({CURR_USER_KEY: i})}"
+                for i in range(2, streams + 2)]
+
+
+def rss_kb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+async def wait_ready(timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', PORT)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("live server didn't start")
+
+
+async def open_stream(cookie):
+    reader, writer = await asyncio.open_connection('127.0.0.1', PORT)
+    writer.write(f"GET /live HTTP/1.1\r\nHost: bench\r\nCookie: {cookie}\r\n\r\n".encode())
+    await writer.drain()
+    await reader.readuntil(b'\r\n\r\n')
+    await reader.readuntil(b'\n\n')  # retry:
+    return reader, writer
+
+
+async def run(cookies, server, transport):
+    await wait_ready()
+    await asyncio.sleep(1)
+    before = rss_kb(server.pid)
+
+    streams = []
+    for start in range(0, len(cookies), 500):
+        streams += await asyncio.gather(*[open_stream(c) for c in cookies[start:start + 500]])
+    await asyncio.sleep(1)
+    after = rss_kb(server.pid)
+
+    print(f"{len(streams)} streams open")
+    print(f"live server memory: {before / 1024:.1f} MB idle, {after / 1024:.1f} MB with "
+          f"streams, {(after - before) / len(streams):.1f} KB per stream")
+
+    start = time.perf_counter()
+    transport.publish(1, 1)
+    await asyncio.gather(*[reader.readuntil(b'\n\n') for reader, writer in streams])
+    print(f"one message to all {len(streams)} followers: "
+          f"{(time.perf_counter() - start) * 1000:.0f} ms")
+
+    for reader, writer in streams:
+        writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--streams', type=int, default=5000)
+    args = parser.parse_args()
+
+    # both ends of every stream are open files (live.py inherits the limit)
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(hard, max(soft, args.streams + 1000)), hard))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        for name in ('FOLLOW_GRAPH_DIR', 'JOBS_DB_PATH', 'TRENDING_PATH'):
+            os.environ.setdefault(name, os.path.join(tmp, name.lower()))
+        os.environ['LIVE_TRANSPORT_URL'] = f"unix://{os.path.join(tmp, 'live.sock')}"
+        os.environ['FLASK_ENV'] = 'production'
+
+        cookies = seed(args.streams)
+
+        from live import transport_for
+        transport = transport_for(os.environ['LIVE_TRANSPORT_URL'])
+
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'live.py'), '--bind', f"127.0.0.1:{PORT}"],
+            cwd=ROOT, stderr=subprocess.DEVNULL)
+        try:
+            asyncio.run(run(cookies, server, transport))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
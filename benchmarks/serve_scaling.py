@@ -0,0 +1,151 @@
+"""Homepage throughput of serve.py with 1, 2, 4 ... N workers.
+
+    python benchmarks/serve_scaling.py [--max-workers N] [--seconds 10] [--users 500]
+
+Seeds a throwaway SQLite database (users, follows, messages), then for
+each worker count starts serve.py, waits for /ready, and has twice as
+many client processes request the logged-in homepage as fast as they can
+for --seconds. Prints requests/s and the speedup over one worker. Set
+DATABASE_URL to run against Postgres instead (its tables are created and
+filled; use a scratch database).
+"""
+
+import argparse
+import http.client
+import multiprocessing
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PORT = 8799
+
+
+def seed(users, follows_per_user, messages_per_user):
+    """Fill the database; returns a session cookie for user 1."""
+
+    from app import create_app
+    from auth import CURR_USER_KEY
+    from follows import recount_follows
+    from models import db, User, Message, Follows
+
+    app = create_app()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.bulk_insert_mappings(User, [
+            {'id': i, 'username': f"user{i}", 'email': f"user{i}@bench.test",
+             'password': 'x', 'image_url': '/static/images/default-pic.png',
+             'header_image_url': '/static/images/warbler-hero.jpg'}
+            for i in range(1, users + 1)])
+
+        rng = random.Random(0)
+        db.session.bulk_insert_mappings(Follows, [
+            {'user_following_id': i, 'user_being_followed_id': j}
+            for i in range(1, users + 1)
+            for j in rng.sample([j for j in range(1, users + 1) if j != i],
+                                min(follows_per_user, users - 1))])
+        db.session.bulk_insert_mappings(Message, [
+            {'user_id': i, 'text': f"message {n} from user {i}"}
+            for i in range(1, users + 1) for n in range(messages_per_user)])
+        recount_follows()
+        db.session.commit()
+
+        serializer = app.session_interface.get_signing_serializer(app)
+        return f"session={serializer.dumps({CURR_USER_KEY: 1})}"
+
+
+def wait_ready(timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', PORT, timeout=5)
+            conn.request('GET', '/ready')
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("server didn't become ready")
+
+
+def client(cookie, seconds, counts):
+    served = errors = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        conn = http.client.HTTPConnection('127.0.0.1', PORT, timeout=30)
+        conn.request('GET', '/', headers={'Cookie': cookie})
+        response = conn.getresponse()
+        response.read()
+        if response.status == 200:
+            served += 1
+        else:
+            errors += 1
+        conn.close()
+    counts.put((served, errors))
+
+
+def measure(workers, cookie, seconds, env):
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'serve.py'), '--bind', f"127.0.0.1:{PORT}",
+         '--workers', str(workers)],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready()
+
+        counts = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=client, args=(cookie, seconds, counts))
+                   for _ in range(2 * workers)]
+        for process in clients:
+            process.start()
+        results = [counts.get() for _ in clients]
+        for process in clients:
+            process.join()
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+
+    return sum(s for s, e in results) / seconds, sum(e for s, e in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--follows', type=int, default=50, help="per user")
+    parser.add_argument('--messages', type=int, default=20, help="per user")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        for name in ('FOLLOW_GRAPH_DIR', 'JOBS_DB_PATH', 'TRENDING_PATH'):
+            os.environ.setdefault(name, os.path.join(tmp, name.lower()))
+        os.environ['FLASK_ENV'] = 'production'
+
+        cookie = seed(args.users, args.follows, args.messages)
+
+        counts = [1]
+        while counts[-1] * 2 <= args.max_workers:
+            counts.append(counts[-1] * 2)
+        if counts[-1] != args.max_workers:
+            counts.append(args.max_workers)
+
+        print(f"{os.cpu_count()} cores; GET / as a user following {args.follows} of "
+              f"{args.users} users")
+        base = None
+        for workers in counts:
+            rate, errors = measure(workers, cookie, args.seconds, dict(os.environ))
+            base = base or rate
+            print(f"{workers:>3} workers  {rate:8.1f} req/s  x{rate / base:.2f}"
+                  f"{f'  ({errors} errors)' if errors else ''}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Cold import time and time to first response, with a budget.
+
+    python benchmarks/startup.py [--runs 7] [--import-budget-ms 400] [--first-response-budget-ms 650]
+
+Each run is a fresh interpreter, so nothing is cached in sys.modules:
+
+- import: `import app` (which must not build the app)
+- first response: `create_app()` and a GET of `url` through the test
+  client, timed from before `import app`
+
+Prints the fastest of the runs (the least disturbed by whatever else the
+machine is doing) and exits with status 1 if either is over its budget, so CI can catch a heavy import creeping back in.
+DATABASE_URL defaults to a throwaway SQLite file; the anonymous homepage
+doesn't query it.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_BUDGET_MS = 400
+FIRST_RESPONSE_BUDGET_MS = 650
+
+IMPORT_RUN = """
+import time
+start = time.perf_counter()
+import app
+elapsed = time.perf_counter() - start
+assert '_app' not in vars(app) or app._app is None, "importing app built it"
+print(elapsed)
+"""
+
+FIRST_RESPONSE_RUN = """
+import sys, time
+start = time.perf_counter()
+from app import create_app
+response = create_app().test_client().get(sys.argv[1])
+elapsed = time.perf_counter() - start
+assert response.status_code == 200, response.status_code
+print(elapsed)
+"""
+
+
+def best_ms(code, runs, env, *args):
+    times = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', code, *args], cwd=ROOT, env=env,
+                             check=True, stdout=subprocess.PIPE, universal_newlines=True)
+        times.append(float(out.stdout.strip().splitlines()[-1]) * 1000)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--url', default='/')
+    parser.add_argument('--import-budget-ms', type=float, default=IMPORT_BUDGET_MS)
+    parser.add_argument('--first-response-budget-ms', type=float,
+                        default=FIRST_RESPONSE_BUDGET_MS)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, FLASK_ENV='production')
+        env.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tmp, 'startup.db')}")
+        for name in ('FOLLOW_GRAPH_DIR', 'JOBS_DB_PATH', 'TRENDING_PATH'):
+            env.setdefault(name, os.path.join(tmp, name.lower()))
+
+        results = [
+            ("import", best_ms(IMPORT_RUN, args.runs, env), args.import_budget_ms),
+            ("first response", best_ms(FIRST_RESPONSE_RUN, args.runs, env, args.url),
+             args.first_response_budget_ms),
+        ]
+
+    failed = False
+    for label, ms, budget in results:
+        over = ms > budget
+        failed |= over
+        print(f"{label:<16} {ms:7.1f} ms  (budget {budget:.0f} ms){'  OVER' if over else ''}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
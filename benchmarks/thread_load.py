@@ -0,0 +1,121 @@
+"""Loading a big reply thread: a query per level, or one path range scan.
+
+    python benchmarks/thread_load.py [--replies 10000] [--runs 20]
+
+Seeds a scratch SQLite database with one message and --replies replies
+to it: each reply answers the thread starter with --top-share chance,
+otherwise one of the --recent latest replies (so the conversation drifts
+deeper, up to MAX_THREAD_DEPTH). Then loads the thread three ways:
+following parent_id one level at a time (what a thread without stored
+paths needs), the whole thread with `shards.thread` (one range scan of
+ix_messages_thread_path), and just the first THREAD_BRANCHES branches,
+the page /messages/<id> shows. Prints the median milliseconds, queries
+and rows of each. Set DATABASE_URL to run against Postgres instead (use
+a scratch database).
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from sqlalchemy import event
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# parameters per `parent_id IN (...)` query (SQLite allows 999)
+LEVEL_BATCH = 500
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--replies', type=int, default=10000)
+    parser.add_argument('--top-share', type=float, default=0.05)
+    parser.add_argument('--recent', type=int, default=100)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        for name in ('FOLLOW_GRAPH_DIR', 'JOBS_DB_PATH', 'TRENDING_PATH', 'LIKE_BUFFER_DIR'):
+            os.environ[name] = os.path.join(tmp, name.lower())
+        os.environ['FLASK_ENV'] = 'production'
+
+        from app import create_app
+        from models import db, User, Message
+        from sharding import shards
+        from threads import reply_fields, depth, THREAD_BRANCHES
+
+        app = create_app()
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            db.session.bulk_insert_mappings(User, [
+                {'id': i, 'username': f"user{i}", 'email': f"user{i}@bench.test", 'password': 'x'}
+                for i in range(1, 101)])
+
+            random.seed(1)
+            root = SimpleNamespace(id=1, path=None, thread_id=None)
+            nodes, rows, counts = [root], [], {1: 0}
+            for message_id in range(2, args.replies + 2):
+                parent = (root if random.random() < args.top_share else
+                          random.choice(nodes[-args.recent:]))
+                node = SimpleNamespace(id=message_id, **reply_fields(parent, message_id))
+                counts[node.parent_id] += 1
+                counts[message_id] = 0
+                nodes.append(node)
+                rows.append(dict(vars(node), text=f"reply {message_id}",
+                                 user_id=random.randint(1, 100)))
+            for row in rows:
+                row['reply_count'] = counts[row['id']]
+            db.session.bulk_insert_mappings(Message, [
+                {'id': 1, 'text': "thread starter", 'user_id': 1, 'reply_count': counts[1]}] + rows)
+            db.session.commit()
+
+            queries = []
+            event.listen(db.engine, 'before_cursor_execute',
+                         lambda *args: queries.append(1))
+
+            def by_level():
+                replies, level = [], [1]
+                while level:
+                    found = []
+                    for start in range(0, len(level), LEVEL_BATCH):
+                        found += (Message.query
+                                  .filter(Message.parent_id.in_(level[start:start + LEVEL_BATCH]))
+                                  .all())
+                    replies += found
+                    level = [msg.id for msg in found]
+                return replies
+
+            def run(name, load):
+                times = []
+                for _ in range(args.runs):
+                    db.session.expunge_all()
+                    del queries[:]
+                    start = time.perf_counter()
+                    replies = load()
+                    times.append(time.perf_counter() - start)
+                print(f"{name:>17}: {statistics.median(times) * 1000:8.1f} ms, "
+                      f"{len(queries):3} queries, {len(replies):6} replies")
+                return replies
+
+            starter = Message.query.get(1)
+            print(f"{args.replies} replies, {starter.reply_count} direct, "
+                  f"{max(depth(row['path']) for row in rows)} deep")
+
+            levels = run("per level", by_level)
+            whole = run("path scan", lambda: shards.thread(starter, branches=None)[0])
+            first = run(f"first {THREAD_BRANCHES} branches",
+                        lambda: shards.thread(starter)[0])
+            assert {msg.id for msg in levels} == {msg.id for msg, _ in whole}
+            assert [msg.id for msg, _ in first] == [msg.id for msg, _ in whole[:len(first)]]
+
+
+if __name__ == '__main__':
+    main()
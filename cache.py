@@ -0,0 +1,616 @@
+"""Cache subsystem for Warbler.
+
+Everything that caches goes through `cache`, which forwards to one of three
+backends picked by the CACHE_URL setting:
+
+    lru://?max_bytes=67108864       per-process LRU (default)
+    shm:///tmp/warbler-cache        mmap file shared by all workers on a box
+    redis://localhost:6379/0        Redis, or the stand-in in resp_standin.py
+
+All backends store pickled values (ints are kept as plain integers so
+`incr` works everywhere) and take TTLs in seconds.
+"""
+
+import fcntl
+import hashlib
+import mmap
+import os
+import pickle
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+_MISSING = object()
+
+
+def dumps(value):
+    """Serialize a value for storage."""
+
+    if type(value) is int:
+        return str(value).encode()
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def loads(blob):
+    """Inverse of `dumps`."""
+
+    if blob[:1] == b'\x80':
+        return pickle.loads(blob)
+    return int(blob)
+
+
+class BaseCache:
+    """Interface shared by every backend.
+
+    Subclasses implement `_get`, `_set`, `_add`, `_delete_many`, `_incr` and
+    `clear`; this class adds hit/miss accounting and stampede protection.
+    """
+
+    # whether other processes see this one's writes
+    shared = True
+
+    def __init__(self, default_ttl=None):
+        self.default_ttl = default_ttl
+        # counters are per-process and only approximately thread-safe
+        self.stats = {'hits': 0, 'misses': 0, 'sets': 0, 'evictions': 0}
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+
+    def _ttl(self, ttl):
+        return self.default_ttl if ttl is None else ttl
+
+    def get(self, key, default=None):
+        """Return the value stored under `key`, or `default`."""
+
+        value = self._get(key)
+
+        if value is _MISSING:
+            self.stats['misses'] += 1
+            return default
+
+        self.stats['hits'] += 1
+        return value
+
+    def get_many(self, keys):
+        """Return {key: value} for the keys that are present."""
+
+        found = {}
+        for key in keys:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                found[key] = value
+        return found
+
+    def set(self, key, value, ttl=None):
+        """Store `value` under `key` for `ttl` seconds (None: default)."""
+
+        self.stats['sets'] += 1
+        self._set(key, value, self._ttl(ttl))
+
+    def add(self, key, value, ttl=None):
+        """Store `value` only if `key` is absent; return whether it did."""
+
+        return self._add(key, value, self._ttl(ttl))
+
+    def delete(self, key):
+        """Remove `key`."""
+
+        self._delete_many([key])
+
+    def delete_many(self, keys):
+        """Remove every key in `keys`."""
+
+        self._delete_many(list(keys))
+
+    def incr(self, key, delta=1):
+        """Atomically add `delta` to the integer at `key` (missing is 0)."""
+
+        return self._incr(key, delta)
+
+    def get_or_set(self, key, compute, ttl=None, lock_ttl=30):
+        """Return the cached value of `key`, calling `compute()` on a miss.
+
+        Only one caller recomputes a missing key at a time: threads in this
+        process wait on the leader, and other processes sharing the backend
+        wait on a lock key until the value appears (or the lock expires).
+        """
+
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = threading.Event()
+
+        if not leader:
+            flight.wait(lock_ttl)
+            value = self._get(key)
+            return compute() if value is _MISSING else value
+
+        try:
+            return self._compute_once(key, compute, ttl, lock_ttl)
+        finally:
+            with self._flights_lock:
+                del self._flights[key]
+            flight.set()
+
+    def _compute_once(self, key, compute, ttl, lock_ttl):
+        lock_key = f"lock:{key}"
+        deadline = time.time() + lock_ttl
+
+        while not self.add(lock_key, 1, ttl=lock_ttl):
+            value = self._get(key)
+            if value is not _MISSING:
+                return value
+            if time.time() > deadline:
+                break
+            time.sleep(0.01)
+
+        try:
+            value = compute()
+            self.set(key, value, ttl)
+            return value
+        finally:
+            self.delete(lock_key)
+
+    def get_stats(self):
+        """Hit/miss/set/eviction counters plus the hit ratio."""
+
+        stats = dict(self.stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+##############################################################################
+# Per-process LRU
+
+
+class LRUCache(BaseCache):
+    """In-process cache evicting least recently used entries by total size."""
+
+    shared = False
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, default_ttl=None):
+        super().__init__(default_ttl)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return _MISSING
+
+            expires_at, blob = entry
+            if expires_at and expires_at < time.time():
+                self._pop(key)
+                return _MISSING
+
+            self._data.move_to_end(key)
+        return loads(blob)
+
+    def _pop(self, key):
+        expires_at, blob = self._data.pop(key)
+        self.size -= len(blob)
+
+    def _store(self, key, blob, ttl):
+        if key in self._data:
+            self._pop(key)
+
+        if len(blob) > self.max_bytes:
+            return
+
+        self._data[key] = (time.time() + ttl if ttl else 0, blob)
+        self.size += len(blob)
+
+        while self.size > self.max_bytes:
+            self._pop(next(iter(self._data)))
+            self.stats['evictions'] += 1
+
+    def _set(self, key, value, ttl):
+        blob = dumps(value)
+        with self._lock:
+            self._store(key, blob, ttl)
+
+    def _add(self, key, value, ttl):
+        blob = dumps(value)
+        with self._lock:
+            entry = self._data.get(key)
+            if entry and not (entry[0] and entry[0] < time.time()):
+                return False
+            self._store(key, blob, ttl)
+            return True
+
+    def _delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                if key in self._data:
+                    self._pop(key)
+
+    def _incr(self, key, delta):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry and not (entry[0] and entry[0] < time.time()):
+                expires_at, blob = entry
+                value = loads(blob) + delta
+            else:
+                expires_at, value = 0, delta
+
+            ttl = max(expires_at - time.time(), 0.001) if expires_at else 0
+            self._store(key, dumps(value), ttl)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+##############################################################################
+# Cross-process shared memory
+
+
+class SharedMemoryCache(BaseCache):
+    """Set-associative hash table in an mmapped file.
+
+    Every worker that opens the same path (or inherits the mapping across
+    fork) sees the same entries. The file is split into `sets` of `ways`
+    fixed-size slots; a key hashes to one set and replaces that set's least
+    recently used slot when full. Each set is guarded by a byte-range
+    `lockf` lock, so workers only contend when they touch the same set.
+    Entries that do not fit in a slot are not cached.
+    """
+
+    MAGIC = b'WRBLSHM1'
+    HEADER = struct.Struct('<8sIII')
+    # key hash, expires at, last access, key length, value length
+    SLOT = struct.Struct('<QddHI')
+
+    def __init__(self, path, size=64 * 1024 * 1024, slot_size=4096, ways=8,
+                 default_ttl=None):
+        super().__init__(default_ttl)
+        self.path = path
+        self.slot_size = slot_size
+        self.ways = ways
+        self.sets = max(1, (size - mmap.PAGESIZE) // (slot_size * ways))
+        self._local_lock = threading.Lock()
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, mmap.PAGESIZE, 0)
+        try:
+            header = os.pread(self._fd, self.HEADER.size, 0)
+            existing = (len(header) == self.HEADER.size and
+                        self.HEADER.unpack(header)[0] == self.MAGIC)
+            if existing:
+                # reuse an existing table's geometry, whatever `size` says
+                _, self.sets, self.ways, self.slot_size = self.HEADER.unpack(header)
+
+            length = mmap.PAGESIZE + self.sets * self.ways * self.slot_size
+            if os.fstat(self._fd).st_size < length:
+                os.ftruncate(self._fd, length)
+            self._map = mmap.mmap(self._fd, length)
+
+            if not existing:
+                self.HEADER.pack_into(self._map, 0, self.MAGIC, self.sets,
+                                      self.ways, self.slot_size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, mmap.PAGESIZE, 0)
+
+    def _locate(self, key):
+        raw = key.encode()
+        digest = hashlib.blake2b(raw, digest_size=8).digest()
+        key_hash = int.from_bytes(digest, 'little') or 1
+        set_index = key_hash % self.sets
+        return raw, key_hash, mmap.PAGESIZE + set_index * self.ways * self.slot_size
+
+    def _lock_set(self, offset, op):
+        fcntl.lockf(self._fd, op, self.ways * self.slot_size, offset)
+
+    def _find(self, raw, key_hash, offset, now):
+        """Return (slot offset, header) for `raw` in a set, plus a victim."""
+
+        victim, victim_rank = None, None
+        for way in range(self.ways):
+            slot = offset + way * self.slot_size
+            header = self.SLOT.unpack_from(self._map, slot)
+            slot_hash, expires_at, accessed, key_len, value_len = header
+
+            if key_len == 0 or (expires_at and expires_at < now):
+                rank = -1
+            else:
+                if slot_hash == key_hash:
+                    start = slot + self.SLOT.size
+                    if self._map[start:start + key_len] == raw:
+                        return slot, header, None
+                rank = accessed
+
+            if victim is None or rank < victim_rank:
+                victim, victim_rank = slot, rank
+
+        return None, None, (victim, victim_rank)
+
+    def _read(self, slot, header):
+        key_len, value_len = header[3], header[4]
+        start = slot + self.SLOT.size + key_len
+        return self._map[start:start + value_len]
+
+    def _write(self, slot, raw, key_hash, blob, expires_at, now):
+        self.SLOT.pack_into(self._map, slot, key_hash, expires_at, now,
+                            len(raw), len(blob))
+        start = slot + self.SLOT.size
+        self._map[start:start + len(raw)] = raw
+        self._map[start + len(raw):start + len(raw) + len(blob)] = blob
+
+    def _fits(self, raw, blob):
+        return self.SLOT.size + len(raw) + len(blob) <= self.slot_size
+
+    def _locked(self, key, fn):
+        raw, key_hash, offset = self._locate(key)
+        with self._local_lock:
+            self._lock_set(offset, fcntl.LOCK_EX)
+            try:
+                return fn(raw, key_hash, offset, time.time())
+            finally:
+                self._lock_set(offset, fcntl.LOCK_UN)
+
+    def _get(self, key):
+        def op(raw, key_hash, offset, now):
+            slot, header, _ = self._find(raw, key_hash, offset, now)
+            if slot is None:
+                return None
+            # touch for LRU
+            struct.pack_into('<d', self._map, slot + 16, now)
+            return self._read(slot, header)
+
+        blob = self._locked(key, op)
+        return _MISSING if blob is None else loads(blob)
+
+    def _put(self, key, blob, ttl, only_if_absent=False):
+        def op(raw, key_hash, offset, now):
+            slot, header, victim = self._find(raw, key_hash, offset, now)
+            if slot is not None and only_if_absent:
+                return False
+            if not self._fits(raw, blob):
+                # too big to keep; the value it replaces must not be served
+                if slot is not None:
+                    self.SLOT.pack_into(self._map, slot, 0, 0, 0, 0, 0)
+                return False
+            if slot is None:
+                slot, rank = victim
+                if rank >= 0:
+                    self.stats['evictions'] += 1
+
+            self._write(slot, raw, key_hash, blob,
+                        now + ttl if ttl else 0, now)
+            return True
+
+        return self._locked(key, op)
+
+    def _set(self, key, value, ttl):
+        self._put(key, dumps(value), ttl)
+
+    def _add(self, key, value, ttl):
+        return self._put(key, dumps(value), ttl, only_if_absent=True)
+
+    def _delete_many(self, keys):
+        def op(raw, key_hash, offset, now):
+            slot, header, _ = self._find(raw, key_hash, offset, now)
+            if slot is not None:
+                self.SLOT.pack_into(self._map, slot, 0, 0, 0, 0, 0)
+
+        for key in keys:
+            self._locked(key, op)
+
+    def _incr(self, key, delta):
+        def op(raw, key_hash, offset, now):
+            slot, header, victim = self._find(raw, key_hash, offset, now)
+            if slot is None:
+                value, expires_at = delta, 0
+                slot, rank = victim
+                if rank >= 0:
+                    self.stats['evictions'] += 1
+            else:
+                value = loads(self._read(slot, header)) + delta
+                expires_at = header[1]
+
+            self._write(slot, raw, key_hash, dumps(value), expires_at, now)
+            return value
+
+        return self._locked(key, op)
+
+    def clear(self):
+        with self._local_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                self._map[mmap.PAGESIZE:] = bytes(len(self._map) - mmap.PAGESIZE)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+
+##############################################################################
+# Redis protocol
+
+
+# safe to send again when their reply was lost (SET only without NX)
+IDEMPOTENT_COMMANDS = {'GET', 'MGET', 'SET', 'DEL', 'SELECT', 'FLUSHDB'}
+
+
+class RedisCache(BaseCache):
+    """Minimal RESP client, one connection per thread.
+
+    Speaks only the handful of commands the cache needs, so it works with a
+    real Redis or with the stand-in server in resp_standin.py.
+    """
+
+    def __init__(self, host='localhost', port=6379, db=0, timeout=1.0,
+                 default_ttl=None):
+        super().__init__(default_ttl)
+        self.host, self.port, self.db, self.timeout = host, port, db, timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port),
+                                            self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = self._local.conn = (sock, sock.makefile('rb'))
+            if self.db:
+                self._send(conn, 'SELECT', self.db)
+        return conn
+
+    def _write(self, conn, *args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        conn[0].sendall(b''.join(parts))
+
+    def _send(self, conn, *args):
+        self._write(conn, *args)
+        return self._read_reply(conn[1])
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line:
+            raise ConnectionError("connection closed by cache server")
+
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode()
+        if kind == b'-':
+            raise RuntimeError(rest.decode())
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            return data[:-2]
+        if kind == b'*':
+            return [self._read_reply(reader) for _ in range(int(rest))]
+        raise RuntimeError(f"bad reply from cache server: {line!r}")
+
+    def command(self, *args):
+        """Run one command, reconnecting once if the connection dropped.
+
+        A command is sent again only if sending it failed, or if running
+        it twice is harmless: a reply lost after the server ran INCRBY or
+        SET NX is an error, not a second increment.
+        """
+
+        try:
+            conn = self._connection()
+            self._write(conn, *args)
+        except OSError:
+            self._local.conn = None
+            return self._send(self._connection(), *args)
+
+        try:
+            return self._read_reply(conn[1])
+        except OSError:
+            self._local.conn = None
+            if args[0] not in IDEMPOTENT_COMMANDS or 'NX' in args:
+                raise
+            return self._send(self._connection(), *args)
+
+    def _get(self, key):
+        blob = self.command('GET', key)
+        return _MISSING if blob is None else loads(blob)
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+
+        found = {}
+        for key, blob in zip(keys, self.command('MGET', *keys)):
+            if blob is None:
+                self.stats['misses'] += 1
+            else:
+                self.stats['hits'] += 1
+                found[key] = loads(blob)
+        return found
+
+    def _set(self, key, value, ttl):
+        if ttl:
+            self.command('SET', key, dumps(value), 'PX', int(ttl * 1000))
+        else:
+            self.command('SET', key, dumps(value))
+
+    def _add(self, key, value, ttl):
+        args = ['SET', key, dumps(value), 'NX']
+        if ttl:
+            args += ['PX', int(ttl * 1000)]
+        return self.command(*args) is not None
+
+    def _delete_many(self, keys):
+        if keys:
+            self.command('DEL', *keys)
+
+    def _incr(self, key, delta):
+        return self.command('INCRBY', key, delta)
+
+    def clear(self):
+        self.command('FLUSHDB')
+
+
+##############################################################################
+# Configuration
+
+
+def cache_from_url(url):
+    """Build a backend from a CACHE_URL."""
+
+    parsed = urlparse(url)
+    options = {name: values[-1] for name, values in parse_qs(parsed.query).items()}
+    default_ttl = float(options['ttl']) if 'ttl' in options else None
+
+    if parsed.scheme == 'lru':
+        return LRUCache(max_bytes=int(options.get('max_bytes', 64 * 1024 * 1024)),
+                        default_ttl=default_ttl)
+
+    if parsed.scheme == 'shm':
+        return SharedMemoryCache(parsed.path or '/tmp/warbler-cache',
+                                 size=int(options.get('size', 64 * 1024 * 1024)),
+                                 slot_size=int(options.get('slot_size', 4096)),
+                                 default_ttl=default_ttl)
+
+    if parsed.scheme == 'redis':
+        return RedisCache(host=parsed.hostname or 'localhost',
+                          port=parsed.port or 6379,
+                          db=int(parsed.path.strip('/') or 0),
+                          default_ttl=default_ttl)
+
+    raise ValueError(f"unknown cache backend in CACHE_URL: {url}")
+
+
+class Cache:
+    """The app-wide cache; forwards everything to the configured backend."""
+
+    def __init__(self):
+        self.backend = LRUCache()
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+cache = Cache()
+
+
+def connect_cache(app):
+    """Point `cache` at the backend named by the app's CACHE_URL."""
+
+    cache.backend = cache_from_url(app.config.get('CACHE_URL', 'lru://'))
@@ -0,0 +1,220 @@
+"""Deleting accounts in the background.
+
+`delete_user` only sets `users.deleted_at` and logs the user out; from
+then on the account can't log in and its pages 404. A background job then
+removes the account's rows in batches of PURGE_BATCH_ROWS, each batch in
+its own short transaction:
+
+1. the user's messages, together with every like of them (on any shard)
+   and their hashtags and mentions; the messages they replied to get
+   their reply counts lowered
+2. the user's own likes
+3. follows in both directions, mentions of the user and their notifications
+4. the user row, then the caches that still mention it
+
+After each batch the worker sleeps long enough that purging takes at most
+PURGE_DUTY_CYCLE of the wall clock, so it never monopolizes the database.
+Progress is kept in the cache under `purge:<user_id>`. Purges run as the
+`purge-deleted-users` job; marked users are found again on every run, so
+a purge cut short is simply resumed.
+"""
+
+import time
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import select
+
+from cache import cache
+from follow_graph import follow_graph
+from fragments import new_version
+from models import db, User, Message, Likes, Follows, Mention, Notification, ShardDirectory
+from sharding import shards, shard_messages, shard_likes
+from tags import unindex_messages
+
+PURGE_BATCH_ROWS = 500
+PURGE_DUTY_CYCLE = 0.2
+PURGE_MIN_PAUSE = 0.01
+PURGE_POLL_SECONDS = 30
+PURGE_PROGRESS_TTL = 24 * 60 * 60
+
+
+class Throttle:
+    """Sleeps after each batch so the work uses at most `duty` of the time."""
+
+    def __init__(self, duty=PURGE_DUTY_CYCLE, min_pause=PURGE_MIN_PAUSE):
+        self.duty = duty
+        self.min_pause = min_pause
+
+    def __call__(self, batch_seconds):
+        time.sleep(max(self.min_pause,
+                       batch_seconds * (1 - self.duty) / self.duty))
+
+
+def progress_key(user_id):
+    return f"purge:{user_id}"
+
+
+def purge_progress(user_id):
+    """{'step', 'deleted': {step: rows}, 'done'} for a purge, or None."""
+
+    return cache.get(progress_key(user_id))
+
+
+def _sources(user_id):
+    """(engine, messages table, likes table) holding `user_id`'s rows, and
+    every likes table."""
+
+    if shards.enabled:
+        engine = shards.engines[shards.shard_for(user_id)]
+        return (engine, shard_messages, shard_likes,
+                [(engine, shard_likes) for engine in shards.engines])
+
+    likes = Likes.__table__
+    return db.engine, Message.__table__, likes, [(db.engine, likes)]
+
+
+def _batches(engine, select_ids, delete, batch_size, throttle):
+    """Repeatedly delete a batch of ids until there are none; returns rows."""
+
+    deleted = 0
+    while True:
+        start = time.perf_counter()
+        with engine.begin() as conn:
+            ids = [row[0] for row in conn.execute(select_ids.limit(batch_size))]
+            if not ids:
+                return deleted
+            delete(conn, ids)
+        deleted += len(ids)
+        throttle(time.perf_counter() - start)
+
+
+def purge_user(user_id, batch_size=PURGE_BATCH_ROWS, throttle=None,
+               on_progress=None):
+    """Delete a marked user and everything that belongs to them."""
+
+    throttle = throttle or Throttle()
+    progress = {'step': None, 'deleted': {}, 'done': False,
+                'started_at': datetime.utcnow().isoformat()}
+
+    def report(step, rows):
+        progress['step'] = step
+        progress['deleted'][step] = progress['deleted'].get(step, 0) + rows
+        cache.set(progress_key(user_id), progress, ttl=PURGE_PROGRESS_TTL)
+        if on_progress:
+            on_progress(progress)
+
+    engine, messages, likes, all_likes = _sources(user_id)
+
+    def delete_messages(conn, ids):
+        for likes_engine, likes_table in all_likes:
+            if likes_engine is engine:
+                conn.execute(likes_table.delete()
+                             .where(likes_table.c.message_id.in_(ids)))
+            else:
+                with likes_engine.begin() as other:
+                    other.execute(likes_table.delete()
+                                  .where(likes_table.c.message_id.in_(ids)))
+        if engine is db.engine:
+            unindex_messages(conn, ids)
+        else:
+            with db.engine.begin() as primary:
+                unindex_messages(primary, ids)
+        parents = Counter(row.parent_id for row in conn.execute(
+            select([messages.c.parent_id])
+            .where(messages.c.id.in_(ids))
+            .where(messages.c.parent_id.isnot(None))))
+        shards.count_replies({parent_id: -count for parent_id, count in parents.items()},
+                             conn)
+        conn.execute(messages.delete().where(messages.c.id.in_(ids)))
+        report('messages', len(ids))
+
+    _batches(engine,
+             select([messages.c.id]).where(messages.c.user_id == user_id),
+             delete_messages, batch_size, throttle)
+
+    def delete_likes(conn, ids):
+        conn.execute(likes.delete().where(likes.c.id.in_(ids)))
+        report('likes', len(ids))
+
+    _batches(engine, select([likes.c.id]).where(likes.c.user_id == user_id),
+             delete_likes, batch_size, throttle)
+
+    follows, users = Follows.__table__, User.__table__
+    for mine, other, count in ((follows.c.user_following_id, follows.c.user_being_followed_id,
+                                users.c.followers_count),
+                               (follows.c.user_being_followed_id, follows.c.user_following_id,
+                                users.c.following_count)):
+        def delete_follows(conn, ids, mine=mine, other=other, count=count):
+            conn.execute(follows.delete()
+                         .where(mine == user_id).where(other.in_(ids)))
+            conn.execute(users.update().where(users.c.id.in_(ids))
+                         .values({count: count - 1}))
+            report('follows', len(ids))
+
+        _batches(db.engine, select([other]).where(mine == user_id),
+                 delete_follows, batch_size, throttle)
+
+    mentions = Mention.__table__
+
+    def delete_mentions(conn, ids):
+        conn.execute(mentions.delete()
+                     .where(mentions.c.user_id == user_id)
+                     .where(mentions.c.message_id.in_(ids)))
+        report('mentions', len(ids))
+
+    _batches(db.engine, select([mentions.c.message_id]).where(mentions.c.user_id == user_id),
+             delete_mentions, batch_size, throttle)
+
+    notifications = Notification.__table__
+
+    def delete_notifications(conn, ids):
+        conn.execute(notifications.delete().where(notifications.c.id.in_(ids)))
+        report('notifications', len(ids))
+
+    _batches(db.engine,
+             select([notifications.c.id]).where(notifications.c.recipient_id == user_id),
+             delete_notifications, batch_size, throttle)
+
+    with db.engine.begin() as conn:
+        conn.execute(ShardDirectory.__table__.delete()
+                     .where(ShardDirectory.user_id == user_id))
+        conn.execute(User.__table__.delete().where(User.id == user_id))
+    report('user', 1)
+
+    forget_user(user_id)
+
+    progress['done'] = True
+    report('caches', 0)
+    return progress
+
+
+def forget_user(user_id):
+    """Drop cache entries and derived data that still mention the user."""
+
+    # bulk counters invalidate every per-user query cache entry of a table
+    for key in ('qversion:users', f"qversion:users:{user_id}",
+                'qversion:messages', 'qversion:messages:bulk',
+                'qversion:likes', 'qversion:likes:bulk',
+                'qversion:follows', 'qversion:follows:bulk'):
+        new_version(key)
+    new_version(f"version:users:{user_id}")
+
+    cache.delete_many([f"recs:{user_id}", f"shard:user:{user_id}"])
+    follow_graph.remove_user(user_id)
+
+
+def pending_user_ids():
+    return [user_id for (user_id,) in
+            db.session.query(User.id).filter(User.deleted_at.isnot(None))
+            .order_by(User.deleted_at)]
+
+
+def purge_pending(**kwargs):
+    """Purge every user marked deleted; returns how many."""
+
+    user_ids = pending_user_ids()
+    db.session.remove()
+    for user_id in user_ids:
+        purge_user(user_id, **kwargs)
+    return len(user_ids)
@@ -0,0 +1,140 @@
+"""Export of messages, likes and follows into memory-mappable column files.
+
+`flask export-analytics` streams each table out in chunks of
+EXPORT_CHUNK_ROWS into one .npy file per column, so analytics (see
+analytics.py) can map them read-only instead of running aggregate queries
+against the live tables:
+
+    ANALYTICS_DIR/manifest.json         export time and row counts
+    ANALYTICS_DIR/messages/id.npy       int64
+    ANALYTICS_DIR/messages/user_id.npy  int32
+    ...
+
+Messages and likes are read from every shard when sharding is on; archived
+message partitions are not included. A new export is written next to the
+old one and swapped in by renaming, so readers never see a partial export.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+from contextlib import ExitStack
+from datetime import datetime
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from sqlalchemy import select, func
+
+from models import db
+from sharding import shards, shard_metadata
+
+EXPORT_CHUNK_ROWS = 100000
+
+COLUMNS = {
+    'messages': [
+        ('id', np.int64),
+        ('user_id', np.int32),
+        ('timestamp', 'datetime64[us]'),
+    ],
+    'likes': [
+        ('id', np.int64),
+        ('user_id', np.int32),
+        ('message_id', np.int64),
+    ],
+    'follows': [
+        ('user_following_id', np.int32),
+        ('user_being_followed_id', np.int32),
+        ('timestamp', 'datetime64[us]'),
+    ],
+}
+
+
+def sources(name):
+    """[(engine, table)] holding the rows of table `name`."""
+
+    if shards.enabled and name in shard_metadata.tables:
+        return [(engine, shard_metadata.tables[name]) for engine in shards.engines]
+
+    return [(db.engine, db.Model.metadata.tables[name])]
+
+
+def export_table(name, out_dir, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Write table `name` as column files under `out_dir`/`name`.
+
+    Returns the number of rows written.
+    """
+
+    columns = COLUMNS[name]
+    table_dir = os.path.join(out_dir, name)
+    os.makedirs(table_dir)
+
+    with ExitStack() as stack:
+        # count and copy inside one transaction per source, so the files
+        # are sized for exactly the rows we stream
+        conns = []
+        for engine, table in sources(name):
+            conn = stack.enter_context(engine.connect())
+            if conn.dialect.name == 'postgresql':
+                conn = conn.execution_options(isolation_level='REPEATABLE READ')
+            stack.enter_context(conn.begin())
+            conns.append((conn, table))
+
+        total = sum(conn.execute(select([func.count()]).select_from(table)).scalar()
+                    for conn, table in conns)
+
+        arrays = [open_memmap(os.path.join(table_dir, f"{column}.npy"),
+                              mode='w+', dtype=dtype, shape=(total,))
+                  for column, dtype in columns]
+
+        written = 0
+        for conn, table in conns:
+            rows = conn.execution_options(stream_results=True).execute(
+                select([table.c[column] for column, dtype in columns]))
+
+            while written < total:
+                chunk = rows.fetchmany(chunk_rows)[:total - written]
+                if not chunk:
+                    break
+
+                end = written + len(chunk)
+                for i, (array, (column, dtype)) in enumerate(zip(arrays, columns)):
+                    array[written:end] = np.array([row[i] for row in chunk],
+                                                  dtype=dtype)
+                written = end
+
+            rows.close()
+
+        for array in arrays:
+            array.flush()
+
+    return written
+
+
+def export_all(export_dir, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Export every table in COLUMNS to `export_dir`, replacing any old export.
+
+    Returns {table: rows}.
+    """
+
+    parent = os.path.dirname(os.path.abspath(export_dir))
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix='.export-', dir=parent)
+
+    try:
+        rows = {name: export_table(name, tmp, chunk_rows) for name in COLUMNS}
+        with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+            json.dump({'exported_at': datetime.utcnow().isoformat(),
+                       'rows': rows}, f)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    # readers that already mapped the old files keep them until they close
+    old = f"{export_dir}.old"
+    if os.path.exists(export_dir):
+        os.rename(export_dir, old)
+    os.rename(tmp, export_dir)
+    shutil.rmtree(old, ignore_errors=True)
+
+    return rows
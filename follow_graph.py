@@ -0,0 +1,457 @@
+"""In-memory follow graph in compressed sparse row (CSR) form.
+
+For each direction ("following" and "followers") the graph keeps two
+arrays: `indptr`, where user u's neighbours are `indices[indptr[u]:indptr[u+1]]`,
+and `indices`, every user's neighbours sorted by id. Membership is a binary
+search in one row, degree is a subtraction, and intersections work on
+sorted rows, so none of them touch the database.
+
+`flask build-follow-graph` streams `follows` into a snapshot directory of
+.npy files under FOLLOW_GRAPH_DIR; workers memory-map it, so the arrays are
+shared through the page cache. Follow changes made after the snapshot are
+appended to that snapshot's journal (12 bytes each) by `add_follow` /
+`stop_following`, and every worker replays the journal tail into a small
+in-memory overlay before answering. Rebuild the snapshot now and then to
+fold the journal in: each snapshot starts a fresh journal, and the old one
+goes with the old snapshot.
+
+Requests never build a snapshot. Until the first one exists (serve.py
+builds it in the master before forking, the hourly job otherwise), queries
+are answered from the follows table instead.
+"""
+
+import fcntl
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import select, func
+
+from models import db, Follows, User
+
+GRAPH_CHUNK_ROWS = 500000
+
+# journal records: (op, follower, followed)
+JOURNAL_RECORD = struct.Struct('<iii')
+UNFOLLOW, FOLLOW, REMOVE_USER = 0, 1, 2
+
+EMPTY = np.zeros(0, dtype=np.int32)
+
+
+def csr(rows, cols, num_nodes):
+    """(indptr, indices) of the edges rows[i] -> cols[i], rows sorted."""
+
+    order = np.argsort(rows.astype(np.int64) * num_nodes + cols)
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_nodes), out=indptr[1:])
+    return indptr, cols[order].astype(np.int32)
+
+
+class FollowGraph:
+    """Follow edges as CSR arrays, plus an overlay of changes since."""
+
+    def __init__(self, out_indptr, out_indices, in_indptr, in_indices):
+        self.out_indptr, self.out_indices = out_indptr, out_indices
+        self.in_indptr, self.in_indices = in_indptr, in_indices
+        self.num_nodes = len(out_indptr) - 1
+
+        # {user: {other: True (added) / False (removed)}} per direction
+        self._out_changes = {}
+        self._in_changes = {}
+
+    @classmethod
+    def from_edges(cls, followers, followed, num_nodes=None):
+        """Graph of the edges followers[i] follows followed[i]."""
+
+        followers = np.asarray(followers, dtype=np.int32)
+        followed = np.asarray(followed, dtype=np.int32)
+        if num_nodes is None:
+            num_nodes = 1 + int(max(followers.max(initial=-1),
+                                    followed.max(initial=-1)))
+
+        return cls(*csr(followers, followed, num_nodes),
+                   *csr(followed, followers, num_nodes))
+
+    ##########################################################################
+    # Changes
+
+    def apply(self, follower, followed, following):
+        """Record that `follower` now does / doesn't follow `followed`."""
+
+        self._out_changes.setdefault(follower, {})[followed] = following
+        self._in_changes.setdefault(followed, {})[follower] = following
+
+    def remove_user(self, user_id):
+        """Drop every edge to and from `user_id`."""
+
+        for followed in self.following(user_id):
+            self.apply(user_id, int(followed), False)
+        for follower in self.followers(user_id):
+            self.apply(int(follower), user_id, False)
+
+    @property
+    def pending_changes(self):
+        return sum(len(changes) for changes in self._out_changes.values())
+
+    ##########################################################################
+    # Queries
+
+    def _base_row(self, indptr, indices, user_id):
+        if not 0 <= user_id < self.num_nodes:
+            return EMPTY
+        return indices[indptr[user_id]:indptr[user_id + 1]]
+
+    def _row(self, indptr, indices, changes, user_id):
+        row = self._base_row(indptr, indices, user_id)
+        changed = changes.get(user_id)
+        if not changed:
+            return row
+
+        added = [other for other, present in changed.items() if present]
+        removed = [other for other, present in changed.items() if not present]
+        row = np.setdiff1d(row, np.array(removed, dtype=np.int32),
+                           assume_unique=True)
+        return np.union1d(row, np.array(added, dtype=np.int32))
+
+    def following(self, user_id):
+        """Sorted ids of the users `user_id` follows."""
+
+        return self._row(self.out_indptr, self.out_indices,
+                         self._out_changes, user_id)
+
+    def followers(self, user_id):
+        """Sorted ids of the users following `user_id`."""
+
+        return self._row(self.in_indptr, self.in_indices,
+                         self._in_changes, user_id)
+
+    def is_following(self, follower, followed):
+        changed = self._out_changes.get(follower)
+        if changed and followed in changed:
+            return changed[followed]
+
+        row = self._base_row(self.out_indptr, self.out_indices, follower)
+        at = np.searchsorted(row, followed)
+        return bool(at < len(row) and row[at] == followed)
+
+    def following_count(self, user_id):
+        if user_id in self._out_changes:
+            return len(self.following(user_id))
+        return len(self._base_row(self.out_indptr, self.out_indices, user_id))
+
+    def follower_count(self, user_id):
+        if user_id in self._in_changes:
+            return len(self.followers(user_id))
+        return len(self._base_row(self.in_indptr, self.in_indices, user_id))
+
+    def mutuals(self, user_id):
+        """Users who follow `user_id` and are followed back."""
+
+        return np.intersect1d(self.following(user_id), self.followers(user_id),
+                              assume_unique=True)
+
+    def common_following(self, a, b):
+        """Users both `a` and `b` follow."""
+
+        return np.intersect1d(self.following(a), self.following(b),
+                              assume_unique=True)
+
+    def followers_of_followers(self, user_id):
+        """Users following `user_id`'s followers, excluding `user_id` and
+        its direct followers."""
+
+        followers = self.followers(user_id)
+        if not len(followers):
+            return EMPTY
+
+        second = np.unique(np.concatenate(
+            [self.followers(int(follower)) for follower in followers]))
+        return np.setdiff1d(second, np.append(followers, user_id),
+                            assume_unique=True)
+
+    ##########################################################################
+    # Snapshots
+
+    def save(self, path, meta):
+        """Write the base arrays (not the overlay) to directory `path`."""
+
+        os.makedirs(path)
+        for name in ('out_indptr', 'out_indices', 'in_indptr', 'in_indices'):
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map a snapshot; returns (graph, meta)."""
+
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        # plain ndarray views of the maps: slicing a np.memmap is much slower
+        arrays = [np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r')
+                  .view(np.ndarray)
+                  for name in ('out_indptr', 'out_indices', 'in_indptr', 'in_indices')]
+        return cls(*arrays), meta
+
+
+def stream_edges(conn, chunk_rows=GRAPH_CHUNK_ROWS):
+    """(followers, followed) arrays of every row of `follows`."""
+
+    table = Follows.__table__
+    total = conn.execute(select([func.count()]).select_from(table)).scalar()
+    followers = np.zeros(total, dtype=np.int32)
+    followed = np.zeros(total, dtype=np.int32)
+
+    rows = conn.execution_options(stream_results=True).execute(
+        select([table.c.user_following_id, table.c.user_being_followed_id]))
+
+    filled = 0
+    while filled < total:
+        chunk = rows.fetchmany(chunk_rows)[:total - filled]
+        if not chunk:
+            break
+        edges = np.array(chunk, dtype=np.int32)
+        followers[filled:filled + len(edges)] = edges[:, 0]
+        followed[filled:filled + len(edges)] = edges[:, 1]
+        filled += len(edges)
+    rows.close()
+
+    return followers[:filled], followed[:filled]
+
+
+class DatabaseFollowGraph(FollowGraph):
+    """FollowGraph queries answered from the follows table, for when there
+    is no snapshot yet."""
+
+    def __init__(self):
+        self._out_changes = {}
+        self._in_changes = {}
+
+    @property
+    def num_nodes(self):
+        return 1 + (db.session.query(func.max(User.id)).scalar() or 0)
+
+    def _ids(self, column, where):
+        rows = db.session.execute(select([column]).where(where).order_by(column))
+        return np.array([id for (id,) in rows], dtype=np.int32)
+
+    def following(self, user_id):
+        table = Follows.__table__
+        return self._ids(table.c.user_being_followed_id,
+                         table.c.user_following_id == user_id)
+
+    def followers(self, user_id):
+        table = Follows.__table__
+        return self._ids(table.c.user_following_id,
+                         table.c.user_being_followed_id == user_id)
+
+    def is_following(self, follower, followed):
+        return db.session.query(Follows.query.filter_by(
+            user_following_id=follower,
+            user_being_followed_id=followed).exists()).scalar()
+
+    def following_count(self, user_id):
+        return len(self.following(user_id))
+
+    def follower_count(self, user_id):
+        return len(self.followers(user_id))
+
+
+class SharedFollowGraph:
+    """The snapshot in a directory plus its journal, kept current per worker."""
+
+    def __init__(self):
+        self.path = None
+        self._graph = None
+        self._snapshot = None
+        self._offset = 0
+        self._lock = threading.RLock()
+
+    def configure(self, path):
+        with self._lock:
+            self.path = path
+            self._graph = self._snapshot = None
+
+    @property
+    def _current(self):
+        return os.path.join(self.path, 'current')
+
+    def _journal(self, snapshot):
+        """Changes since `snapshot` was built (since none was, for None)."""
+
+        if snapshot is None:
+            return os.path.join(self.path, 'journal')
+        return os.path.join(self.path, snapshot, 'journal')
+
+    def _current_snapshot(self):
+        try:
+            with open(self._current) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _lock_journal(self, operation):
+        """The journal lock file, flock()ed: shared while appending to the
+        current journal, exclusive while switching to a new one. Closing
+        it unlocks."""
+
+        lock = open(os.path.join(self.path, '.journal.lock'), 'a')
+        fcntl.flock(lock, operation)
+        return lock
+
+    def build(self, chunk_rows=GRAPH_CHUNK_ROWS, missing_only=False):
+        """Stream `follows` into a new snapshot and make it current.
+
+        Changes journalled before the build are in the database by then;
+        those journalled while it streams are copied into the new
+        snapshot's journal (replaying an already-applied change is
+        harmless). With `missing_only`, does nothing if a snapshot exists.
+        Returns the number of edges, or None if nothing was built.
+        """
+
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, '.lock'), 'w') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+
+            old = self._current_snapshot()
+            if missing_only and old is not None:
+                return None
+            with self._lock_journal(fcntl.LOCK_EX):
+                try:
+                    start = os.path.getsize(self._journal(old))
+                except FileNotFoundError:
+                    start = 0
+
+            with db.engine.connect() as conn:
+                followers, followed = stream_edges(conn, chunk_rows)
+
+            num_nodes = 1 + int(max(followers.max(initial=0), followed.max(initial=0)))
+            graph = FollowGraph.from_edges(followers, followed, num_nodes)
+
+            name = f"snapshot-{datetime.utcnow():%Y%m%dT%H%M%S%f}"
+            tmp = tempfile.mkdtemp(prefix='.build-', dir=self.path)
+            graph.save(os.path.join(tmp, name), {
+                'edges': len(followers), 'num_nodes': num_nodes,
+                'built_at': datetime.utcnow().isoformat()})
+            os.rename(os.path.join(tmp, name), os.path.join(self.path, name))
+            shutil.rmtree(tmp)
+
+            # no change can be journalled between copying the tail and
+            # swapping the pointer; workers notice on their next query
+            with self._lock_journal(fcntl.LOCK_EX):
+                try:
+                    with open(self._journal(old), 'rb') as f:
+                        f.seek(start)
+                        tail = f.read()
+                except FileNotFoundError:
+                    tail = b''
+                with open(self._journal(name), 'wb') as f:
+                    f.write(tail)
+
+                with open(f"{self._current}.tmp", 'w') as f:
+                    f.write(name)
+                os.replace(f"{self._current}.tmp", self._current)
+
+                if old is None:
+                    try:
+                        os.remove(self._journal(None))
+                    except FileNotFoundError:
+                        pass
+
+        for stale in os.listdir(self.path):
+            if stale.startswith('snapshot-') and stale != name:
+                shutil.rmtree(os.path.join(self.path, stale), ignore_errors=True)
+
+        return len(followers)
+
+    def ensure_snapshot(self):
+        """Build a snapshot if there is none yet (in the serve.py master or
+        a job, not while answering a request)."""
+
+        self.build(missing_only=True)
+
+    def graph(self):
+        """The graph with every journalled change applied, or the follows
+        table behind the same interface while there is no snapshot."""
+
+        with self._lock:
+            snapshot = self._current_snapshot()
+            if snapshot is None:
+                return DatabaseFollowGraph()
+
+            if snapshot != self._snapshot:
+                self._graph, meta = FollowGraph.load(os.path.join(self.path, snapshot))
+                self._snapshot = snapshot
+                self._offset = 0
+
+            self._replay()
+            return self._graph
+
+    def _replay(self):
+        journal = self._journal(self._snapshot)
+        try:
+            if os.path.getsize(journal) == self._offset:
+                return
+            with open(journal, 'rb') as f:
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+
+        whole = len(data) - len(data) % JOURNAL_RECORD.size
+        for op, follower, followed in JOURNAL_RECORD.iter_unpack(data[:whole]):
+            if op == REMOVE_USER:
+                self._graph.remove_user(follower)
+            else:
+                self._graph.apply(follower, followed, op == FOLLOW)
+        self._offset += whole
+
+    def _record(self, *records):
+        """Append (op, follower, followed) changes to the journal, after
+        they are committed."""
+
+        if self.path is None or not records:
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock_journal(fcntl.LOCK_SH):
+            journal = self._journal(self._current_snapshot())
+            fd = os.open(journal, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, b''.join(JOURNAL_RECORD.pack(*record) for record in records))
+            finally:
+                os.close(fd)
+
+    def add_follow(self, follower, followed):
+        self._record((FOLLOW, follower, followed))
+
+    def stop_following(self, follower, followed):
+        self._record((UNFOLLOW, follower, followed))
+
+    def add_follows(self, follower, followed_ids):
+        self._record(*[(FOLLOW, follower, followed) for followed in followed_ids])
+
+    def remove_follows(self, follower, followed_ids):
+        self._record(*[(UNFOLLOW, follower, followed) for followed in followed_ids])
+
+    def remove_user(self, user_id):
+        self._record((REMOVE_USER, user_id, 0))
+
+    def __getattr__(self, name):
+        """Queries (is_following, followers, mutuals...) go to the graph."""
+
+        return getattr(self.graph(), name)
+
+
+follow_graph = SharedFollowGraph()
+
+
+def connect_follow_graph(app):
+    """Keep the follow graph snapshot and journal in FOLLOW_GRAPH_DIR."""
+
+    follow_graph.configure(app.config['FOLLOW_GRAPH_DIR'])
@@ -0,0 +1,323 @@
+"""Set-based follow and unfollow, follower counts and follow listings.
+
+Going through `user.following` loads the user's whole following
+collection to add or remove one row. On Postgres these helpers are single
+statements instead: an INSERT ... SELECT ... ON CONFLICT DO NOTHING and a
+DELETE ... IN, both RETURNING the rows they changed, so two requests
+racing on the same follow can't both count it. SQLite has no RETURNING
+(for SQLAlchemy 1.3), so there they write one row per statement (INSERT
+OR IGNORE) and go by each statement's rowcount. They run in the current
+db.session transaction; the caller commits, then tells the follow graph.
+`follow_users` also notifies the newly followed users.
+
+`users.followers_count` / `following_count` are adjusted in the same
+transaction, by these helpers and by listeners for Follows rows and the
+`following` / `followers` collections, so pages never count rows.
+`recount_follows` recomputes them after bulk loads.
+
+Follower and following listings page by follow time, newest first, with
+a cursor (the last row's follow time and user id) instead of an offset,
+so every page is an index range scan of FOLLOW_PAGE_SIZE rows of
+ix_follows_*_timestamp plus as many primary key lookups for the card
+columns, however many followers the account has.
+"""
+
+import base64
+from datetime import datetime
+
+from sqlalchemy import select, literal, and_, or_, func, event, inspect
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import load_only
+
+from models import db, User, Follows
+from query_cache import mark_stale, cached_all
+
+# most users one bulk request may follow or unfollow
+BULK_FOLLOW_LIMIT = 500
+
+FOLLOW_PAGE_SIZE = 30
+
+# the user directory (/users)
+USERS_PAGE_SIZE = 100
+MAX_USERS_PAGE_SIZE = 500
+USERS_CHUNK_SIZE = 50
+
+# what a user card shows
+CARD_COLUMNS = ('id', 'username', 'image_url', 'header_image_url', 'bio')
+
+
+def _already_following(follower_id, user_ids):
+    follows = Follows.__table__
+    return {user_id for (user_id,) in db.session.execute(
+        select([follows.c.user_being_followed_id])
+        .where(follows.c.user_following_id == follower_id)
+        .where(follows.c.user_being_followed_id.in_(user_ids)))}
+
+
+def _returning():
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def _insert_follows(follower_id, user_ids):
+    """Insert the follows of `user_ids` that aren't there yet; returns the
+    ids whose rows this inserted."""
+
+    table = Follows.__table__
+    now = datetime.utcnow()
+
+    if _returning():
+        insert = (postgresql.insert(table)
+                  .from_select(['user_following_id', 'user_being_followed_id', 'timestamp'],
+                               select([literal(follower_id), User.id, literal(now)])
+                               .where(User.id.in_(user_ids)))
+                  .on_conflict_do_nothing()
+                  .returning(table.c.user_being_followed_id))
+        return {user_id for (user_id,) in db.session.execute(insert)}
+
+    insert = table.insert().prefix_with('OR IGNORE')
+    return {user_id for user_id in user_ids
+            if db.session.execute(insert.values(
+                user_following_id=follower_id, user_being_followed_id=user_id,
+                timestamp=now)).rowcount}
+
+
+def _delete_follows(follower_id, user_ids):
+    """Delete the follows of `user_ids`; returns the ids whose rows this
+    deleted."""
+
+    table = Follows.__table__
+    delete = table.delete().where(table.c.user_following_id == follower_id)
+
+    if _returning():
+        return {user_id for (user_id,) in db.session.execute(
+            delete.where(table.c.user_being_followed_id.in_(user_ids))
+            .returning(table.c.user_being_followed_id))}
+
+    return {user_id for user_id in user_ids
+            if db.session.execute(delete.where(
+                table.c.user_being_followed_id == user_id)).rowcount}
+
+
+def _adjust_counts(execute, follower_id, followed_ids, delta):
+    """Add `delta` per follow to the follower's and the followed counts."""
+
+    users = User.__table__
+    execute(users.update().where(users.c.id == follower_id)
+            .values(following_count=users.c.following_count + delta * len(followed_ids)))
+    execute(users.update().where(users.c.id.in_(followed_ids))
+            .values(followers_count=users.c.followers_count + delta))
+
+
+def follow_users(follower_id, user_ids):
+    """Make `follower_id` follow every active user in `user_ids` (already
+    followed ones are left alone). Returns the ids of those users."""
+
+    user_ids = {int(user_id) for user_id in user_ids} - {follower_id}
+    if not user_ids:
+        return []
+
+    active = and_(User.id.in_(user_ids), User.deleted_at.is_(None))
+    followed = [user_id for (user_id,) in
+                db.session.execute(select([User.id]).where(active))]
+
+    if not followed:
+        return followed
+
+    # only rows this inserted count; a request racing us counts its own
+    new = _insert_follows(follower_id, followed)
+    if not new:
+        return followed
+
+    _adjust_counts(db.session.execute, follower_id, new, 1)
+    mark_stale(db.session, 'follows', follower_id, *new)
+    mark_stale(db.session, 'users', follower_id, *new)
+
+    # notifications imports this module
+    from notifications import notify_follows
+    notify_follows(follower_id, sorted(new))
+
+    return followed
+
+
+def unfollow_users(follower_id, user_ids):
+    """Stop `follower_id` following `user_ids`; returns rows deleted."""
+
+    user_ids = {int(user_id) for user_id in user_ids}
+    if not user_ids:
+        return 0
+
+    followed = _delete_follows(follower_id, user_ids)
+    if not followed:
+        return 0
+
+    _adjust_counts(db.session.execute, follower_id, followed, -1)
+    mark_stale(db.session, 'follows', follower_id, *followed)
+    mark_stale(db.session, 'users', follower_id, *followed)
+
+    return len(followed)
+
+
+def recount_follows(user_ids=None):
+    """Recompute follower / following counts from the follows table, for
+    `user_ids` or everyone. Run in the caller's transaction."""
+
+    users, follows = User.__table__, Follows.__table__
+
+    def count(column):
+        return (select([func.count()]).where(column == users.c.id)
+                .as_scalar())
+
+    update = users.update().values(
+        followers_count=count(follows.c.user_being_followed_id),
+        following_count=count(follows.c.user_following_id))
+    if user_ids is not None:
+        update = update.where(users.c.id.in_(user_ids))
+
+    db.session.execute(update)
+    mark_stale(db.session, 'users', *(user_ids or [None]))
+
+
+##############################################################################
+# Keeping the counts for ORM writes
+
+
+@event.listens_for(Follows, 'after_insert')
+def count_follow(mapper, connection, follow):
+    _adjust_counts(connection.execute, follow.user_following_id,
+                   [follow.user_being_followed_id], 1)
+
+
+@event.listens_for(Follows, 'after_delete')
+def count_unfollow(mapper, connection, follow):
+    _adjust_counts(connection.execute, follow.user_following_id,
+                   [follow.user_being_followed_id], -1)
+
+
+def _bump(user, attr, delta):
+    """Count a collection change; applied as `col = col + n` at flush, so
+    concurrent increments aren't lost."""
+
+    state = inspect(user)
+    deltas = state.info.setdefault('follow_count_deltas', {})
+    deltas[attr] = deltas.get(attr, 0) + delta
+    if state.session is not None:
+        state.session.info.setdefault('follow_counted', set()).add(state)
+
+
+@event.listens_for(db.session, 'before_flush')
+def apply_count_deltas(session, flush_context, instances):
+    states = session.info.pop('follow_counted', set())
+    states.update(inspect(obj) for obj in session.new if isinstance(obj, User))
+    for state in states:
+        user = state.obj()
+        if user is None:
+            continue
+        for attr, delta in state.info.pop('follow_count_deltas', {}).items():
+            if state.pending:
+                setattr(user, attr, (getattr(user, attr) or 0) + delta)
+            else:
+                setattr(user, attr, getattr(User, attr) + delta)
+
+
+@event.listens_for(User.following, 'append')
+def count_appended_following(user, followed, initiator):
+    _bump(user, 'following_count', 1)
+    _bump(followed, 'followers_count', 1)
+
+
+@event.listens_for(User.following, 'remove')
+def count_removed_following(user, followed, initiator):
+    _bump(user, 'following_count', -1)
+    _bump(followed, 'followers_count', -1)
+
+
+@event.listens_for(User.followers, 'append')
+def count_appended_follower(user, follower, initiator):
+    _bump(user, 'followers_count', 1)
+    _bump(follower, 'following_count', 1)
+
+
+@event.listens_for(User.followers, 'remove')
+def count_removed_follower(user, follower, initiator):
+    _bump(user, 'followers_count', -1)
+    _bump(follower, 'following_count', -1)
+
+
+##############################################################################
+# Listings
+
+
+def encode_cursor(timestamp, user_id):
+    raw = f"{timestamp.isoformat()}|{user_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(follow time, user id) from a cursor; ValueError if it isn't one."""
+
+    # base64, utf-8 and number errors are all ValueErrors already
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+    timestamp, user_id = raw.split('|')
+    return datetime.fromisoformat(timestamp), int(user_id)
+
+
+def follow_page(user_id, direction, after=None, limit=FOLLOW_PAGE_SIZE):
+    """One page of `user_id`'s 'followers' or 'following', most recently
+    followed first: (users with only the card columns loaded, cursor for
+    the next page or None).
+    """
+
+    if direction == 'followers':
+        mine, theirs = Follows.user_being_followed_id, Follows.user_following_id
+    else:
+        mine, theirs = Follows.user_following_id, Follows.user_being_followed_id
+
+    query = (User.query
+             .options(load_only(*CARD_COLUMNS))
+             .join(Follows, theirs == User.id)
+             .add_columns(Follows.timestamp)
+             .filter(mine == user_id)
+             .order_by(Follows.timestamp.desc(), theirs.desc()))
+
+    if after:
+        timestamp, last_id = decode_cursor(after)
+        query = query.filter(or_(Follows.timestamp < timestamp,
+                                 and_(Follows.timestamp == timestamp,
+                                      theirs < last_id)))
+
+    rows = cached_all(query.limit(limit + 1), ('follows', user_id), 'users')
+
+    users = [user for user, followed_at in rows[:limit]]
+    if len(rows) <= limit:
+        return users, None
+
+    last, followed_at = rows[limit - 1]
+    return users, encode_cursor(followed_at, last.id)
+
+
+def followed_among(follower_id, user_ids):
+    """Which of `user_ids` `follower_id` follows (one indexed lookup)."""
+
+    if not user_ids:
+        return set()
+    return _already_following(follower_id, user_ids)
+
+
+def user_cards(query, viewer_id=None, chunk_size=USERS_CHUNK_SIZE):
+    """Yield (user, followed by the viewer) for a query of users, loading
+    only the card columns, USERS_CHUNK_SIZE rows at a time (a server-side
+    cursor on Postgres), so memory doesn't grow with the result."""
+
+    query = query.options(load_only(*CARD_COLUMNS)).yield_per(chunk_size)
+    chunk = []
+
+    def flush():
+        followed = followed_among(viewer_id, [user.id for user in chunk]) if viewer_id else ()
+        return [(user, user.id in followed) for user in chunk]
+
+    for user in query:
+        chunk.append(user)
+        if len(chunk) == chunk_size:
+            yield from flush()
+            chunk = []
+    yield from flush()
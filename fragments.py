@@ -0,0 +1,114 @@
+"""Rendered-fragment cache for message cards and user cards.
+
+Fragments are keyed by a version token per entity, replaced with a new
+random one whenever the entity changes. Tokens live in the same
+evictable cache as the fragments, so they never count up: a token that
+was evicted is replaced by a new one, which only misses, where a counter
+starting over could match a fragment rendered before an update.
+
+Tokens are replaced when the change commits, not when it is flushed:
+a render in between would still read the old row, and cache it under
+the new token.
+"""
+
+import uuid
+
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from cache import cache
+from models import User, Message
+
+# unused fragments age out instead of piling up in shared backends
+FRAGMENT_TTL = 24 * 60 * 60
+
+
+def version_key(entity):
+    return f"version:{entity.__tablename__}:{entity.id}"
+
+
+def new_version(key):
+    """Invalidate the fragments keyed by version `key`."""
+
+    cache.set(key, uuid.uuid4().hex)
+
+
+def bump_version(mapper, connection, target):
+    """Invalidate cached fragments of `target` once its change commits."""
+
+    session = object_session(target)
+    if session is None:
+        new_version(version_key(target))
+    else:
+        session.info.setdefault('fragments_stale', set()).add(version_key(target))
+
+
+def current_versions(keys):
+    """{key: token}, making a token for every key that has none."""
+
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            token = uuid.uuid4().hex
+            # another worker may have made one first
+            versions[key] = token if cache.add(key, token) else cache.get(key, token)
+    return versions
+
+
+for model in (User, Message):
+    event.listen(model, 'after_update', bump_version)
+    event.listen(model, 'after_delete', bump_version)
+
+
+# every session: shard sessions write messages too
+@event.listens_for(Session, 'after_commit')
+def bump_on_commit(session):
+    for key in session.info.pop('fragments_stale', ()):
+        new_version(key)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_on_rollback(session):
+    session.info.pop('fragments_stale', None)
+
+
+def cache_fragment(name, *entities, caller):
+    """Return the cached html of a `{% call %}` block, rendering on miss.
+
+    The key is the fragment name plus the id and version of every entity
+    the block depends on, so changing any of them re-renders the block:
+
+        {% call cache_fragment('message-card', msg, msg.user) %}
+          ...
+        {% endcall %}
+
+    Anything specific to the viewer (like star, follow button) must stay
+    outside the block.
+    """
+
+    keys = [version_key(entity) for entity in entities]
+    versions = current_versions(keys)
+    key = "fragment:" + name + ":" + ":".join(
+        f"{entity.__tablename__}.{entity.id}.{versions[k]}"
+        for entity, k in zip(entities, keys))
+
+    html = cache.get(key)
+
+    if html is None:
+        html = str(caller())
+        cache.set(key, html, ttl=FRAGMENT_TTL)
+
+    return Markup(html)
+
+
+def clear_fragment_cache():
+    """Drop every cached fragment (and everything else in the cache)."""
+
+    cache.clear()
+
+
+def connect_fragment_cache(app):
+    """Make `cache_fragment` available to the templates of `app`."""
+
+    app.jinja_env.globals['cache_fragment'] = cache_fragment
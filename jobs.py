@@ -0,0 +1,477 @@
+"""Background jobs: a durable queue in a local SQLite file, and workers.
+
+Register a job with `@queue.job('name')`, then `queue.enqueue('name', *args)`
+from anywhere. Jobs are rows in JOBS_DB_PATH (SQLite, WAL mode), so no
+broker is needed, enqueued jobs survive restarts, and several worker
+processes on the machine can share the queue.
+
+- Deduplication: a job enqueued with `dedupe_key` is skipped while another
+  job with the same key is still queued or running.
+- Retries: a job that raises is retried up to `max_attempts` times, after
+  RETRY_BASE_SECONDS * 2**(attempt - 1) (capped, with jitter).
+- Leases: a claimed job is leased for LEASE_SECONDS, and its worker renews
+  the lease while the job runs, for up to `timeout` seconds in all. If the
+  worker dies (or the job outruns its timeout) the lease runs out and the
+  job is claimed again.
+- Periodic jobs: `queue.periodic('*/15 * * * *', 'name')` enqueues `name` on
+  a cron schedule (minute hour day-of-month month day-of-week), once per
+  due time however many workers are running.
+- Metrics: `queue.stats()` gives per-job-type throughput and run/queue
+  latency over a recent window.
+
+`flask worker` runs the jobs (and the scheduler) with a pool of threads,
+optionally in several processes.
+"""
+
+import json
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+from models import db
+
+RETRY_BASE_SECONDS = 5
+RETRY_MAX_SECONDS = 60 * 60
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_TIMEOUT = 10 * 60
+LEASE_SECONDS = 60
+KEEP_FINISHED_SECONDS = 24 * 60 * 60
+STATS_WINDOW_SECONDS = 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    args TEXT NOT NULL,
+    dedupe_key TEXT,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    timeout REAL NOT NULL,
+    enqueued_at REAL NOT NULL,
+    run_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    locked_until REAL,
+    worker TEXT,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_ready ON jobs (state, run_at);
+CREATE INDEX IF NOT EXISTS ix_jobs_finished ON jobs (finished_at);
+CREATE UNIQUE INDEX IF NOT EXISTS ix_jobs_dedupe ON jobs (dedupe_key)
+    WHERE dedupe_key IS NOT NULL AND state IN ('queued', 'running');
+CREATE TABLE IF NOT EXISTS schedules (
+    name TEXT PRIMARY KEY,
+    last_run REAL NOT NULL
+);
+"""
+
+
+class UnknownJob(Exception):
+    """A job name with no registered function."""
+
+
+##############################################################################
+# Cron schedules
+
+
+def _cron_field(spec, low, high):
+    values = set()
+    for part in spec.split(','):
+        step = 1
+        if '/' in part:
+            part, step = part.split('/')
+            step = int(step)
+
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = (int(bound) for bound in part.split('-'))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+
+        if not low <= start <= end <= high:
+            raise ValueError(f"cron field {spec!r} out of range {low}-{high}")
+        values.update(range(start, end + 1, step))
+
+    return frozenset(values)
+
+
+class CronSchedule:
+    """minute hour day-of-month month day-of-week (0 = Sunday).
+
+    As in cron, when both day fields are restricted (neither starts with
+    `*`), a day matching either one matches.
+    """
+
+    def __init__(self, spec):
+        fields = spec.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron spec needs 5 fields: {spec!r}")
+
+        self.spec = spec
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            _cron_field(field, low, high) for field, (low, high) in
+            zip(fields, ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6)))]
+        self.either_day = not fields[2].startswith('*') and not fields[4].startswith('*')
+
+    def matches(self, when):
+        day = when.day in self.days
+        weekday = when.isoweekday() % 7 in self.weekdays
+        return (when.minute in self.minutes and when.hour in self.hours
+                and when.month in self.months
+                and (day or weekday if self.either_day else day and weekday))
+
+    def due(self, last, now):
+        """Did a scheduled minute pass in (last, now]? Looks back a day at most."""
+
+        minute = max(last, now - timedelta(days=1)).replace(second=0, microsecond=0)
+        while minute < now.replace(second=0, microsecond=0):
+            minute += timedelta(minutes=1)
+            if self.matches(minute):
+                return True
+        return False
+
+
+##############################################################################
+# Queue
+
+
+class Job:
+    """A claimed job row."""
+
+    def __init__(self, row):
+        (self.id, self.name, args, self.attempts, self.max_attempts,
+         self.timeout, self.run_at) = row
+        self.args, self.kwargs = json.loads(args)
+
+
+class JobQueue:
+    """Registered job types, periodic schedules and the queue file."""
+
+    def __init__(self):
+        self.path = None
+        self.registry = {}
+        self.schedules = []
+        self._local = threading.local()
+
+    def configure(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        """This thread's connection to the queue file."""
+
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _transaction(self, fn):
+        """Run fn(conn) inside BEGIN IMMEDIATE (one writer at a time)."""
+
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    ##########################################################################
+    # Registering
+
+    def job(self, name, max_attempts=DEFAULT_MAX_ATTEMPTS, timeout=DEFAULT_TIMEOUT):
+        """Decorator registering a function as job type `name`."""
+
+        def register(fn):
+            self.registry[name] = (fn, max_attempts, timeout)
+            return fn
+
+        return register
+
+    def periodic(self, spec, name, *args, **kwargs):
+        """Enqueue job `name` with these arguments on cron schedule `spec`."""
+
+        self.schedules.append((CronSchedule(spec), name, args, kwargs))
+
+    ##########################################################################
+    # Enqueueing and claiming
+
+    def enqueue(self, name, *args, dedupe_key=None, delay=0, **kwargs):
+        """Queue a job; returns its id, or None if a duplicate is pending."""
+
+        if name not in self.registry:
+            raise UnknownJob(name)
+
+        fn, max_attempts, timeout = self.registry[name]
+        now = time.time()
+        cursor = self._conn().execute(
+            "INSERT OR IGNORE INTO jobs (name, args, dedupe_key, max_attempts, "
+            "timeout, enqueued_at, run_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (name, json.dumps([args, kwargs]), dedupe_key, max_attempts,
+             timeout, now, now + delay))
+        return cursor.lastrowid if cursor.rowcount else None
+
+    def claim(self, worker):
+        """Lease the next due job to `worker`, or return None."""
+
+        def op(conn):
+            now = time.time()
+            # jobs whose worker died go back to the queue, unless that was
+            # their last attempt
+            conn.execute("UPDATE jobs SET state = 'failed', finished_at = ?, "
+                         "locked_until = NULL, last_error = 'lease expired' "
+                         "WHERE state = 'running' AND locked_until < ? "
+                         "AND attempts >= max_attempts", (now, now))
+            conn.execute("UPDATE jobs SET state = 'queued' "
+                         "WHERE state = 'running' AND locked_until < ?", (now,))
+
+            row = conn.execute(
+                "SELECT id, name, args, attempts, max_attempts, timeout, run_at "
+                "FROM jobs WHERE state = 'queued' AND run_at <= ? "
+                "ORDER BY run_at LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+
+            conn.execute("UPDATE jobs SET state = 'running', attempts = attempts + 1, "
+                         "started_at = ?, locked_until = ?, worker = ? WHERE id = ?",
+                         (now, now + min(LEASE_SECONDS, row[5]), worker, row[0]))
+            return Job(row[:3] + (row[3] + 1,) + row[4:])
+
+        return self._transaction(op)
+
+    def renew(self, job, worker):
+        """Extend `worker`'s lease on `job` by LEASE_SECONDS, up to its
+        timeout; False if the lease was lost."""
+
+        cursor = self._conn().execute(
+            "UPDATE jobs SET locked_until = min(?, started_at + timeout) "
+            "WHERE id = ? AND state = 'running' AND worker = ? AND attempts = ?",
+            (time.time() + LEASE_SECONDS, job.id, worker, job.attempts))
+        return cursor.rowcount == 1
+
+    # a worker whose lease ran out (and the job was claimed again) must not
+    # finish the job for the new claim
+    LEASED = "id = ? AND state = 'running' AND worker = ? AND attempts = ?"
+
+    def complete(self, job, worker):
+        """Mark `worker`'s claim on `job` done; False if the lease was lost."""
+
+        cursor = self._conn().execute(
+            "UPDATE jobs SET state = 'done', finished_at = ?, locked_until = NULL "
+            f"WHERE {self.LEASED}", (time.time(), job.id, worker, job.attempts))
+        return cursor.rowcount == 1
+
+    def fail(self, job, worker, error):
+        """Schedule a retry with backoff, or give up after max_attempts;
+        False if `worker`'s lease was lost."""
+
+        now = time.time()
+        if job.attempts < job.max_attempts:
+            backoff = min(RETRY_MAX_SECONDS,
+                          RETRY_BASE_SECONDS * 2 ** (job.attempts - 1))
+            backoff *= random.uniform(0.9, 1.1)
+            cursor = self._conn().execute(
+                "UPDATE jobs SET state = 'queued', run_at = ?, locked_until = NULL, "
+                f"last_error = ? WHERE {self.LEASED}",
+                (now + backoff, error, job.id, worker, job.attempts))
+        else:
+            cursor = self._conn().execute(
+                "UPDATE jobs SET state = 'failed', finished_at = ?, "
+                f"locked_until = NULL, last_error = ? WHERE {self.LEASED}",
+                (now, error, job.id, worker, job.attempts))
+        return cursor.rowcount == 1
+
+    ##########################################################################
+    # Scheduler
+
+    def enqueue_due(self, now=None):
+        """Enqueue the periodic jobs due since the last check; returns names."""
+
+        now = now or datetime.utcnow()
+        enqueued = []
+
+        for schedule, name, args, kwargs in self.schedules:
+            key = f"{name} {schedule.spec}"
+
+            def op(conn):
+                row = conn.execute("SELECT last_run FROM schedules WHERE name = ?",
+                                   (key,)).fetchone()
+                conn.execute("INSERT OR REPLACE INTO schedules (name, last_run) "
+                             "VALUES (?, ?)", (key, now.timestamp()))
+                return row is not None and schedule.due(
+                    datetime.fromtimestamp(row[0]), now)
+
+            if self._transaction(op):
+                self.enqueue(name, *args, dedupe_key=f"periodic:{key}", **kwargs)
+                enqueued.append(name)
+
+        return enqueued
+
+    ##########################################################################
+    # Metrics and housekeeping
+
+    def stats(self, window=STATS_WINDOW_SECONDS):
+        """{job name: counts, jobs/second, run and queue latency} over `window`."""
+
+        since = time.time() - window
+        rows = self._conn().execute(
+            "SELECT name, state, finished_at - started_at, started_at - run_at "
+            "FROM jobs WHERE finished_at >= ?", (since,)).fetchall()
+        pending = self._conn().execute(
+            "SELECT name, state, count(*) FROM jobs "
+            "WHERE state IN ('queued', 'running') GROUP BY name, state").fetchall()
+
+        stats = {}
+
+        def entry(name):
+            return stats.setdefault(name, {
+                'queued': 0, 'running': 0, 'done': 0, 'failed': 0,
+                'per_second': 0.0, 'run_seconds': [], 'wait_seconds': []})
+
+        for name, state, ran, waited in rows:
+            item = entry(name)
+            item[state] += 1
+            item['run_seconds'].append(ran)
+            item['wait_seconds'].append(waited)
+
+        for name, state, count in pending:
+            entry(name)[state] = count
+
+        for item in stats.values():
+            item['per_second'] = item['done'] / window
+            for field in ('run_seconds', 'wait_seconds'):
+                values = sorted(item[field])
+                item[field] = {
+                    'mean': sum(values) / len(values) if values else None,
+                    'p95': values[int(0.95 * (len(values) - 1))] if values else None,
+                    'max': values[-1] if values else None,
+                }
+
+        return stats
+
+    def prune(self, keep=KEEP_FINISHED_SECONDS):
+        """Forget finished jobs older than `keep` seconds."""
+
+        self._conn().execute("DELETE FROM jobs WHERE finished_at < ?",
+                             (time.time() - keep,))
+
+
+queue = JobQueue()
+
+
+def connect_jobs(app):
+    """Keep the job queue in the app's JOBS_DB_PATH."""
+
+    queue.configure(app.config['JOBS_DB_PATH'])
+
+
+##############################################################################
+# Workers
+
+
+class Worker:
+    """Runs queued jobs on `threads` threads, plus the periodic scheduler."""
+
+    def __init__(self, app, job_queue=queue, threads=4, poll_seconds=1.0):
+        self.app = app
+        self.queue = job_queue
+        self.threads = threads
+        self.poll_seconds = poll_seconds
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.stopping = threading.Event()
+
+    def run_job(self, job):
+        done = threading.Event()
+        threading.Thread(target=self._heartbeat, args=(job, done),
+                         name=f"job-heartbeat-{job.id}", daemon=True).start()
+        with self.app.app_context():
+            try:
+                # queued by a process that knows job types this one doesn't
+                if job.name not in self.queue.registry:
+                    raise UnknownJob(job.name)
+                self.queue.registry[job.name][0](*job.args, **job.kwargs)
+            except Exception:
+                self.app.logger.exception("job %s #%s failed", job.name, job.id)
+                self.queue.fail(job, self.name, traceback.format_exc())
+            else:
+                self.queue.complete(job, self.name)
+            finally:
+                done.set()
+                # jobs must not leave sessions (or their locks) behind
+                db.session.remove()
+
+    def _heartbeat(self, job, done):
+        """Renew the lease on a running job until `done` is set."""
+
+        while not done.wait(LEASE_SECONDS / 3):
+            try:
+                if not self.queue.renew(job, self.name):
+                    self.app.logger.warning("job %s #%s lost its lease", job.name, job.id)
+                    return
+            except Exception:
+                self.app.logger.exception("renewing the lease of job #%s failed", job.id)
+
+    def run_pending(self):
+        """Run due jobs in this thread until none are left; returns how many."""
+
+        ran = 0
+        while True:
+            job = self.queue.claim(self.name)
+            if job is None:
+                return ran
+            self.run_job(job)
+            ran += 1
+
+    def _work(self):
+        while not self.stopping.is_set():
+            job = self.queue.claim(self.name)
+            if job is None:
+                self.stopping.wait(self.poll_seconds)
+            else:
+                self.run_job(job)
+
+    def _schedule(self):
+        while not self.stopping.is_set():
+            try:
+                self.queue.enqueue_due()
+            except Exception:
+                self.app.logger.exception("periodic job scheduling failed")
+            # wake up just after the next minute starts
+            self.stopping.wait(60 - time.time() % 60 + 0.5)
+
+    def run(self):
+        """Work until stop() (or Ctrl-C)."""
+
+        pool = [threading.Thread(target=self._work, name=f"job-worker-{i}",
+                                 daemon=True)
+                for i in range(self.threads)]
+        pool.append(threading.Thread(target=self._schedule, name='job-scheduler',
+                                     daemon=True))
+        for thread in pool:
+            thread.start()
+
+        try:
+            while not self.stopping.wait(1):
+                pass
+        except KeyboardInterrupt:
+            self.stop()
+
+        for thread in pool:
+            thread.join()
+
+    def stop(self):
+        self.stopping.set()
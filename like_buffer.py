@@ -0,0 +1,371 @@
+"""Write-behind buffer for like toggles.
+
+A click used to be a transaction of its own, so a popular message meant
+thousands of commits a second. `like_buffer.toggle` answers at once
+instead. It works out the new state from this process's unwritten
+toggles, or one indexed read, appends the event to a log, and keeps only
+the latest state per (user, message). A background thread writes the net
+changes with `shards.apply_likes` every LIKE_FLUSH_MS milliseconds, or as
+soon as LIKE_FLUSH_EVENTS are waiting. That is one transaction of
+multi-row statements per shard. Then `trending` counts the likes that
+are new and takes back the ones deleted, so liking and unliking a
+message over and over doesn't make it trend, and the new likes go to
+`notifications.notify_likes` in one batch.
+
+The log is a file per process in LIKE_BUFFER_DIR. Every event is its own
+write(), so a crashed worker loses nothing the kernel received. Each
+flush fsyncs the log first, so a machine crash loses at most one flush
+window. Logs are deleted once written to the database. Logs left by
+processes that died are replayed by the next buffer to start, and
+checked for once a minute.
+
+A process's files are named likes-<pid>-<random token>, since pids get
+reused, and while it runs it holds a lockf() lock on its
+likes-<pid>-<token>.lock. Logs whose lock can be taken belong to a
+process that is gone. The lock is the only liveness check. Keep
+LIKE_BUFFER_DIR on a local disk, or on a filesystem whose POSIX locks
+work across every host that shares it.
+
+Other processes see a toggle only once it's flushed, so pages that must
+show it (the form post's redirect) call `flush()`. `overlay` applies this
+process's unwritten toggles to a set of liked ids.
+"""
+
+import fcntl
+import logging
+import os
+import struct
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from flask import has_app_context
+from sqlalchemy.exc import IntegrityError
+
+from models import db
+from notifications import notify_likes
+from sharding import shards
+from trending import trending
+
+# user id, message id, liked
+LOG_RECORD = struct.Struct('<iqB')
+
+# how often the flusher looks for logs of workers that died since it started
+RECOVER_SECONDS = 60
+
+log = logging.getLogger(__name__)
+
+
+class LikeBuffer:
+    """Unwritten like toggles of this process, and the thread writing them."""
+
+    def __init__(self):
+        self.app = None
+        self.directory = None
+        self.flush_seconds = 0.05
+        self.max_events = 500
+        self._pid = None
+        self._owner = None
+        self._start_lock = threading.Lock()
+        self.stats = {'toggles': 0, 'flushes': 0, 'rows': 0}
+
+    def configure(self, app):
+        self.app = app
+        self.directory = app.config['LIKE_BUFFER_DIR']
+        self.flush_seconds = app.config['LIKE_FLUSH_MS'] / 1000
+        self.max_events = app.config['LIKE_FLUSH_EVENTS']
+        self._pid = None
+
+    ##########################################################################
+    # Toggling
+
+    def toggle(self, user_id, message_id):
+        """Like the message, or unlike it if already liked; True if liked."""
+
+        self._start()
+        key = (user_id, message_id)
+
+        with self._lock:
+            before = self._pending.get(key, self._flushing.get(key))
+        if before is None:
+            before = shards.is_liked(user_id, message_id)
+        liked = not before
+
+        with self._lock:
+            # as of the last flush; only likes that weren't there are news
+            self._before.setdefault(key, before)
+            self._pending[key] = liked
+            os.write(self._log, LOG_RECORD.pack(user_id, message_id, liked))
+            self.stats['toggles'] += 1
+            if len(self._pending) >= self.max_events:
+                self._wake.set()
+
+        return liked
+
+    def overlay(self, user_id, liked_ids):
+        """`liked_ids` of `user_id` with this process's unwritten toggles."""
+
+        if self._pid != os.getpid():
+            return liked_ids
+
+        with self._lock:
+            changes = [(message_id, liked)
+                       for changes in (self._flushing, self._pending)
+                       for (liker_id, message_id), liked in changes.items()
+                       if liker_id == user_id]
+
+        liked_ids = set(liked_ids)
+        for message_id, liked in changes:
+            if liked:
+                liked_ids.add(message_id)
+            else:
+                liked_ids.discard(message_id)
+        return liked_ids
+
+    ##########################################################################
+    # Flushing
+
+    def flush(self):
+        """Write every pending toggle now; returns how many rows changed."""
+
+        if self._pid != os.getpid():
+            return 0
+
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                changes, self._pending = self._pending, {}
+                before, self._before = self._before, {}
+                self._flushing = changes
+
+                # events up to here must survive whatever happens next; the
+                # log goes aside until they are committed
+                os.fsync(self._log)
+                os.close(self._log)
+                self._flush_seq += 1
+                flushing = f"{self._log_path}.{self._flush_seq:08d}.flushing"
+                os.rename(self._log_path, flushing)
+                self._written_logs.append(flushing)
+                self._log = self._open_log()
+
+            try:
+                unliked = self._write(changes)
+            except Exception:
+                with self._lock:
+                    # toggles made since win over the failed ones
+                    for key, liked in changes.items():
+                        self._pending.setdefault(key, liked)
+                        self._before.setdefault(key, before[key])
+                    self._flushing = {}
+                raise
+
+            with self._lock:
+                self._flushing = {}
+                logs, self._written_logs = self._written_logs, []
+            for path in logs:
+                os.unlink(path)
+
+            self.stats['flushes'] += 1
+            self.stats['rows'] += len(changes)
+
+            self._written(changes, before, unliked)
+            return len(changes)
+
+    def close(self):
+        """Flush and stop logging (a worker about to exit)."""
+
+        if self._pid != os.getpid():
+            return
+        self.flush()
+        with self._lock:
+            os.close(self._log)
+            os.unlink(self._log_path)
+            # last, so recover() never sees our logs unlocked
+            os.unlink(self._owner_path)
+            os.close(self._owner_fd)
+            self._pid = None
+            self._wake.set()
+
+    def _write(self, changes):
+        """Apply `changes`; returns {key: timestamp} of the likes deleted."""
+
+        try:
+            return self._in_app(shards.apply_likes, changes)
+        except IntegrityError:
+            # a message or user was deleted since; don't let it hold up the rest
+            unliked = {}
+            for key, liked in changes.items():
+                try:
+                    unliked.update(self._in_app(shards.apply_likes, {key: liked}))
+                except IntegrityError:
+                    log.info("dropped like toggle %s of a deleted row", key)
+            return unliked
+
+    def _written(self, changes, before, unliked):
+        """Count written `changes` in trending and send their notifications.
+        `before` says which keys were liked before; `unliked` is what
+        _write returned."""
+
+        new_likes = [key for key, liked in changes.items() if liked and not before[key]]
+        for user_id, message_id in new_likes:
+            trending.record_like(message_id)
+        for (user_id, message_id), liked_at in unliked.items():
+            trending.remove_like(message_id, liked_at)
+
+        if new_likes:
+            try:
+                self._in_app(self._notify, new_likes)
+            except Exception:
+                # the likes are written; don't write them again
+                log.exception("notifying %s likes failed", len(new_likes))
+
+    def _notify(self, likes):
+        try:
+            notify_likes(likes)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def _in_app(self, fn, *args):
+        if has_app_context():
+            # a request's own flush: a nested context would close its session
+            return fn(*args)
+        with self.app.app_context():
+            return fn(*args)
+
+    def _run(self, wake):
+        recovered = time.monotonic()
+        while True:
+            wake.wait(self.flush_seconds)
+            wake.clear()
+            # closed, or started again after a fork
+            if self._pid != os.getpid() or wake is not self._wake:
+                return
+            try:
+                self.flush()
+                if time.monotonic() - recovered > RECOVER_SECONDS:
+                    recovered = time.monotonic()
+                    self.recover()
+            except Exception:
+                log.exception("flushing likes failed; retrying")
+
+    ##########################################################################
+    # Starting and recovery
+
+    def _open_log(self):
+        return os.open(self._log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _start(self):
+        """Once per process: replay dead processes' logs, open ours and
+        start the flushing thread."""
+
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._start_process()
+
+    def _start_process(self):
+        # locks held in the parent at fork time would never be released here
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = {}
+        self._before = {}
+        self._flushing = {}
+        self._written_logs = []
+        self._flush_seq = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._owner = f"likes-{os.getpid()}-{uuid.uuid4().hex[:12]}"
+        self._owner_path = os.path.join(self.directory, f"{self._owner}.lock")
+        # locked before it appears under its name, so it is never seen unlocked
+        tmp = os.path.join(self.directory, f".{self._owner}.lock.tmp")
+        self._owner_fd = os.open(tmp, os.O_WRONLY | os.O_CREAT, 0o644)
+        fcntl.lockf(self._owner_fd, fcntl.LOCK_EX)
+        os.rename(tmp, self._owner_path)
+
+        self.recover()
+
+        self._log_path = os.path.join(self.directory, f"{self._owner}.log")
+        self._log = self._open_log()
+        self._pid = os.getpid()
+        threading.Thread(target=self._run, args=(self._wake,), name='like-flusher',
+                         daemon=True).start()
+
+    def recover(self):
+        """Write the toggles in logs of processes that are gone; returns
+        how many rows changed."""
+
+        with open(os.path.join(self.directory, '.recover.lock'), 'w') as lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+
+            by_owner = defaultdict(list)
+            for name in os.listdir(self.directory):
+                if name.startswith('likes-'):
+                    by_owner[name.split('.')[0]].append(name)
+
+            changed = 0
+            for owner, names in by_owner.items():
+                if owner == self._owner:
+                    continue
+                owner_fd = _take_over(os.path.join(self.directory, f"{owner}.lock"))
+                if owner_fd is False:
+                    continue
+
+                try:
+                    # set-aside logs in order, then the live one
+                    logs = sorted((name for name in names if not name.endswith('.lock')),
+                                  key=lambda name: (name.endswith('.log'), name))
+                    changes = {}
+                    for name in logs:
+                        with open(os.path.join(self.directory, name), 'rb') as f:
+                            data = f.read()
+                        # a crash can leave half a record at the end
+                        whole = len(data) - len(data) % LOG_RECORD.size
+                        for user_id, message_id, liked in LOG_RECORD.iter_unpack(data[:whole]):
+                            changes[user_id, message_id] = bool(liked)
+
+                    if changes:
+                        # the dead process's view of them is gone; ask the table
+                        before = {key: liked and self._in_app(shards.is_liked, *key)
+                                  for key, liked in changes.items()}
+                        self._written(changes, before, self._write(changes))
+                        log.info("recovered %s like toggles of %s", len(changes), owner)
+                    for name in names:
+                        os.unlink(os.path.join(self.directory, name))
+                    changed += len(changes)
+                finally:
+                    if owner_fd is not None:
+                        os.close(owner_fd)
+
+            return changed
+
+
+def _take_over(lock_path):
+    """Lock a process's lock file if that process is gone: the locked fd,
+    None if there is no lock file left, or False if it is still running."""
+
+    try:
+        fd = os.open(lock_path, os.O_WRONLY)
+    except FileNotFoundError:
+        return None
+
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    return fd
+
+
+like_buffer = LikeBuffer()
+
+
+def connect_like_buffer(app):
+    """Buffer like toggles in the app's LIKE_BUFFER_DIR."""
+
+    like_buffer.configure(app)
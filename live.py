@@ -0,0 +1,400 @@
+"""Live timeline: new message ids pushed to followers as Server-Sent Events.
+
+    python live.py [--bind 0.0.0.0:8001]
+
+The web workers (serve.py) serve one request at a time, so they can't
+hold streams open. This is a separate server for that: one asyncio event
+loop holding every open stream, each an idle coroutine and a few small
+buffers. Put it behind the same host as the site and route LIVE_URL
+(say /live) to it, so the browser sends the session cookie along.
+
+When messages_add commits, the worker publishes (author id, message id)
+on the transport named by LIVE_TRANSPORT_URL:
+
+- unix:///path/live.sock: a datagram socket the live server binds. One
+  host only; a worker never waits on it.
+- notify://: NOTIFY on the primary database, which the live server
+  LISTENs to, so web workers and the live server can be on any hosts.
+
+The live server hands each message to its hub, which pushes it to the
+open streams of the author and their followers (from the follow graph).
+Each stream keeps a bounded list of ids not sent yet. Ids arriving within
+COALESCE_SECONDS go out as one "messages" event. A stream that falls
+MAX_PENDING ids behind gets a single "reset" event instead, telling the
+page to reload.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import struct
+from collections import defaultdict
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit
+
+import numpy as np
+from sqlalchemy import select, func
+
+LIVE_CHANNEL = 'warbler_live'
+
+# (author id, message id) in a datagram
+DATAGRAM = struct.Struct('<iq')
+
+# ids a stream may fall behind before it is told to reload instead
+MAX_PENDING = 100
+# how long to gather a burst into one event
+COALESCE_SECONDS = 0.25
+# a comment line this often keeps proxies from closing idle streams and
+# notices clients that went away
+KEEPALIVE_SECONDS = 15
+# browsers wait this long before reconnecting a dropped stream
+RETRY_MS = 5000
+
+HEAD_TIMEOUT = 10
+MAX_HEAD_BYTES = 16 * 1024
+WRITE_TIMEOUT = 30
+RECONNECT_SECONDS = 5
+
+log = logging.getLogger('live')
+
+
+##############################################################################
+# Transports
+
+
+class SocketTransport:
+    """Datagrams on a local unix socket (one host)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._sock = None
+        self._pid = None
+
+    def publish(self, user_id, message_id):
+        # a socket made before a fork would be shared by every worker
+        if self._pid != os.getpid():
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.setblocking(False)
+            self._pid = os.getpid()
+        try:
+            self._sock.sendto(DATAGRAM.pack(user_id, message_id), self.path)
+        except OSError:
+            # no live server, or it's behind: nobody must wait for these
+            pass
+
+    async def subscribe(self, deliver):
+        """Bind the socket and call `deliver(user_id, message_id)` for each
+        datagram."""
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(self.path)
+
+        class Datagrams(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                if len(data) == DATAGRAM.size:
+                    deliver(*DATAGRAM.unpack(data))
+
+        await asyncio.get_running_loop().create_datagram_endpoint(Datagrams, sock=sock)
+
+
+class NotifyTransport:
+    """Postgres NOTIFY / LISTEN on the primary database (any hosts)."""
+
+    def publish(self, user_id, message_id):
+        from models import db
+
+        with db.engine.begin() as conn:
+            conn.execute(select([func.pg_notify(LIVE_CHANNEL, f"{user_id}:{message_id}")]))
+
+    async def subscribe(self, deliver):
+        """LISTEN on a connection of its own, reconnecting if it drops."""
+
+        from models import db
+
+        loop = asyncio.get_running_loop()
+
+        raw = db.engine.raw_connection()
+        raw.detach()
+        conn = raw.connection
+        conn.autocommit = True
+        conn.cursor().execute(f"LISTEN {LIVE_CHANNEL}")
+
+        def readable():
+            try:
+                conn.poll()
+            except Exception:
+                log.exception("lost the LISTEN connection")
+                loop.remove_reader(conn.fileno())
+                loop.call_later(RECONNECT_SECONDS,
+                                lambda: loop.create_task(self.subscribe(deliver)))
+                return
+            while conn.notifies:
+                user_id, message_id = conn.notifies.pop(0).payload.split(':')
+                deliver(int(user_id), int(message_id))
+
+        loop.add_reader(conn.fileno(), readable)
+
+
+def transport_for(url):
+    """The transport for a LIVE_TRANSPORT_URL, or None if it's empty."""
+
+    if not url:
+        return None
+    parts = urlsplit(url)
+    if parts.scheme == 'unix':
+        return SocketTransport(parts.path)
+    if parts.scheme == 'notify':
+        return NotifyTransport()
+    raise ValueError(f"unknown live transport {url!r}")
+
+
+class Live:
+    """Publishes new messages to the live server, if there is a transport."""
+
+    def __init__(self):
+        self.transport = None
+
+    def configure(self, url):
+        self.transport = transport_for(url)
+
+    def publish(self, user_id, message_id):
+        if self.transport is not None:
+            self.transport.publish(user_id, message_id)
+
+
+live = Live()
+
+
+def connect_live(app):
+    """Publish new messages on the app's LIVE_TRANSPORT_URL."""
+
+    live.configure(app.config['LIVE_TRANSPORT_URL'])
+
+
+##############################################################################
+# Hub
+
+
+class Subscriber:
+    """One open stream: the message ids it hasn't been sent yet."""
+
+    def __init__(self, user_id, max_pending=MAX_PENDING):
+        self.user_id = user_id
+        self.max_pending = max_pending
+        self.pending = []
+        self.overflowed = False
+        self.ready = asyncio.Event()
+
+    def push(self, message_id):
+        if self.overflowed:
+            return
+        if len(self.pending) >= self.max_pending:
+            # too far behind to be worth catching up id by id
+            self.overflowed = True
+            self.pending = []
+        else:
+            self.pending.append(message_id)
+        self.ready.set()
+
+    def take(self):
+        """(ids not sent yet, whether some were dropped); empties the list."""
+
+        taken = self.pending, self.overflowed
+        self.pending, self.overflowed = [], False
+        self.ready.clear()
+        return taken
+
+
+class Hub:
+    """Open streams by user; fans each new message out to the author's."""
+
+    def __init__(self, followers):
+        # followers(user_id) -> sorted array of the ids following them
+        self.followers = followers
+        self.subscribers = defaultdict(set)
+
+    def subscribe(self, subscriber):
+        self.subscribers[subscriber.user_id].add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        streams = self.subscribers[subscriber.user_id]
+        streams.discard(subscriber)
+        if not streams:
+            del self.subscribers[subscriber.user_id]
+
+    def deliver(self, author_id, message_id):
+        if not self.subscribers:
+            return
+
+        connected = np.fromiter(self.subscribers, dtype=np.int64, count=len(self.subscribers))
+        recipients = np.intersect1d(self.followers(author_id), connected,
+                                    assume_unique=True).tolist()
+        if author_id in self.subscribers:
+            recipients.append(author_id)
+
+        for user_id in recipients:
+            for subscriber in self.subscribers[user_id]:
+                subscriber.push(message_id)
+
+
+##############################################################################
+# Server
+
+
+class LiveServer:
+    """Serves GET /live as an event stream of the viewer's new message ids."""
+
+    def __init__(self, app, hub, path='/live'):
+        from auth import CURR_USER_KEY
+
+        self.hub = hub
+        self.path = path
+        self.user_key = CURR_USER_KEY
+        self.cookie_name = app.config['SESSION_COOKIE_NAME']
+        self.serializer = app.session_interface.get_signing_serializer(app)
+        self.max_age = int(app.permanent_session_lifetime.total_seconds())
+        self.handlers = set()
+
+    def user_id(self, headers):
+        """The logged-in user of the request's session cookie, or None."""
+
+        cookie = SimpleCookie(headers.get('cookie', ''))
+        if self.cookie_name not in cookie:
+            return None
+        try:
+            session = self.serializer.loads(cookie[self.cookie_name].value,
+                                            max_age=self.max_age)
+        except Exception:
+            return None
+        return session.get(self.user_key)
+
+    async def read_head(self, reader):
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), HEAD_TIMEOUT)
+        request_line, *lines = head.decode('latin-1').split('\r\n')
+        method, target, _ = request_line.split(' ', 2)
+        headers = {}
+        for line in lines:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        return method, target.split('?', 1)[0], headers
+
+    async def respond(self, writer, status, body=b''):
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+
+    async def send(self, writer, data):
+        writer.write(data.encode())
+        await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT)
+
+    async def handle(self, reader, writer):
+        handler = asyncio.current_task()
+        self.handlers.add(handler)
+        try:
+            try:
+                method, path, headers = await self.read_head(reader)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                    asyncio.LimitOverrunError, ValueError):
+                return
+
+            if method != 'GET' or path != self.path:
+                return await self.respond(writer, '404 Not Found')
+            user_id = self.user_id(headers)
+            if user_id is None:
+                return await self.respond(writer, '401 Unauthorized')
+
+            await self.stream(writer, user_id)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            self.handlers.discard(handler)
+            writer.close()
+
+    def close_streams(self):
+        for handler in list(self.handlers):
+            handler.cancel()
+
+    async def stream(self, writer, user_id):
+        await self.send(writer, "HTTP/1.1 200 OK\r\n"
+                                "Content-Type: text/event-stream\r\n"
+                                "Cache-Control: no-cache\r\n"
+                                "X-Accel-Buffering: no\r\n"
+                                "\r\n"
+                                f"retry: {RETRY_MS}\n\n")
+
+        subscriber = Subscriber(user_id)
+        self.hub.subscribe(subscriber)
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(subscriber.ready.wait(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    await self.send(writer, ": keepalive\n\n")
+                    continue
+
+                # let the rest of a burst arrive
+                await asyncio.sleep(COALESCE_SECONDS)
+                ids, overflowed = subscriber.take()
+                if overflowed:
+                    await self.send(writer, "event: reset\ndata: {}\n\n")
+                else:
+                    await self.send(writer, f"id: {ids[-1]}\nevent: messages\n"
+                                            f"data: {json.dumps(ids)}\n\n")
+        finally:
+            self.hub.unsubscribe(subscriber)
+
+
+async def serve(app, listener):
+    """Run the live server on `listener` until SIGTERM or SIGINT."""
+
+    from follow_graph import follow_graph
+
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+
+    hub = Hub(follow_graph.followers)
+    await transport_for(app.config['LIVE_TRANSPORT_URL']).subscribe(hub.deliver)
+
+    live_server = LiveServer(app, hub)
+    server = await asyncio.start_server(live_server.handle, sock=listener,
+                                        limit=MAX_HEAD_BYTES)
+    log.info("live on %s:%s", *listener.getsockname()[:2])
+
+    await stopping.wait()
+    server.close()
+    live_server.close_streams()
+    await server.wait_closed()
+
+
+def main():
+    from serve import listen
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bind', default='0.0.0.0:8001', help="host:port to listen on")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format="[%(asctime)s] [%(process)d] %(message)s")
+
+    from app import create_app
+
+    app = create_app()
+    if not app.config['LIVE_TRANSPORT_URL']:
+        parser.error("LIVE_TRANSPORT_URL is not set")
+
+    with app.app_context():
+        asyncio.run(serve(app, listen(args.bind)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""Messages and reply threads, the homepage timeline, likes, trending and
+hashtags."""
+
+from flask import (Blueprint, current_app, render_template, request, flash, redirect, g, abort,
+                   jsonify)
+
+from like_buffer import like_buffer
+from live import live
+from models import db
+from notifications import notify_mentions, notify_reply
+from partitions import ensure_partitions, find_archived_message
+from recommendations import recommendations_for
+from sharding import shards
+from tags import index_message, unindex_messages, normalize_tag, tag_page
+from threads import ancestor_ids
+from trending import trending
+
+bp = Blueprint('messages', __name__)
+
+
+##############################################################################
+# Messages routes:
+
+
+@bp.route('/messages/new', methods=["GET", "POST"])
+def messages_add():
+    """Add a message:
+
+    Show form if GET. If valid, update message and redirect to user page.
+    """
+    if not g.user or request.form.get('user_id', str(g.user.id)) != str(g.user.id):
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    from forms import MessageForm
+
+    form = MessageForm()
+
+    if form.validate_on_submit():
+        post_message(form.text.data)
+
+        return redirect(f"/users/{g.user.id}")
+
+    return render_template('messages/new.html', form=form)
+
+
+def post_message(text, parent=None):
+    """Store a message (a reply to `parent`, if given) by g.user and tell
+    everyone who should know."""
+
+    msg = shards.add_message(g.user.id, text, parent)
+    # the message may be on a shard; `flask ops index-messages` fills
+    # in any that miss this
+    notify_mentions(msg, index_message(msg))
+    if parent is not None:
+        notify_reply(msg, parent)
+    db.session.commit()
+    trending.record_message(msg.id)
+    live.publish(g.user.id, msg.id)
+
+    return msg
+
+
+@bp.route('/messages/<int:message_id>', methods=["GET"])
+def messages_show(message_id):
+    """Show a message, the messages it replies to, and its replies."""
+
+    from forms import MessageForm
+
+    msg = shards.get_message(message_id)
+    ancestors, replies, next_start = [], [], None
+
+    if msg is None:
+        # old months only live in the archive, without their threads
+        msg = find_archived_message(current_app.config['MESSAGE_ARCHIVE_DIR'], message_id)
+    else:
+        ancestors = shards.messages_by_id(ancestor_ids(msg))
+        replies, next_start = shards.thread(msg, request.args.get('after', type=int))
+
+    if msg is None:
+        abort(404)
+
+    return render_template('messages/show.html', message=msg, ancestors=ancestors,
+                           replies=replies, next_start=next_start,
+                           form=MessageForm() if g.user else None)
+
+
+@bp.route('/messages/<int:message_id>/reply', methods=["POST"])
+def messages_reply(message_id):
+    """Reply to a message."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    from forms import MessageForm
+
+    parent = shards.get_message(message_id)
+    if parent is None:
+        abort(404)
+
+    form = MessageForm()
+    if not form.validate_on_submit():
+        flash("Your reply was empty.", "danger")
+        return redirect(f"/messages/{message_id}")
+
+    msg = post_message(form.text.data, parent)
+
+    return redirect(f"/messages/{message_id}#message-{msg.id}")
+
+
+@bp.route('/messages/<int:message_id>/delete', methods=["GET","POST"])
+def messages_destroy(message_id):
+    """Delete a message."""
+    msg = shards.get_message(message_id)
+
+    if not g.user or msg.user_id != g.user.id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+
+    message_id = msg.id
+    shards.delete_message(msg)
+    unindex_messages(db.session, [message_id])
+    db.session.commit()
+
+    return redirect(f"/users/{g.user.id}")
+
+
+##############################################################################
+# Homepage, likes and trending
+
+
+@bp.route('/')
+def homepage():
+    """Show homepage:
+
+    - anon users: no messages
+    - logged in: 100 most recent messages of followed_users
+    """
+
+    if g.user:
+        # get list of users being following
+        user = g.user
+        followed_users = [followed_user.id for followed_user in user.following]
+        followed_users.append(user.id)
+
+        messages = shards.messages_for(followed_users, limit=100)
+
+        like_message_ids = like_buffer.overlay(user.id, shards.liked_message_ids(user.id))
+
+        suggestions = recommendations_for(user.id)
+            
+        return render_template('home.html', messages=messages, likes=like_message_ids, like_message_ids=like_message_ids, user=user, suggestions=suggestions)
+
+    else:
+        return render_template('home-anon.html')
+
+@bp.route('/users/handle_like/<int:msg_id>', methods=["POST"])
+def handle_like(msg_id):
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    if shards.get_message(msg_id) is None:
+        abort(404)
+
+    # adds the like, or removes it if this user already liked the message
+    liked = like_buffer.toggle(g.user.id, msg_id)
+
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        # the homepage script; the buffer writes it shortly
+        return jsonify(liked=liked)
+
+    # the page we redirect to may be served by another worker
+    like_buffer.flush()
+    return redirect('/')
+
+@bp.route('/trending')
+def show_trending():
+    """Show the messages with the most recent likes."""
+
+    ranked = [message_id for message_id, score in trending.top(20)]
+    messages = shards.messages_by_id(ranked)
+
+    return render_template('trending.html', messages=messages)
+
+
+@bp.route('/tags/<tag>')
+def show_tag(tag):
+    """Show the messages with a hashtag, newest first."""
+
+    tag = normalize_tag(tag)
+    if not tag:
+        abort(404)
+
+    try:
+        messages, next_cursor = tag_page(tag, request.args.get('before'))
+    except ValueError:
+        abort(400)
+
+    return render_template('tags.html', tag=tag, messages=messages, next_cursor=next_cursor)
+
+
+##############################################################################
+# Message partitions
+
+
+@bp.before_app_first_request
+def create_future_partitions():
+    """Make sure the coming months have partitions before messages arrive."""
+
+    with db.engine.begin() as conn:
+        ensure_partitions(conn)
@@ -3,16 +3,24 @@
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+
+from routing import RoutingSQLAlchemy
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
+    # follower / following listings page by follow time straight off these
+    __table_args__ = (
+        db.Index('ix_follows_followed_timestamp',
+                 'user_being_followed_id', 'timestamp', 'user_following_id'),
+        db.Index('ix_follows_following_timestamp',
+                 'user_following_id', 'timestamp', 'user_being_followed_id'),
+    )
 
     user_being_followed_id = db.Column(
         db.Integer,
@@ -26,14 +34,28 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+# Message ids are global across shards, so they need 64 bits (SQLite only
+# autoincrements plain INTEGER primary keys, which are 64-bit there anyway).
+BigId = db.BigInteger().with_variant(db.Integer, 'sqlite')
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
     __tablename__ = 'likes' 
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id'),
+    )
 
     id = db.Column(
-        db.Integer,
+        BigId,
         primary_key=True
     )
 
@@ -43,9 +65,14 @@ class Likes(db.Model):
     )
 
     message_id = db.Column(
-        db.Integer,
+        BigId,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
     )
 
     messages = db.relationship('Message')
@@ -96,6 +123,34 @@ class User(db.Model):
         nullable=False,
     )
 
+    # set when the account is deleted; the rows are purged in the background
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # kept up to date by follows.py; `flask recount-follows` recomputes them
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # kept up to date by notifications.py, for the navbar
+    unread_notifications = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -162,7 +217,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -176,9 +231,15 @@ class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp'),
+        # a thread, or any reply's subtree, in display order (see threads.py)
+        db.Index('ix_messages_thread_path', 'thread_id', 'path'),
+        db.Index('ix_messages_parent_path', 'parent_id', 'path'),
+    )
 
     id = db.Column(
-        db.Integer,
+        BigId,
         primary_key=True,
     )
 
@@ -190,7 +251,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -199,9 +260,185 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Replies only; no foreign key, the parent may be on another shard or
+    # partition. `thread_id` is the top message's id, `path` the
+    # materialized path of ids from it down to this reply.
+    parent_id = db.Column(
+        BigId,
+    )
+
+    thread_id = db.Column(
+        BigId,
+    )
+
+    path = db.Column(
+        db.Text,
+    )
+
+    # direct replies; kept up to date by ShardRouter
+    reply_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
 
+class MessageTag(db.Model):
+    """A hashtag in a message (see tags.py)."""
+
+    __tablename__ = 'message_tags'
+    # a tag's messages, newest first, straight off the index
+    __table_args__ = (
+        db.Index('ix_message_tags_tag_timestamp', 'tag', 'timestamp', 'message_id'),
+        db.Index('ix_message_tags_message_id', 'message_id'),
+    )
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    # no foreign key: the message may live on a shard
+    message_id = db.Column(
+        BigId,
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+
+class Mention(db.Model):
+    """A user @mentioned in a message (see tags.py)."""
+
+    __tablename__ = 'mentions'
+    __table_args__ = (
+        db.Index('ix_mentions_user_timestamp', 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_mentions_message_id', 'message_id'),
+    )
+
+    # the user mentioned
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        BigId,
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+
+class Notification(db.Model):
+    """An inbox row: likes of a message, a mention, or new followers
+    (see notifications.py)."""
+
+    __tablename__ = 'notifications'
+    __table_args__ = (
+        db.Index('ix_notifications_recipient_updated', 'recipient_id', 'updated_at', 'id'),
+        # events fold into the one unread row per recipient, kind and message
+        db.Index('ix_notifications_unread', 'recipient_id', 'kind', 'message_id', unique=True,
+                 postgresql_where=db.text('read_at IS NULL'),
+                 sqlite_where=db.text('read_at IS NULL')),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    recipient_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # 'like', 'mention', 'reply' or 'follow'
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # the liked, mentioning or replied-to message; 0 for follows
+    message_id = db.Column(
+        BigId,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # the most recent of `actor_count` users
+    actor_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='set null'),
+    )
+
+    actor_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    read_at = db.Column(
+        db.DateTime,
+    )
+
+    actor = db.relationship('User', foreign_keys=[actor_id])
+
+
+class ShardDirectory(db.Model):
+    """Users whose messages/likes live somewhere other than their home shard."""
+
+    __tablename__ = 'shard_directory'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    shard = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    # set while the user's rows are being moved; their writes wait
+    frozen = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -0,0 +1,154 @@
+"""Notifications: likes of and replies to your warbles, mentions of you,
+new followers.
+
+Each user has an inbox of `notifications` rows. An event folds into the
+recipient's unread row for the same kind and message (or, for follows,
+their unread "new followers" row), if there is one. So a warble liked by
+thousands is one row, "alice and 41 others liked your warble". The row
+keeps the most recent actor and a count. Once the inbox has been read,
+the next event starts a new row.
+
+Folding is an UPDATE of the unread row, then an INSERT only if there was
+none. A partial unique index, one unread row per recipient, kind and
+message, stops two writers from both inserting.
+`users.unread_notifications` counts unread rows and changes in the same
+transaction, so the navbar shows it straight from g.user.
+
+Likes come from the like buffer's flushes, so a burst of likes costs one
+UPDATE per message per flush, not one per click. Follows come from
+`follows.follow_users`, and mentions and replies from posting a message. Everything
+here runs in the current db.session transaction; the caller commits.
+"""
+
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import joinedload
+
+from follows import encode_cursor, decode_cursor, CARD_COLUMNS
+from models import db, User, Notification
+from query_cache import mark_stale
+from sharding import shards, insert_ignoring_duplicates
+
+NOTIFICATIONS_PAGE_SIZE = 30
+
+# read notifications older than this are deleted by the prune job
+KEEP_READ_DAYS = 90
+
+
+##############################################################################
+# Recording
+
+
+def notify(recipient_id, kind, actor_ids, message_id=0, now=None):
+    """Record that `actor_ids` (oldest first) did `kind` to the recipient."""
+
+    actor_ids = [actor_id for actor_id in actor_ids if actor_id != recipient_id]
+    if not actor_ids:
+        return
+
+    now = now or datetime.utcnow()
+    table = Notification.__table__
+    unread = and_(table.c.recipient_id == recipient_id, table.c.kind == kind,
+                  table.c.message_id == message_id, table.c.read_at.is_(None))
+    fold = (table.update().where(unread)
+            .values(actor_id=actor_ids[-1], updated_at=now,
+                    actor_count=table.c.actor_count + len(actor_ids)))
+
+    if db.session.execute(fold).rowcount:
+        return
+
+    inserted = db.session.execute(
+        insert_ignoring_duplicates(db.session, table).values(
+            recipient_id=recipient_id, kind=kind, message_id=message_id,
+            actor_id=actor_ids[-1], actor_count=len(actor_ids), updated_at=now)).rowcount
+    if not inserted:
+        # another transaction made the unread row first
+        db.session.execute(fold)
+        return
+
+    users = User.__table__
+    db.session.execute(users.update().where(users.c.id == recipient_id)
+                       .values(unread_notifications=users.c.unread_notifications + 1))
+    mark_stale(db.session, 'users', recipient_id)
+
+
+def notify_likes(likes):
+    """New likes, [(liker id, message id)]: one fold per liked message."""
+
+    likers = defaultdict(list)
+    for liker_id, message_id in likes:
+        likers[message_id].append(liker_id)
+
+    now = datetime.utcnow()
+    for msg in shards.messages_by_id(likers):
+        notify(msg.user_id, 'like', likers[msg.id], msg.id, now)
+
+
+def notify_mentions(msg, user_ids):
+    for user_id in user_ids:
+        notify(user_id, 'mention', [msg.user_id], msg.id)
+
+
+def notify_reply(msg, parent):
+    notify(parent.user_id, 'reply', [msg.user_id], parent.id)
+
+
+def notify_follows(follower_id, user_ids):
+    now = datetime.utcnow()
+    for user_id in user_ids:
+        notify(user_id, 'follow', [follower_id], now=now)
+
+
+##############################################################################
+# Reading
+
+
+def inbox_page(user_id, before=None, limit=NOTIFICATIONS_PAGE_SIZE):
+    """One page of the user's notifications, most recently updated first:
+    ([(notification, message or None)], cursor for the next page or None).
+    ValueError for a bad cursor."""
+
+    query = (Notification.query
+             .options(joinedload(Notification.actor).load_only(*CARD_COLUMNS))
+             .filter(Notification.recipient_id == user_id)
+             .order_by(Notification.updated_at.desc(), Notification.id.desc()))
+    if before:
+        updated_at, last_id = decode_cursor(before)
+        query = query.filter(or_(Notification.updated_at < updated_at,
+                                 and_(Notification.updated_at == updated_at,
+                                      Notification.id < last_id)))
+
+    rows = query.limit(limit + 1).all()
+    page = rows[:limit]
+
+    messages = {msg.id: msg for msg in shards.messages_by_id(
+        {notification.message_id for notification in page if notification.message_id})}
+    items = [(notification, messages.get(notification.message_id)) for notification in page]
+
+    if len(rows) <= limit:
+        return items, None
+    last = page[-1]
+    return items, encode_cursor(last.updated_at, last.id)
+
+
+def mark_read(user_id):
+    """Mark all the user's notifications read and zero their counter."""
+
+    table, users = Notification.__table__, User.__table__
+    db.session.execute(table.update()
+                       .where(table.c.recipient_id == user_id)
+                       .where(table.c.read_at.is_(None))
+                       .values(read_at=datetime.utcnow()))
+    db.session.execute(users.update().where(users.c.id == user_id)
+                       .values(unread_notifications=0))
+    mark_stale(db.session, 'users', user_id)
+
+
+def prune(days=KEEP_READ_DAYS):
+    """Delete notifications read more than `days` ago; returns how many."""
+
+    table = Notification.__table__
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    return db.session.execute(table.delete().where(table.c.read_at < cutoff)).rowcount
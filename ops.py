@@ -0,0 +1,361 @@
+"""Operations: maintenance commands, background jobs and stats endpoints.
+
+The commands are registered on the app's `flask` CLI by create_app. The
+stats endpoints answer only requests with `Authorization: Bearer
+<OPS_TOKEN>`, and 404 while OPS_TOKEN is unset.
+"""
+
+import hmac
+import os
+from functools import wraps
+
+import click
+from flask import Blueprint, current_app, jsonify, request, abort
+from flask.cli import AppGroup
+
+from analytics import Export, posting_rates, like_ratios, follower_growth, top
+from cache import cache
+from deletion import purge_pending, Throttle, PURGE_BATCH_ROWS, PURGE_DUTY_CYCLE
+from export import export_all
+from follow_graph import follow_graph
+from follows import recount_follows
+from jobs import queue, Worker
+from models import db
+from notifications import prune as prune_notifications
+from partitions import (ensure_partitions, partition_messages, archive_partitions,
+                        ARCHIVE_AFTER_MONTHS)
+from recommendations import refresh as refresh_recommendations
+from sharding import shards
+from tags import index_messages, INDEX_BATCH_ROWS
+from template_cache import precompile
+from trending import trending, REBUILD_HOURS
+
+bp = Blueprint('ops', __name__)
+cli = AppGroup('ops')
+
+
+def ops_only(view):
+    """Serve `view` only to requests carrying the OPS_TOKEN."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = current_app.config['OPS_TOKEN']
+        if not token:
+            abort(404)
+        given = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(given.encode(), f"Bearer {token}".encode()):
+            abort(403)
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+##############################################################################
+# Message partitions
+
+
+@cli.command('partition-messages')
+def partition_messages_command():
+    """Convert messages into a table partitioned by month (Postgres)."""
+
+    with db.engine.begin() as conn:
+        partition_messages(conn)
+        ensure_partitions(conn)
+
+
+@cli.command('archive-messages')
+@click.option('--after-months', default=ARCHIVE_AFTER_MONTHS,
+              help="Archive months older than this.")
+def archive_messages(after_months):
+    """Move old message partitions to compressed files in the archive dir."""
+
+    for name in archive_all_messages(after_months):
+        print(f"archived {name}")
+
+
+def archive_all_messages(after_months=ARCHIVE_AFTER_MONTHS):
+    """Archive old partitions on the primary and every shard; returns names."""
+
+    archive_dir = current_app.config['MESSAGE_ARCHIVE_DIR']
+    engines = [('', db.engine)] + [
+        (f"shard{i}-", engine) for i, engine in enumerate(shards.engines)]
+
+    archived = []
+    for prefix, engine in engines:
+        with engine.begin() as conn:
+            archived += [prefix + name for name in archive_partitions(
+                conn, archive_dir, after_months, label_prefix=prefix)]
+            ensure_partitions(conn)
+    return archived
+
+
+@cli.command('index-messages')
+@click.option('--batch-size', default=INDEX_BATCH_ROWS, help="Messages per transaction.")
+def index_messages_command(batch_size):
+    """Index the hashtags and mentions of every stored message."""
+
+    def show(messages, tags, mentions):
+        print(f"\r  {messages} messages: {tags} tags, {mentions} mentions", end="", flush=True)
+
+    messages, tags, mentions = index_messages(batch_size, on_progress=show)
+    print(f"\nindexed {messages} messages")
+
+
+##############################################################################
+# Analytics
+
+
+@cli.command('export-analytics')
+def export_analytics():
+    """Export messages, likes and follows as column files for reports."""
+
+    for name, rows in export_all(current_app.config['ANALYTICS_DIR']).items():
+        print(f"{name}: {rows} rows")
+
+
+@cli.command('engagement-report')
+@click.option('--days', default=30, help="Window for rates and growth.")
+@click.option('--top', 'top_n', default=10, help="Users to list per stat.")
+def engagement_report(days, top_n):
+    """Top users by posting rate, like ratio and follower growth."""
+
+    data = Export(current_app.config['ANALYTICS_DIR'])
+    stats = [
+        ("messages per day", posting_rates(data, days)),
+        ("likes per message", like_ratios(data)),
+        (f"new followers, last {days} days", follower_growth(data, days)[0]),
+    ]
+
+    print(f"export of {data.exported_at}")
+    for title, values in stats:
+        print(f"\n{title}")
+        for user_id, value in top(values, top_n):
+            print(f"  user {user_id:<8} {value:.2f}")
+
+
+##############################################################################
+# Follow graph
+
+
+@cli.command('build-follow-graph')
+def build_follow_graph():
+    """Rebuild the follow graph snapshot from the follows table."""
+
+    edges = follow_graph.build()
+    print(f"follow graph: {edges} edges")
+
+
+@cli.command('recount-follows')
+def recount_follows_command():
+    """Recompute every user's follower and following counts."""
+
+    recount_follows()
+    db.session.commit()
+
+
+@cli.command('recommend')
+@click.option('--all', 'everyone', is_flag=True,
+              help="Recompute every user, not just those whose follows changed.")
+def recommend(everyone):
+    """Precompute "who to follow" suggestions into the cache."""
+
+    refreshed, seconds = refresh_recommendations(stale_only=not everyone)
+    rate = refreshed / seconds if seconds else 0
+    print(f"refreshed {refreshed} users in {seconds:.1f} s ({rate:.0f} users/s)")
+
+
+@cli.command('rebuild-trending')
+@click.option('--hours', default=REBUILD_HOURS, help="History to recount.")
+def rebuild_trending(hours):
+    """Recount trending scores from recent messages and likes."""
+
+    events = trending.rebuild(hours)
+    print(f"trending: {events} events from the last {hours} hours")
+
+
+##############################################################################
+# Account deletion
+
+
+@cli.command('purge-deleted-users')
+@click.option('--batch-size', default=PURGE_BATCH_ROWS, help="Rows per transaction.")
+@click.option('--duty', default=PURGE_DUTY_CYCLE,
+              help="Fraction of the time spent deleting; the rest is pauses.")
+def purge_deleted_users(batch_size, duty):
+    """Purge the rows of accounts marked deleted, in throttled batches."""
+
+    def show(progress):
+        counts = ", ".join(f"{step} {rows}" for step, rows in progress['deleted'].items())
+        print(f"\r  {counts}", end="", flush=True)
+
+    purged = purge_pending(batch_size=batch_size, throttle=Throttle(duty),
+                           on_progress=show)
+    print(f"\npurged {purged} users")
+
+
+##############################################################################
+# Shard maintenance
+
+
+@cli.command('create-shards')
+def create_shards():
+    """Create the message/like tables on every shard."""
+
+    shards.create_tables()
+
+
+@cli.command('move-user')
+@click.argument('user_id', type=int)
+@click.argument('shard', type=int)
+def move_user(user_id, shard):
+    """Move a user's messages and likes to another shard, online."""
+
+    copied = shards.move_user(user_id, shard)
+    print(f"moved user {user_id} to shard {shard} ({copied} rows copied)")
+
+
+##############################################################################
+# Background jobs
+
+
+@queue.job('purge-deleted-users', timeout=60 * 60)
+def purge_deleted_users_job():
+    purge_pending()
+
+
+@queue.job('build-follow-graph')
+def build_follow_graph_job():
+    follow_graph.build()
+
+
+@queue.job('refresh-recommendations', timeout=60 * 60)
+def refresh_recommendations_job(user_ids=None):
+    refresh_recommendations(user_ids)
+
+
+@queue.job('export-analytics', timeout=60 * 60)
+def export_analytics_job():
+    export_all(current_app.config['ANALYTICS_DIR'])
+
+
+@queue.job('archive-messages', max_attempts=3, timeout=6 * 60 * 60)
+def archive_messages_job():
+    archive_all_messages()
+
+
+@queue.job('index-messages', max_attempts=3, timeout=6 * 60 * 60)
+def index_messages_job():
+    index_messages()
+
+
+@queue.job('prune-jobs')
+def prune_jobs_job():
+    queue.prune()
+
+
+@queue.job('prune-notifications')
+def prune_notifications_job():
+    prune_notifications()
+    db.session.commit()
+
+
+queue.periodic('*/10 * * * *', 'purge-deleted-users')
+queue.periodic('0 * * * *', 'build-follow-graph')
+queue.periodic('*/15 * * * *', 'refresh-recommendations')
+queue.periodic('0 3 * * *', 'export-analytics')
+queue.periodic('30 3 * * *', 'archive-messages')
+queue.periodic('0 4 * * *', 'prune-jobs')
+queue.periodic('15 4 * * *', 'prune-notifications')
+
+
+@cli.command('worker')
+@click.option('--threads', default=4, help="Jobs run at once per process.")
+@click.option('--processes', default=1, help="Worker processes to fork.")
+def worker(threads, processes):
+    """Run background and periodic jobs until interrupted."""
+
+    app = current_app._get_current_object()
+
+    def run():
+        # connections must not be shared across fork
+        db.engine.dispose()
+        for engine in shards.engines:
+            engine.dispose()
+        Worker(app, threads=threads).run()
+
+    if processes == 1:
+        run()
+        return
+
+    children = []
+    for i in range(processes):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run()
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    for pid in children:
+        os.waitpid(pid, 0)
+
+
+@bp.route('/jobs/stats')
+@ops_only
+def show_job_stats():
+    """Per-job-type counts, throughput and latency for the last hour, as JSON."""
+
+    return jsonify(queue.stats())
+
+
+##############################################################################
+# Templates
+
+
+@cli.command('precompile-templates')
+def precompile_templates():
+    """Compile every template into the shared bytecode cache."""
+
+    timings = precompile(current_app.jinja_env)
+
+    print(f"{'template':<24} {'compile':>9} {'cached':>9} {'saved':>9}")
+    for name, compile_ms, cached_ms in timings:
+        print(f"{name:<24} {compile_ms:7.2f}ms {cached_ms:7.2f}ms "
+              f"{compile_ms - cached_ms:7.2f}ms")
+
+    total_compile = sum(t[1] for t in timings)
+    total_cached = sum(t[2] for t in timings)
+    print(f"{'total':<24} {total_compile:7.2f}ms {total_cached:7.2f}ms "
+          f"{total_compile - total_cached:7.2f}ms")
+
+
+##############################################################################
+# Health
+
+
+@bp.route('/ready')
+def ready():
+    """200 once this worker can serve pages (the database answers), else 503."""
+
+    try:
+        db.session.execute('SELECT 1')
+    except Exception:
+        current_app.logger.exception("readiness check failed")
+        return jsonify(ready=False, pid=os.getpid()), 503
+    finally:
+        db.session.remove()
+
+    return jsonify(ready=True, pid=os.getpid())
+
+
+##############################################################################
+# Cache stats
+
+
+@bp.route('/cache/stats')
+@ops_only
+def show_cache_stats():
+    """Hit/miss/eviction counters of this worker's cache, as JSON."""
+
+    return jsonify(cache.get_stats())
@@ -0,0 +1,250 @@
+"""Monthly partitions of `messages`, and cold archival of old months.
+
+On Postgres, `flask partition-messages` turns `messages` into a table
+partitioned by month on `timestamp` (the primary key becomes
+(id, timestamp), and likes no longer have a foreign key to it; the app
+deletes likes of deleted messages itself). Partitions for the next
+PARTITION_MONTHS_AHEAD months are created when the app starts and by
+`flask archive-messages`.
+
+`flask archive-messages` detaches every partition older than
+ARCHIVE_AFTER_MONTHS, streams it into compressed column files under
+ARCHIVE_DIR and drops it, so the live table and its indexes only ever hold
+recent months. `find_archived_message` resolves ids that were archived.
+
+Archive layout: one directory per partition, holding chunk files
+(`chunk-00000.npz`, rows sorted by id) and a `manifest.json` at the top
+listing each chunk's id range.
+"""
+
+import json
+import os
+from datetime import date, datetime
+from functools import lru_cache
+
+import numpy as np
+from sqlalchemy import text
+
+from models import Message, User
+
+PARTITION_MONTHS_AHEAD = 3
+ARCHIVE_AFTER_MONTHS = 6
+ARCHIVE_CHUNK_ROWS = 500000
+
+
+def add_months(month, n):
+    """First day of the month `n` months after `month`."""
+
+    index = month.year * 12 + month.month - 1 + n
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"messages_y{month.year}m{month.month:02d}"
+
+
+def is_partitioned(conn):
+    """Is `messages` a partitioned table on this connection's database?"""
+
+    if conn.dialect.name != 'postgresql':
+        return False
+
+    kind = conn.execute(text(
+        "SELECT relkind FROM pg_class WHERE relname = 'messages'")).scalar()
+    return kind == 'p'
+
+
+def create_partition(conn, month):
+    name = partition_name(month)
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF messages "
+        f"FOR VALUES FROM ('{month}') TO ('{add_months(month, 1)}')"))
+
+
+def ensure_partitions(conn, months_ahead=PARTITION_MONTHS_AHEAD, today=None):
+    """Create this month's partition and the next `months_ahead`."""
+
+    if not is_partitioned(conn):
+        return
+
+    this_month = (today or date.today()).replace(day=1)
+    for n in range(months_ahead + 1):
+        create_partition(conn, add_months(this_month, n))
+
+
+def partition_messages(conn):
+    """Convert a plain `messages` table into a partitioned one (Postgres)."""
+
+    if is_partitioned(conn):
+        return
+
+    conn.execute(text("ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_message_id_fkey"))
+    conn.execute(text("ALTER TABLE messages RENAME TO messages_unpartitioned"))
+    conn.execute(text("ALTER TABLE messages_unpartitioned "
+                      "RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey"))
+    conn.execute(text("""
+        CREATE TABLE messages (
+            id BIGINT NOT NULL DEFAULT nextval('messages_id_seq'),
+            text VARCHAR(140) NOT NULL,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            parent_id BIGINT,
+            thread_id BIGINT,
+            path TEXT,
+            reply_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp)"""))
+    conn.execute(text("ALTER SEQUENCE messages_id_seq OWNED BY messages.id"))
+    for name, columns in (('ix_messages_user_id_timestamp', 'user_id, timestamp'),
+                          ('ix_messages_thread_path', 'thread_id, path'),
+                          ('ix_messages_parent_path', 'parent_id, path')):
+        conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        conn.execute(text(f"CREATE INDEX {name} ON messages ({columns})"))
+
+    oldest = conn.execute(text(
+        "SELECT min(timestamp) FROM messages_unpartitioned")).scalar()
+    month = (oldest or datetime.utcnow()).date().replace(day=1)
+    last = add_months(date.today().replace(day=1), PARTITION_MONTHS_AHEAD)
+    while month <= last:
+        create_partition(conn, month)
+        month = add_months(month, 1)
+
+    conn.execute(text("INSERT INTO messages SELECT id, text, timestamp, user_id, parent_id, "
+                      "thread_id, path, reply_count FROM messages_unpartitioned"))
+    conn.execute(text("DROP TABLE messages_unpartitioned"))
+
+
+def partitions(conn):
+    """[(name, first day of month)] of the attached partitions, oldest first."""
+
+    names = [name for (name,) in conn.execute(text("""
+        SELECT child.relname FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = 'messages'"""))]
+
+    found = []
+    for name in names:
+        year, month = name[len('messages_y'):].split('m')
+        found.append((name, date(int(year), int(month), 1)))
+    return sorted(found, key=lambda partition: partition[1])
+
+
+##############################################################################
+# Archive
+
+
+def write_chunk(path, rows):
+    """Write rows of (id, text, timestamp, user_id), sorted by id, as
+    compressed columns."""
+
+    encoded = [row.text.encode() for row in rows]
+    offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+
+    np.savez_compressed(
+        path,
+        id=np.array([row.id for row in rows], dtype=np.int64),
+        user_id=np.array([row.user_id for row in rows], dtype=np.int32),
+        timestamp=np.array([row.timestamp for row in rows], dtype='datetime64[us]'),
+        text=np.frombuffer(b''.join(encoded), dtype=np.uint8),
+        text_offsets=offsets,
+    )
+
+
+def archive_rows(rows, archive_dir, label, chunk_rows=ARCHIVE_CHUNK_ROWS):
+    """Stream `rows` (sorted by id) into chunk files; returns manifest entries."""
+
+    os.makedirs(os.path.join(archive_dir, label), exist_ok=True)
+
+    entries, chunk = [], []
+
+    def flush():
+        path = os.path.join(label, f"chunk-{len(entries):05d}.npz")
+        write_chunk(os.path.join(archive_dir, path), chunk)
+        entries.append({'file': path, 'rows': len(chunk),
+                        'min_id': chunk[0].id, 'max_id': chunk[-1].id})
+        chunk.clear()
+
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_rows:
+            flush()
+    if chunk:
+        flush()
+
+    return entries
+
+
+def read_manifest(archive_dir):
+    try:
+        with open(os.path.join(archive_dir, 'manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def add_to_manifest(archive_dir, entries):
+    manifest = read_manifest(archive_dir) + entries
+    tmp = os.path.join(archive_dir, 'manifest.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, os.path.join(archive_dir, 'manifest.json'))
+    load_chunk.cache_clear()
+
+
+def archive_partitions(conn, archive_dir, after_months=ARCHIVE_AFTER_MONTHS,
+                       label_prefix='', today=None):
+    """Move partitions older than `after_months` into the archive.
+
+    Returns the names of the archived partitions.
+    """
+
+    if not is_partitioned(conn):
+        return []
+
+    cutoff = add_months((today or date.today()).replace(day=1), -after_months)
+    archived = []
+
+    for name, month in partitions(conn):
+        if month >= cutoff:
+            break
+
+        conn.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+        rows = conn.execution_options(stream_results=True).execute(text(
+            f"SELECT id, text, timestamp, user_id FROM {name} ORDER BY id"))
+        entries = archive_rows(rows, archive_dir, label_prefix + name)
+        add_to_manifest(archive_dir, entries)
+        conn.execute(text(f"DROP TABLE {name}"))
+        archived.append(name)
+
+    return archived
+
+
+@lru_cache(maxsize=8)
+def load_chunk(path):
+    with np.load(path) as chunk:
+        return {name: chunk[name] for name in chunk.files}
+
+
+def find_archived_message(archive_dir, message_id):
+    """Rebuild an archived message (not added to the session), or None."""
+
+    for entry in read_manifest(archive_dir):
+        if not entry['min_id'] <= message_id <= entry['max_id']:
+            continue
+
+        chunk = load_chunk(os.path.join(archive_dir, entry['file']))
+        i = int(np.searchsorted(chunk['id'], message_id))
+        if i == len(chunk['id']) or chunk['id'][i] != message_id:
+            continue
+
+        start, end = chunk['text_offsets'][i], chunk['text_offsets'][i + 1]
+        msg = Message(id=message_id,
+                      text=chunk['text'][start:end].tobytes().decode(),
+                      timestamp=chunk['timestamp'][i].astype(datetime),
+                      user_id=int(chunk['user_id'][i]))
+        msg.user = User.query.get(msg.user_id)
+        return msg
+
+    return None
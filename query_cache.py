@@ -0,0 +1,253 @@
+"""Query result cache invalidated by per-table version tokens.
+
+A cached result is stored under the normalized SQL, its parameters and the
+current versions of everything it depends on. Dependencies are either a
+whole table ('users') or one user's partition of a table
+(('messages', user_id)). Writes replace the matching versions with new
+random tokens, so a stale entry is never looked up again; it just ages
+out. Versions share the evictable cache with the results, which is why
+they are tokens, as for fragments: an evicted version gets a new token
+and misses, where a counter starting over could match an old entry.
+
+For 'users', only changes other users' pages show (PUBLIC_USER_COLUMNS,
+new and deleted accounts) replace the whole-table version. Counters such
+as unread_notifications only invalidate that user's own entries.
+
+Versions are replaced twice: on flush, so later reads in the same
+transaction (same request) miss and see the write, and again on
+commit/rollback, so a result another request computed from the
+pre-commit state is never served afterwards.
+
+Routes opt in with @cache_queries; outside of them `cached_all` and
+`cached_scalar` just run the query. Reads served by a replica use entries
+already cached but never add one: the replica may be behind the versions
+the entry would be stored under.
+
+ORM instances are cached as their loaded column values minus
+PRIVATE_COLUMNS (password hashes, emails), since every worker, and with
+shm:// or redis:// every process on the box, can read the cache. Whatever
+else is loaded (relationships) is left out too.
+"""
+
+import hashlib
+from functools import wraps
+
+from flask import g, has_app_context
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import get_history, set_committed_value, PASSIVE_NO_INITIALIZE
+
+from cache import cache
+from fragments import new_version, current_versions
+from models import db, User, Message, Follows, Likes
+
+QUERY_CACHE_TTL = 10 * 60
+
+CACHED_TABLES = ('messages', 'follows', 'likes', 'users')
+
+# never written to the cache; loaded from the database if used
+PRIVATE_COLUMNS = {User: ('password', 'email')}
+
+# users columns shown on other users' pages (follow lists' cards)
+PUBLIC_USER_COLUMNS = ('username', 'image_url', 'header_image_url', 'bio', 'deleted_at')
+
+
+def cache_queries(view):
+    """Let `cached_all`/`cached_scalar` use the cache inside this route."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.cache_queries = True
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def _enabled():
+    return has_app_context() and g.get('cache_queries', False)
+
+
+def _version_keys(depends_on):
+    keys = []
+    for dep in depends_on:
+        if isinstance(dep, tuple):
+            table, user_id = dep
+            keys += [f"qversion:{table}:{user_id}", f"qversion:{table}:bulk"]
+        else:
+            keys.append(f"qversion:{dep}")
+    return keys
+
+
+def _cache_key(query, depends_on):
+    compiled = query.statement.compile(dialect=db.session.get_bind().dialect)
+    sql = " ".join(str(compiled).split())
+    params = sorted(compiled.params.items())
+
+    keys = _version_keys(depends_on)
+    versions = current_versions(keys)
+    vector = [versions[key] for key in keys]
+
+    digest = hashlib.sha1(repr((sql, params, vector)).encode()).hexdigest()
+    return f"query:{digest}"
+
+
+class _Projection:
+    """An ORM instance's cacheable column values."""
+
+    def __init__(self, cls, columns):
+        self.cls, self.columns = cls, columns
+
+
+def _project(value):
+    """What the cache stores for one result value."""
+
+    mapper = getattr(type(value), '__mapper__', None)
+    if mapper is None:
+        return value
+
+    loaded = inspect(value).dict
+    private = PRIVATE_COLUMNS.get(mapper.class_, ())
+    return _Projection(mapper.class_, {
+        attr.key: loaded[attr.key] for attr in mapper.column_attrs
+        if attr.key in loaded and attr.key not in private})
+
+
+def _rebuild(value):
+    """A detached instance from a cached projection."""
+
+    if not isinstance(value, _Projection):
+        return value
+
+    obj = value.cls.__mapper__.class_manager.new_instance()
+    for key, column_value in value.columns.items():
+        set_committed_value(obj, key, column_value)
+    make_transient_to_detached(obj)
+    return obj
+
+
+def cached_all(query, *depends_on):
+    """`query.all()`, served from the cache inside @cache_queries routes.
+
+    ORM instances come back merged into the current session.
+    """
+
+    if not _enabled():
+        return query.all()
+
+    key = _cache_key(query, depends_on)
+    rows = cache.get(key)
+
+    if rows is None and db.session().reads_replicas():
+        # a lagging replica's rows would outlive the lag in the cache
+        return query.all()
+
+    if rows is None:
+        rows = query.all()
+        cache.set(key, [tuple(map(_project, row)) if isinstance(row, tuple) else _project(row)
+                        for row in rows], ttl=QUERY_CACHE_TTL)
+        return rows
+
+    rows = [tuple(map(_rebuild, row)) if isinstance(row, tuple) else _rebuild(row)
+            for row in rows]
+    return list(query.merge_result(rows, load=False))
+
+
+def cached_scalar(query, *depends_on):
+    """`query.scalar()`, served from the cache inside @cache_queries routes."""
+
+    if not _enabled():
+        return query.scalar()
+
+    key = _cache_key(query, depends_on)
+    if db.session().reads_replicas():
+        value = cache.get(key)
+        return query.scalar() if value is None else value
+
+    return cache.get_or_set(key, query.scalar, ttl=QUERY_CACHE_TTL)
+
+
+##############################################################################
+# Invalidation
+
+
+def _keys(table, user_ids, whole_table=True):
+    keys = {f"qversion:{table}"} if whole_table else set()
+    for user_id in user_ids:
+        keys.add(f"qversion:{table}:{user_id}" if user_id else
+                 f"qversion:{table}:bulk")
+    return keys
+
+
+def _touched(session):
+    """Version keys made stale by the pending changes in `session`."""
+
+    keys = set()
+
+    def touch(table, *user_ids, whole_table=True):
+        keys.update(_keys(table, user_ids, whole_table))
+
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Message):
+            touch('messages', obj.user_id)
+        elif isinstance(obj, Likes):
+            touch('likes', obj.user_id)
+        elif isinstance(obj, Follows):
+            touch('follows', obj.user_following_id, obj.user_being_followed_id)
+        elif isinstance(obj, User):
+            public = (obj in session.new or obj in session.deleted
+                      or any(get_history(obj, column, PASSIVE_NO_INITIALIZE).has_changes()
+                             for column in PUBLIC_USER_COLUMNS))
+            touch('users', obj.id, whole_table=public)
+
+            # rows written through relationship collections
+            for attr, table in (('following', 'follows'),
+                                ('followers', 'follows'),
+                                ('likes', 'likes')):
+                added, _, removed = get_history(obj, attr, PASSIVE_NO_INITIALIZE)
+                if added or removed:
+                    touch(table, obj.id)
+                    if table == 'follows':
+                        touch(table, *[other.id for other in added + removed])
+
+    return keys
+
+
+def _bump(session, keys):
+    for key in keys:
+        new_version(key)
+    session.info.setdefault('query_cache_stale', set()).update(keys)
+
+
+def mark_stale(session, table, *user_ids):
+    """Invalidate like a flush would, for writes made with plain SQL
+    statements in `session` (which the ORM doesn't see).
+
+    Plain-SQL writes to users only change counters, so they leave the
+    whole-table 'users' version alone.
+    """
+
+    _bump(session, _keys(table, user_ids, whole_table=table != 'users'))
+
+
+@event.listens_for(db.session, 'after_flush')
+def bump_on_flush(session, flush_context):
+    _bump(session, _touched(session))
+
+
+@event.listens_for(db.session, 'after_bulk_delete')
+@event.listens_for(db.session, 'after_bulk_update')
+def bump_on_bulk(update_context):
+    table = update_context.mapper.local_table.name
+    if table in CACHED_TABLES:
+        keys = {f"qversion:{table}", f"qversion:{table}:bulk"}
+        for key in keys:
+            new_version(key)
+        update_context.session.info.setdefault(
+            'query_cache_stale', set()).update(keys)
+
+
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_soft_rollback')
+def bump_on_end(session, *args):
+    for key in session.info.pop('query_cache_stale', ()):
+        new_version(key)
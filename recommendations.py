@@ -0,0 +1,225 @@
+""""Who to follow" suggestions computed from the follow graph.
+
+A candidate's score for a user adds up:
+
+- friends of friends: accounts followed by the people the user follows,
+  each path weighted down by how many accounts the middle person follows
+  (following a famous account from someone who follows everyone means
+  little);
+- shared audience: how many of the user's followers follow the candidate;
+- recent activity: log(1 + messages in the last ACTIVITY_DAYS days).
+
+Everything but activity comes from follow_graph's arrays, a handful of
+vectorized numpy operations per user. `flask recommend` precomputes the
+suggestions into the cache in batches, and on later runs only refreshes
+users whose follows changed since (the query cache's per-user `follows`
+version). A user whose entry is out of date is shown it anyway while a
+`refresh-recommendations` job recomputes it; one without any entry gets
+one computed on the spot.
+"""
+
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select, func
+
+from cache import cache
+from export import sources
+from follow_graph import follow_graph
+from fragments import current_versions
+from jobs import queue
+from models import db, User
+
+RECOMMENDATION_TTL = 24 * 60 * 60
+RECOMMENDATIONS_PER_USER = 20
+REC_BATCH_USERS = 1000
+
+ACTIVITY_DAYS = 14
+
+# at most this many followees / followers are walked per user, so hub
+# accounts don't make a single user cost seconds
+MAX_NEIGHBOURS = 500
+
+W_FRIENDS_OF_FRIENDS = 1.0
+W_SHARED_AUDIENCE = 0.5
+W_ACTIVITY = 0.25
+
+EMPTY = np.zeros(0, dtype=np.int64)
+
+
+def _key(user_id):
+    return f"recs:{user_id}"
+
+
+def _version_key(user_id):
+    return f"qversion:follows:{user_id}"
+
+
+def post_counts(user_ids=None, days=ACTIVITY_DAYS):
+    """{user_id: messages in the last `days` days}, for `user_ids` or everyone."""
+
+    since = datetime.utcnow() - timedelta(days=days)
+    counts = {}
+
+    for engine, table in sources('messages'):
+        query = (select([table.c.user_id, func.count()])
+                 .where(table.c.timestamp >= since)
+                 .group_by(table.c.user_id))
+        if user_ids is not None:
+            query = query.where(table.c.user_id.in_([int(u) for u in user_ids]))
+
+        with engine.connect() as conn:
+            for user_id, count in conn.execute(query):
+                counts[user_id] = counts.get(user_id, 0) + count
+
+    return counts
+
+
+def _recent_posts(ids):
+    counts = post_counts(ids)
+    return np.array([counts.get(int(i), 0) for i in ids], dtype=np.int64)
+
+
+def activity_array(counts, size):
+    posts = np.zeros(size, dtype=np.int64)
+    for user_id, count in counts.items():
+        if user_id < size:
+            posts[user_id] = count
+    return posts
+
+
+def _sample(ids, user_id):
+    """At most MAX_NEIGHBOURS of `ids`, the same ones for the same user."""
+
+    if len(ids) <= MAX_NEIGHBOURS:
+        return ids
+    rng = np.random.RandomState(user_id)
+    return np.sort(rng.choice(ids, MAX_NEIGHBOURS, replace=False))
+
+
+def _walk(graph, middle):
+    """(accounts followed by the `middle` users, which middle user each came from)."""
+
+    rows = [graph.following(int(user)) for user in middle]
+    if not rows:
+        return EMPTY, EMPTY
+    lengths = np.array([len(row) for row in rows])
+    return np.concatenate(rows), np.repeat(np.arange(len(rows)), lengths)
+
+
+def score(graph, user_id, posts_for, limit=RECOMMENDATIONS_PER_USER):
+    """[(candidate_id, score)] for `user_id`, best first.
+
+    `posts_for(ids)` returns recent message counts for an array of ids.
+    """
+
+    following = graph.following(user_id)
+
+    middle = _sample(following, user_id)
+    friends_of_friends, via = _walk(graph, middle)
+    middle_out = np.array([graph.following_count(int(user)) for user in middle])
+    path_weights = (1 / np.log2(2 + middle_out))[via] if len(via) else EMPTY
+
+    audience, _ = _walk(graph, _sample(graph.followers(user_id), user_id))
+
+    candidates, inverse = np.unique(
+        np.concatenate([friends_of_friends, audience]), return_inverse=True)
+    if not len(candidates):
+        return []
+
+    split = len(friends_of_friends)
+    fof_score = np.bincount(inverse[:split], weights=path_weights,
+                            minlength=len(candidates))
+    shared_audience = np.bincount(inverse[split:], minlength=len(candidates))
+
+    keep = ~np.isin(candidates, following) & (candidates != user_id)
+    candidates = candidates[keep]
+    if not len(candidates):
+        return []
+
+    scores = (W_FRIENDS_OF_FRIENDS * fof_score[keep]
+              + W_SHARED_AUDIENCE * shared_audience[keep]
+              + W_ACTIVITY * np.log1p(posts_for(candidates)))
+
+    best = np.argsort(-scores, kind='stable')[:limit]
+    return [(int(candidates[i]), float(scores[i])) for i in best]
+
+
+def _store(user_id, version, scored):
+    cache.set(_key(user_id),
+              {'version': version, 'ids': [candidate for candidate, s in scored]},
+              ttl=RECOMMENDATION_TTL)
+
+
+def refresh(user_ids=None, stale_only=True, batch_size=REC_BATCH_USERS):
+    """Precompute suggestions for `user_ids` (default: everyone).
+
+    With `stale_only`, users whose cached suggestions were computed from
+    their current follows are skipped. Returns (users refreshed, seconds).
+    """
+
+    start = time.perf_counter()
+
+    follow_graph.ensure_snapshot()
+    graph = follow_graph.graph()
+
+    if user_ids is None:
+        user_ids = [user_id for (user_id,) in
+                    db.session.query(User.id)
+                    .filter(User.deleted_at.is_(None)).order_by(User.id)]
+        posts = activity_array(post_counts(), graph.num_nodes)
+
+        def posts_for(ids):
+            return posts[np.minimum(ids, len(posts) - 1)] * (ids < len(posts))
+    else:
+        # a few users: count only their candidates' messages
+        posts_for = _recent_posts
+
+    refreshed = 0
+    for i in range(0, len(user_ids), batch_size):
+        batch = user_ids[i:i + batch_size]
+        versions = current_versions([_version_key(user_id) for user_id in batch])
+
+        if stale_only:
+            entries = cache.get_many([_key(user_id) for user_id in batch])
+            batch = [user_id for user_id in batch
+                     if _key(user_id) not in entries
+                     or entries[_key(user_id)]['version']
+                     != versions[_version_key(user_id)]]
+
+        for user_id in batch:
+            _store(user_id, versions[_version_key(user_id)],
+                   score(graph, user_id, posts_for))
+        refreshed += len(batch)
+
+    return refreshed, time.perf_counter() - start
+
+
+def recommendations_for(user_id, limit=5):
+    """Up to `limit` suggested users for `user_id`, from the cache.
+
+    An out-of-date entry is still served, and a job queued to recompute
+    it; only a user without one waits for the scoring.
+    """
+
+    version = current_versions([_version_key(user_id)])[_version_key(user_id)]
+    entry = cache.get(_key(user_id))
+
+    if entry is None:
+        scored = score(follow_graph.graph(), user_id, _recent_posts)
+        _store(user_id, version, scored)
+        ids = [candidate for candidate, s in scored]
+    else:
+        if entry['version'] != version:
+            queue.enqueue('refresh-recommendations', [user_id],
+                          dedupe_key=f"refresh-recommendations:{user_id}")
+        ids = entry['ids']
+
+    if not ids:
+        return []
+
+    # suggestions may name users deleted (or soft-deleted) since
+    users = {user.id: user for user in
+             User.query.filter(User.id.in_(ids), User.deleted_at.is_(None))}
+    return [users[i] for i in ids if i in users][:limit]
@@ -0,0 +1,166 @@
+"""Tiny Redis-protocol server for development and tests.
+
+Implements just the commands `cache.RedisCache` uses, in memory:
+
+    python resp_standin.py --port 6380
+
+then run the app with CACHE_URL=redis://localhost:6380/0.
+"""
+
+import argparse
+import socketserver
+import threading
+import time
+
+
+class RespStandIn(socketserver.ThreadingTCPServer):
+    """Threaded TCP server holding one dict per logical database."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, RespHandler)
+        self.dbs = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Serve from a background thread; returns the (host, port)."""
+
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self.server_address
+
+
+class RespHandler(socketserver.StreamRequestHandler):
+    """One client connection."""
+
+    def handle(self):
+        self.db = 0
+
+        while True:
+            try:
+                args = self.read_command()
+            except (ConnectionError, ValueError):
+                return
+            if args is None:
+                return
+
+            try:
+                reply = self.dispatch(args)
+            except Exception as e:
+                reply = ('-', f"ERR {e}")
+            self.wfile.write(encode(reply))
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if line[:1] != b'*':
+            return line.split()
+
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def data(self):
+        return self.server.dbs.setdefault(self.db, {})
+
+    def lookup(self, key):
+        entry = self.data().get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at and expires_at < time.time():
+            del self.data()[key]
+            return None
+        return value
+
+    def dispatch(self, args):
+        name = args[0].upper().decode()
+
+        with self.server.lock:
+            if name == 'PING':
+                return ('+', 'PONG')
+
+            if name == 'SELECT':
+                self.db = int(args[1])
+                return ('+', 'OK')
+
+            if name == 'GET':
+                return self.lookup(args[1])
+
+            if name == 'MGET':
+                return [self.lookup(key) for key in args[1:]]
+
+            if name == 'SET':
+                key, value, options = args[1], args[2], args[3:]
+                expires_at = 0
+                only_if_absent = False
+                i = 0
+                while i < len(options):
+                    option = options[i].upper()
+                    if option == b'NX':
+                        only_if_absent = True
+                    elif option == b'PX':
+                        i += 1
+                        expires_at = time.time() + int(options[i]) / 1000
+                    elif option == b'EX':
+                        i += 1
+                        expires_at = time.time() + int(options[i])
+                    i += 1
+
+                if only_if_absent and self.lookup(key) is not None:
+                    return None
+                self.data()[key] = (value, expires_at)
+                return ('+', 'OK')
+
+            if name == 'DEL':
+                removed = 0
+                for key in args[1:]:
+                    if self.lookup(key) is not None:
+                        del self.data()[key]
+                        removed += 1
+                return removed
+
+            if name in ('INCR', 'INCRBY'):
+                key = args[1]
+                delta = int(args[2]) if name == 'INCRBY' else 1
+                entry = self.data().get(key)
+                expires_at = entry[1] if entry else 0
+                value = int(self.lookup(key) or 0) + delta
+                self.data()[key] = (str(value).encode(), expires_at)
+                return value
+
+            if name == 'FLUSHDB':
+                self.data().clear()
+                return ('+', 'OK')
+
+        raise ValueError(f"unknown command '{name}'")
+
+
+def encode(reply):
+    """Encode a Python value as a RESP reply."""
+
+    if reply is None:
+        return b'$-1\r\n'
+    if isinstance(reply, tuple):
+        kind, text = reply
+        return f"{kind}{text}\r\n".encode()
+    if isinstance(reply, int):
+        return b':%d\r\n' % reply
+    if isinstance(reply, list):
+        return b'*%d\r\n' % len(reply) + b''.join(encode(item) for item in reply)
+    return b'$%d\r\n%s\r\n' % (len(reply), reply)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6380)
+    args = parser.parse_args()
+
+    server = RespStandIn((args.host, args.port))
+    print(f"RESP stand-in listening on {args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,180 @@
+"""Read-replica routing for the Flask-SQLAlchemy session.
+
+Replicas are listed in SQLALCHEMY_REPLICA_URIS and registered as the binds
+replica_0, replica_1, ... A session sends its queries to a replica only
+when all of these hold:
+
+- it is serving a GET/HEAD request,
+- it has not written anything yet (after a write, everything goes to the
+  primary until the session is removed at the end of the request),
+- the browser has not committed a write in the last
+  READ_YOUR_WRITES_SECONDS (so users always see their own changes),
+- some replica passed its last health check.
+
+Replicas are used round-robin, one per session: every read of a request
+goes to the replica its first read picked, so a count and a list can't
+come from two replicas at different replication positions. Each one is
+re-checked with `SELECT 1` at most every REPLICA_HEALTH_CHECK_SECONDS;
+one that fails is skipped until a later check succeeds.
+
+A replica can lag, so results read from one are never written to the
+query cache (see `RoutingSession.reads_replicas`).
+"""
+
+import itertools
+import threading
+import time
+
+from flask import has_request_context, request, session as flask_session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.sql.dml import UpdateBase
+
+READ_YOUR_WRITES_KEY = '_read_your_writes_until'
+
+
+class ReplicaSet:
+    """Round-robin over the healthy replicas of one app."""
+
+    def __init__(self, db, app, bind_keys, check_interval):
+        self.db = db
+        self.app = app
+        self.bind_keys = bind_keys
+        self.check_interval = check_interval
+        self.healthy = {key: True for key in bind_keys}
+        self.checked_at = {key: 0 for key in bind_keys}
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    def engine(self, bind_key):
+        return self.db.get_engine(self.app, bind=bind_key)
+
+    def check(self, bind_key):
+        """Probe one replica and record whether it answered."""
+
+        try:
+            with self.engine(bind_key).connect() as conn:
+                conn.execute('SELECT 1')
+            healthy = True
+        except Exception:
+            healthy = False
+
+        self.healthy[bind_key] = healthy
+        self.checked_at[bind_key] = time.time()
+        return healthy
+
+    def is_healthy(self, bind_key):
+        if time.time() - self.checked_at[bind_key] > self.check_interval:
+            with self._lock:
+                if time.time() - self.checked_at[bind_key] > self.check_interval:
+                    self.check(bind_key)
+        return self.healthy[bind_key]
+
+    def pick(self):
+        """Engine of the next healthy replica, or None if there isn't one."""
+
+        start = next(self._turn)
+        for i in range(len(self.bind_keys)):
+            bind_key = self.bind_keys[(start + i) % len(self.bind_keys)]
+            if self.is_healthy(bind_key):
+                return self.engine(bind_key)
+        return None
+
+
+def wants_replica():
+    """Can the current request be served from a replica?"""
+
+    return (has_request_context()
+            and request.method in ('GET', 'HEAD')
+            and flask_session.get(READ_YOUR_WRITES_KEY, 0) < time.time())
+
+
+class RoutingSession(SignallingSession):
+    """Session that reads from replicas and writes to the primary."""
+
+    def reads_replicas(self):
+        """May this session's queries be served by a replica right now?"""
+
+        return bool(self.app.extensions.get('replicas')
+                    and not self.info.get('wrote')
+                    and wants_replica())
+
+    def get_bind(self, mapper=None, clause=None):
+        if (not self._flushing
+                and not self._has_bind_key(mapper)
+                and self.reads_replicas()):
+            engine = self.info.get('replica')
+            if engine is None:
+                engine = self.info['replica'] = self.app.extensions['replicas'].pick()
+            if engine is not None:
+                return engine
+
+        return super().get_bind(mapper, clause)
+
+    def execute(self, clause, *args, **kwargs):
+        # INSERT/UPDATE/DELETE statements write as much as a flush does
+        if isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+        return super().execute(clause, *args, **kwargs)
+
+    @staticmethod
+    def _has_bind_key(mapper):
+        if mapper is None:
+            return False
+        table = getattr(mapper, 'persist_selectable', None)
+        if table is None:
+            table = mapper.mapped_table
+        return table.info.get('bind_key') is not None
+
+
+def stick_to_primary(session, flush_context, instances):
+    if session.new or session.dirty or session.deleted:
+        session.info['wrote'] = True
+
+
+def open_read_your_writes_window(session):
+    if session.info.get('wrote') and has_request_context():
+        window = session.app.config['READ_YOUR_WRITES_SECONDS']
+        flask_session[READ_YOUR_WRITES_KEY] = time.time() + window
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy extension whose sessions route reads to replicas."""
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+        app.config.setdefault('READ_YOUR_WRITES_SECONDS', 5)
+        app.config.setdefault('REPLICA_HEALTH_CHECK_SECONDS', 5)
+        super().init_app(app)
+        self.configure_replicas(app, app.config['SQLALCHEMY_REPLICA_URIS'])
+
+    def configure_replicas(self, app, uris):
+        """(Re)point the app's replica binds at `uris`."""
+
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        for key in [key for key in binds if key.startswith('replica_')]:
+            del binds[key]
+
+        bind_keys = []
+        for i, uri in enumerate(uris):
+            bind_keys.append(f"replica_{i}")
+            binds[f"replica_{i}"] = uri
+
+        app.config['SQLALCHEMY_BINDS'] = binds
+        app.config['SQLALCHEMY_REPLICA_URIS'] = list(uris)
+
+        # forget engines of replicas that were replaced
+        connectors = get_state(app).connectors
+        for key in [key for key in connectors if str(key).startswith('replica_')]:
+            del connectors[key]
+
+        app.extensions['replicas'] = (
+            ReplicaSet(self, app, bind_keys,
+                       app.config['REPLICA_HEALTH_CHECK_SECONDS'])
+            if bind_keys else None)
+
+    def create_session(self, options):
+        factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        event.listen(factory, 'before_flush', stick_to_primary)
+        event.listen(factory, 'after_commit', open_read_your_writes_window)
+        return factory
@@ -1,8 +1,10 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
-from app import db
-from models import User, Message, Follows
+from app import app  # noqa: F401 (connects the database)
+from models import db, User, Message, Follows
+from follows import recount_follows
+from tags import index_messages
 
 
 db.drop_all()
@@ -17,4 +19,9 @@ with open('generator/messages.csv') as messages:
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
+recount_follows()
+
 db.session.commit()
+
+# bulk inserts skip the hashtag and mention index
+index_messages()
@@ -0,0 +1,310 @@
+"""Production server: a preloading master process and forked workers.
+
+    python serve.py [--bind 0.0.0.0:8000] [--workers N] [--max-requests 10000]
+
+The master builds the app with create_app(), then loads what workers only
+read (compiled templates, the follow graph snapshot, the trending sketch),
+closes its database connections and freezes the garbage collector's view
+of all that, so the forked workers share those pages copy-on-write. Each
+worker serves one request at a time from the shared listening socket.
+
+- A worker exits after --max-requests requests (plus up to
+  --max-requests-jitter, so they don't all go at once) and is replaced,
+  which caps how much memory a leak can grow to.
+- SIGHUP reloads gracefully: the master re-executes itself (new code, new
+  app) on the same socket, keeping its pid, while the old workers go on
+  serving. Once the new master has preloaded and started its workers,
+  the old ones finish their current request and exit.
+- SIGTERM / SIGINT stop the workers the same way, then the master exits.
+
+More than one worker needs a cache they share: CACHE_URL shm:// or
+redis://, not the per-process lru:// default.
+
+Load balancers should poll /ready (see ops.py).
+"""
+
+import argparse
+import gc
+import logging
+import os
+import random
+import signal
+import socket
+import sys
+import time
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+LISTEN_FD_ENV = 'WARBLER_LISTEN_FD'
+# the pids of the workers a reload leaves running, for the new master
+RETIRING_ENV = 'WARBLER_RETIRING_WORKERS'
+
+MAX_REQUESTS = 10000
+MAX_REQUESTS_JITTER = 1000
+GRACEFUL_TIMEOUT = 30
+LISTEN_BACKLOG = 2048
+
+# how often idle workers and the master look at their flags
+POLL_SECONDS = 0.5
+
+log = logging.getLogger('serve')
+
+
+def listen(bind):
+    """The listening socket: inherited across a reload, else a new one."""
+
+    if LISTEN_FD_ENV in os.environ:
+        listener = socket.socket(fileno=int(os.environ.pop(LISTEN_FD_ENV)))
+    else:
+        host, port = bind.rsplit(':', 1)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, int(port)))
+        listener.listen(LISTEN_BACKLOG)
+
+    # idle workers all wait on it; the ones that lose the race for a
+    # connection get EAGAIN instead of blocking in accept()
+    listener.setblocking(False)
+    return listener
+
+
+def preload(app):
+    """Load, in the master, everything workers only read."""
+
+    from follow_graph import follow_graph
+    from models import db
+    from sharding import shards
+    from trending import trending
+
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+    with app.app_context():
+        # built here, not by the first request a worker serves
+        follow_graph.ensure_snapshot()
+        follow_graph.graph()
+        trending.sketch()
+
+        # connections must not be shared across fork
+        db.engine.dispose()
+        for engine in shards.engines:
+            engine.dispose()
+
+    gc.collect()
+    # keep the collector from writing to (and so copying) preloaded pages
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class Worker:
+    """Serves requests from the shared socket until told to stop or done."""
+
+    def __init__(self, app, listener, max_requests, access_log=False):
+        self.app = app
+        self.listener = listener
+        self.max_requests = max_requests
+        self.handler = WSGIRequestHandler if access_log else QuietRequestHandler
+        self.served = 0
+        self.stopping = False
+
+    def count(self, environ, start_response):
+        self.served += 1
+        return self.app(environ, start_response)
+
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        random.seed()
+
+        host = self.listener.getsockname()[0]
+        server = make_server(host, 0, self.count, request_handler=self.handler,
+                             fd=self.listener.fileno())
+        server.timeout = POLL_SECONDS
+
+        # a master that dies (say, a reload into code that doesn't start)
+        # must not leave its workers holding the socket
+        master = os.getppid()
+        while (not self.stopping and self.served < self.max_requests
+               and os.getppid() == master):
+            server.handle_request()
+
+        server.server_close()
+
+        from like_buffer import like_buffer
+        # this worker's unwritten like toggles
+        like_buffer.close()
+
+
+class Master:
+    """Forks and replaces workers; handles reload and shutdown signals."""
+
+    def __init__(self, app, listener, workers, max_requests=MAX_REQUESTS,
+                 max_requests_jitter=MAX_REQUESTS_JITTER,
+                 graceful_timeout=GRACEFUL_TIMEOUT, access_log=False, retiring=()):
+        self.app = app
+        self.listener = listener
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.graceful_timeout = graceful_timeout
+        self.access_log = access_log
+        self.children = set()
+        # the previous master's workers, still ours to reap after the exec
+        self.retiring = set(retiring)
+        self.stopping = False
+        self.reloading = False
+
+    def spawn(self):
+        max_requests = self.max_requests + random.randint(0, self.max_requests_jitter)
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                Worker(self.app, self.listener, max_requests, self.access_log).run()
+            except Exception:
+                log.exception("worker %s crashed", os.getpid())
+                code = 1
+            finally:
+                os._exit(code)
+
+        self.children.add(pid)
+        log.info("started worker %s", pid)
+
+    def reap(self):
+        """Forget exited workers; returns how many current ones there were."""
+
+        exited = 0
+        while self.children or self.retiring:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                # a retiring pid that had already been reaped
+                self.retiring.clear()
+                break
+            if pid == 0:
+                break
+            if pid in self.children:
+                self.children.discard(pid)
+                exited += 1
+            else:
+                self.retiring.discard(pid)
+        return exited
+
+    def retire(self):
+        """Ask the previous generation's workers to finish and exit."""
+
+        for pid in self.retiring:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        return time.time() + self.graceful_timeout
+
+    def kill(self, pids):
+        for pid in pids:
+            log.warning("killing worker %s", pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def stop_workers(self):
+        """Let every worker finish its request and exit; kill stragglers."""
+
+        self.retiring |= self.children
+        self.children = set()
+        deadline = self.retire()
+        while self.retiring and time.time() < deadline:
+            self.reap()
+            time.sleep(0.05)
+
+        self.kill(self.retiring)
+        while self.retiring:
+            try:
+                self.retiring.discard(os.waitpid(-1, 0)[0])
+            except ChildProcessError:
+                break
+
+    def run(self):
+        def stop(signum, frame):
+            self.stopping = True
+
+        def reload(signum, frame):
+            self.reloading = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, reload)
+
+        for _ in range(self.workers):
+            self.spawn()
+        # the new workers are serving, so the old ones can go
+        retire_by = self.retire()
+
+        while not (self.stopping or self.reloading):
+            for _ in range(self.reap()):
+                if not (self.stopping or self.reloading):
+                    self.spawn()
+            if self.retiring and time.time() > retire_by:
+                self.kill(self.retiring)
+                retire_by = float('inf')
+            time.sleep(POLL_SECONDS)
+
+        if self.reloading:
+            self.reexec()
+        self.stop_workers()
+
+    def reexec(self):
+        """Replace this process with a fresh master on the same socket; the
+        workers keep serving until it has started its own."""
+
+        log.info("reloading")
+        fd = self.listener.fileno()
+        os.set_inheritable(fd, True)
+        os.environ[LISTEN_FD_ENV] = str(fd)
+        os.environ[RETIRING_ENV] = ','.join(
+            str(pid) for pid in self.children | self.retiring)
+        os.execv(sys.executable, [sys.executable, os.path.abspath(__file__)] + sys.argv[1:])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bind', default='0.0.0.0:8000', help="host:port to listen on")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--max-requests', type=int, default=MAX_REQUESTS)
+    parser.add_argument('--max-requests-jitter', type=int, default=MAX_REQUESTS_JITTER)
+    parser.add_argument('--graceful-timeout', type=float, default=GRACEFUL_TIMEOUT)
+    parser.add_argument('--access-log', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format="[%(asctime)s] [%(process)d] %(message)s")
+
+    from app import create_app
+
+    retiring = [int(pid) for pid in os.environ.pop(RETIRING_ENV, '').split(',') if pid]
+    listener = listen(args.bind)
+    app = create_app()
+    if args.workers > 1 and app.config['CACHE_URL'].startswith('lru://'):
+        # each worker would cache (and invalidate) on its own, serving
+        # what another worker's writes made stale
+        parser.error("more than one worker needs a shared cache: "
+                     "set CACHE_URL to shm:///path or redis://host:port/db")
+    preload(app)
+    log.info("listening on %s:%s", *listener.getsockname()[:2])
+
+    Master(app, listener, args.workers, args.max_requests, args.max_requests_jitter,
+           args.graceful_timeout, args.access_log, retiring).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,775 @@
+"""Horizontal sharding of messages and likes by user_id.
+
+SHARD_URIS lists the shard databases. A user's messages and likes live on
+shard `user_id % len(SHARD_URIS)` unless the shard_directory table on the
+primary says otherwise (after `move_user`). Users, follows and the
+directory stay on the primary.
+
+Sharded rows get ids that are unique across shards,
+`sequence * SHARD_SLOTS + shard`, so a message id also says which shard
+created it and single-message lookups go straight there.
+
+With no SHARD_URIS everything stays on the primary and the helpers below
+are plain queries on db.session, so routes call them either way.
+"""
+
+import heapq
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from itertools import islice
+
+from sqlalchemy import (create_engine, select, func, and_, or_, tuple_, Column, Index,
+                        Integer, MetaData, Sequence, Table, UniqueConstraint)
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import sessionmaker
+
+from cache import cache
+from models import db, Message, Likes, ShardDirectory
+from query_cache import cached_all, cached_scalar, mark_stale
+from threads import THREAD_BRANCHES, reply_fields, branch_paths, subtree, branches_query, thread_rows
+
+SHARD_SLOTS = 1024
+
+# readers cache directory entries this long, so a moved user's old rows
+# are kept until every worker has seen the new location
+DIRECTORY_TTL = 60
+
+# writers check the directory right before writing; after freezing a user
+# the mover waits this long for writes already past the check to land
+FREEZE_GRACE_SECONDS = 2
+FROZEN_WAIT_SECONDS = 5
+
+# rows per multi-row like insert or delete (SQLite allows 999 parameters)
+LIKE_BATCH_ROWS = 200
+
+
+def _chunks(rows, size):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def insert_ignoring_duplicates(session, table):
+    """An INSERT into `table` that skips rows already there."""
+
+    if session.get_bind().dialect.name == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    return table.insert().prefix_with('OR IGNORE')
+
+
+class ShardBusy(Exception):
+    """The user's rows are being moved; retry the write shortly."""
+
+
+shard_metadata = MetaData()
+
+
+def _shard_table(table):
+    """Copy of `table` for the shards: same columns, unique constraints
+    and indexes, no foreign keys."""
+
+    copy = Table(table.name, shard_metadata, *[
+        Column(column.name, column.type, primary_key=column.primary_key,
+               nullable=column.nullable, autoincrement=False)
+        for column in table.columns])
+
+    # includes those from unique=True columns
+    for constraint in table.constraints:
+        if isinstance(constraint, UniqueConstraint):
+            copy.append_constraint(UniqueConstraint(
+                *[column.name for column in constraint.columns],
+                name=constraint.name))
+
+    for index in table.indexes:
+        Index(index.name, *[copy.c[column.name] for column in index.columns],
+              unique=index.unique)
+
+    return copy
+
+
+shard_messages = _shard_table(Message.__table__)
+shard_likes = _shard_table(Likes.__table__)
+
+# id source on databases without sequences (SQLite)
+shard_ids = Table('shard_ids', shard_metadata,
+                  Column('id', Integer, primary_key=True),
+                  sqlite_autoincrement=True)
+id_sequence = Sequence('shard_id_seq', metadata=shard_metadata)
+
+
+class ShardRouter:
+    """Routes message/like reads and writes to the owning shard."""
+
+    def __init__(self):
+        self.engines = []
+        self.sessions = []
+        self._pool = None
+
+    @property
+    def enabled(self):
+        return bool(self.engines)
+
+    def configure(self, uris):
+        """Use the databases at `uris` as shards (none: no sharding)."""
+
+        for engine in self.engines:
+            engine.dispose()
+
+        self.engines = [create_engine(uri) for uri in uris]
+        self.sessions = [sessionmaker(bind=engine, expire_on_commit=False)
+                         for engine in self.engines]
+        self._pool = (ThreadPoolExecutor(max_workers=len(uris),
+                                         thread_name_prefix='shard')
+                      if uris else None)
+
+    def create_tables(self):
+        for engine in self.engines:
+            shard_metadata.create_all(engine)
+
+    def drop_tables(self):
+        for engine in self.engines:
+            shard_metadata.drop_all(engine)
+
+    ##########################################################################
+    # Directory
+
+    def home_shard(self, user_id):
+        return user_id % len(self.engines)
+
+    def _directory_key(self, user_id):
+        return f"shard:user:{user_id}"
+
+    def _lookup(self, user_id):
+        entry = db.session.query(ShardDirectory).populate_existing().get(user_id)
+        if entry is None:
+            return self.home_shard(user_id), False
+        return entry.shard, entry.frozen
+
+    def shard_for(self, user_id):
+        """Shard holding `user_id`'s rows, for reads (cached)."""
+
+        key = self._directory_key(user_id)
+        shard = cache.get(key)
+        if shard is None:
+            shard = self._lookup(user_id)[0]
+            cache.set(key, shard, ttl=DIRECTORY_TTL)
+        return shard
+
+    def _write_shard(self, user_id):
+        """Shard to write `user_id`'s rows to, read fresh from the primary."""
+
+        deadline = time.time() + FROZEN_WAIT_SECONDS
+        while True:
+            shard, frozen = self._lookup(user_id)
+            if not frozen:
+                return shard
+            if time.time() > deadline:
+                raise ShardBusy(user_id)
+            time.sleep(0.05)
+
+    def _set_directory(self, user_id, shard, frozen):
+        entry = ShardDirectory.query.get(user_id)
+        if shard == self.home_shard(user_id) and not frozen:
+            if entry is not None:
+                db.session.delete(entry)
+        elif entry is None:
+            db.session.add(ShardDirectory(user_id=user_id, shard=shard,
+                                          frozen=frozen))
+        else:
+            entry.shard, entry.frozen = shard, frozen
+
+        db.session.commit()
+        cache.delete(self._directory_key(user_id))
+
+    ##########################################################################
+    # Plumbing
+
+    def _next_id(self, session, shard):
+        conn = session.connection()
+        if conn.dialect.supports_sequences:
+            seq = conn.execute(id_sequence)
+        else:
+            seq = conn.execute(shard_ids.insert()).inserted_primary_key[0]
+            conn.execute(shard_ids.delete().where(shard_ids.c.id < seq))
+        return seq * SHARD_SLOTS + shard
+
+    def _fetch(self, shard, build):
+        """Run the query `build(session)` on one shard; detached results."""
+
+        session = self.sessions[shard]()
+        try:
+            rows = build(session).all()
+            session.expunge_all()
+            return rows
+        finally:
+            session.close()
+
+    def _scatter(self, jobs):
+        """Run [(shard, build)] concurrently; list of result lists."""
+
+        if len(jobs) == 1:
+            return [self._fetch(*jobs[0])]
+        return list(self._pool.map(lambda job: self._fetch(*job), jobs))
+
+    def _attach(self, rows):
+        """Bring shard rows into db.session so relationships load from the
+        primary (msg.user, ...)."""
+
+        return [db.session.merge(row, load=False) for row in rows]
+
+    def _write(self, user_id, work):
+        """Run `work(session, shard)` in a transaction on the user's shard."""
+
+        shard = self._write_shard(user_id)
+        session = self.sessions[shard]()
+        try:
+            result = work(session, shard)
+            session.commit()
+            return result
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    ##########################################################################
+    # Messages
+
+    def messages_for(self, user_ids, limit=100, before=None, after=None):
+        """Newest `limit` messages by any of `user_ids`, newest first.
+
+        `before` / `after` are the (timestamp, id) of a message; only older /
+        newer messages are returned. Each shard returns its own newest
+        `limit`, and those sorted lists are merged by timestamp.
+        """
+
+        def window(query):
+            if before is not None:
+                timestamp, message_id = before
+                query = query.filter(or_(Message.timestamp < timestamp,
+                                         and_(Message.timestamp == timestamp,
+                                              Message.id < message_id)))
+            if after is not None:
+                timestamp, message_id = after
+                query = query.filter(or_(Message.timestamp > timestamp,
+                                         and_(Message.timestamp == timestamp,
+                                              Message.id > message_id)))
+            return query
+
+        if not self.enabled:
+            return cached_all(window(Message.query.filter(Message.user_id.in_(user_ids)))
+                              .order_by(Message.timestamp.desc(), Message.id.desc())
+                              .limit(limit),
+                              *[('messages', user_id) for user_id in user_ids])
+
+        by_shard = defaultdict(list)
+        for user_id in user_ids:
+            by_shard[self.shard_for(user_id)].append(user_id)
+
+        def newest(ids):
+            return lambda session: (window(session
+                                           .query(Message)
+                                           .filter(Message.user_id.in_(ids)))
+                                    .order_by(Message.timestamp.desc(),
+                                              Message.id.desc())
+                                    .limit(limit))
+
+        results = self._scatter([(shard, newest(ids))
+                                 for shard, ids in by_shard.items()])
+        merged = heapq.merge(*results, key=lambda m: (m.timestamp, m.id),
+                             reverse=True)
+        return self._attach(islice(merged, limit))
+
+    def newest_messages(self, user_ids):
+        """{user id: (timestamp, id) of their newest message}, for those of
+        `user_ids` who have any."""
+
+        def newest(ids):
+            def build(session):
+                latest = (session.query(Message.user_id,
+                                        func.max(Message.timestamp).label('timestamp'))
+                          .filter(Message.user_id.in_(ids))
+                          .group_by(Message.user_id)
+                          .subquery())
+                return (session.query(Message.user_id, Message.timestamp, func.max(Message.id))
+                        .join(latest, and_(Message.user_id == latest.c.user_id,
+                                           Message.timestamp == latest.c.timestamp))
+                        .group_by(Message.user_id, Message.timestamp))
+            return build
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+
+        if not self.enabled:
+            results = [newest(user_ids)(db.session).all()]
+        else:
+            by_shard = defaultdict(list)
+            for user_id in user_ids:
+                by_shard[self.shard_for(user_id)].append(user_id)
+            results = self._scatter([(shard, newest(ids))
+                                     for shard, ids in by_shard.items()])
+
+        found = {}
+        for rows in results:
+            for user_id, timestamp, message_id in rows:
+                found[user_id] = max(found.get(user_id, ()), (timestamp, message_id))
+        return found
+
+    def messages_by_id(self, message_ids):
+        """Messages with these ids, in the same order (missing ones skipped)."""
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return []
+
+        if not self.enabled:
+            found = {m.id: m for m in
+                     Message.query.filter(Message.id.in_(message_ids))}
+        else:
+            # ids usually still live on the shard that created them...
+            by_shard = defaultdict(list)
+            for message_id in message_ids:
+                by_shard[message_id % SHARD_SLOTS % len(self.engines)].append(message_id)
+
+            def by_ids(ids):
+                return lambda session: (session.query(Message)
+                                        .filter(Message.id.in_(ids)))
+
+            found = {}
+            for rows in self._scatter([(shard, by_ids(ids))
+                                       for shard, ids in by_shard.items()]):
+                found.update((m.id, m) for m in rows)
+
+            # ...unless their author was moved since
+            missing = [i for i in message_ids if i not in found]
+            if missing:
+                jobs = [(shard, by_ids(missing))
+                        for shard in range(len(self.engines))]
+                for rows in self._scatter(jobs):
+                    found.update((m.id, m) for m in rows)
+
+            found = dict(zip(found, self._attach(found.values())))
+
+        return [found[i] for i in message_ids if i in found]
+
+    def get_message(self, message_id):
+        """One message, or None."""
+
+        if not self.enabled:
+            return Message.query.get(message_id)
+
+        found = self.messages_by_id([message_id])
+        return found[0] if found else None
+
+    def add_message(self, user_id, text, parent=None):
+        """Store a new message by `user_id`, a reply if `parent` is given,
+        and return it."""
+
+        if not self.enabled:
+            msg = Message(text=text, user_id=user_id)
+            db.session.add(msg)
+            if parent is not None:
+                db.session.flush()
+                for name, value in reply_fields(parent, msg.id).items():
+                    setattr(msg, name, value)
+                self._count_reply(msg.parent_id, parent)
+            db.session.commit()
+            return msg
+
+        def insert(session, shard):
+            message_id = self._next_id(session, shard)
+            # everything set, so the copy attached to db.session never
+            # tries to load a column from the primary
+            thread = (reply_fields(parent, message_id) if parent is not None else
+                      {'parent_id': None, 'thread_id': None, 'path': None})
+            msg = Message(id=message_id, text=text, user_id=user_id,
+                          timestamp=datetime.utcnow(), reply_count=0, **thread)
+            session.add(msg)
+            return msg
+
+        msg = self._write(user_id, insert)
+        if parent is not None:
+            # a second transaction, on the parent's shard
+            self._count_reply(msg.parent_id, parent)
+        return self._attach([msg])[0]
+
+    def _count_reply(self, parent_id, parent):
+        """One more reply to `parent_id`: `parent` itself, or (past the
+        depth limit) its parent."""
+
+        if parent_id != parent.id:
+            self.count_replies({parent_id: 1})
+        elif not self.enabled:
+            # a flushed change, so the author's cached timelines go stale
+            parent.reply_count = Message.reply_count + 1
+        else:
+            messages = shard_messages
+            self._write(parent.user_id, lambda session, shard: session.execute(
+                messages.update().where(messages.c.id == parent.id)
+                .values(reply_count=messages.c.reply_count + 1)))
+
+    def count_replies(self, deltas, conn=None):
+        """Add {message id: delta} to those messages' reply counts. `conn`
+        is an open connection to use for its own database; otherwise the
+        primary is written in db.session."""
+
+        by_delta = defaultdict(list)
+        for message_id, delta in deltas.items():
+            if delta:
+                by_delta[delta].append(message_id)
+
+        def updates(messages):
+            return [messages.update().where(messages.c.id.in_(ids))
+                    .values(reply_count=messages.c.reply_count + delta)
+                    for delta, ids in by_delta.items()]
+
+        if not self.enabled:
+            if conn is not None:
+                for statement in updates(Message.__table__):
+                    conn.execute(statement)
+                return
+            for delta, ids in by_delta.items():
+                (Message.query.filter(Message.id.in_(ids))
+                 .update({Message.reply_count: Message.reply_count + delta},
+                         synchronize_session=False))
+            return
+
+        # the messages' authors may have moved off the shards that made them
+        for engine in self.engines:
+            if conn is not None and conn.engine is engine:
+                for statement in updates(shard_messages):
+                    conn.execute(statement)
+                continue
+            with engine.begin() as shard_conn:
+                for statement in updates(shard_messages):
+                    shard_conn.execute(statement)
+
+    def delete_message(self, msg):
+        """Delete a message and the likes pointing at it. Its replies stay
+        in the thread."""
+
+        if not self.enabled:
+            # partitioned messages can't be the target of likes' foreign key
+            Likes.query.filter_by(message_id=msg.id).delete()
+            if msg.parent_id:
+                self.count_replies({msg.parent_id: -1})
+            db.session.delete(msg)
+            db.session.commit()
+            return
+
+        self._write(msg.user_id, lambda session, shard: (
+            session.query(Message).filter_by(id=msg.id).delete()))
+        if msg.parent_id:
+            self.count_replies({msg.parent_id: -1})
+
+        # likes are sharded by who liked, so they can be anywhere
+        for engine in self.engines:
+            with engine.begin() as conn:
+                conn.execute(shard_likes.delete()
+                             .where(shard_likes.c.message_id == msg.id))
+
+        db.session.expunge(msg)
+
+    def thread(self, msg, start=None, branches=THREAD_BRANCHES):
+        """`msg`'s replies, in thread order, from its direct reply `start`
+        on: ([(reply, depth below `msg`)], id of the direct reply to start
+        the next page at, or None). `branches` limits the page to that many
+        direct replies and everything under them (None: all of them).
+
+        One query without shards. With shards, replies can be on any of
+        them: one round for the first `branches` + 1 direct replies, then
+        one for the rows before the first left out, merged by path.
+        """
+
+        if not self.enabled:
+            if branches is None:
+                return thread_rows(msg, subtree(db.session, msg, start).all(), None)
+            rows = branches_query(db.session, msg, start, branches).all()
+            return thread_rows(msg, [reply for reply, next_path in rows],
+                               rows[0].next_path if rows else None)
+
+        next_path = None
+        if branches is not None:
+            firsts = self._scatter([
+                (shard, lambda session: branch_paths(session, msg, start, branches + 1))
+                for shard in range(len(self.engines))])
+            paths = sorted(row.path for rows in firsts for row in rows)
+            next_path = paths[branches] if len(paths) > branches else None
+
+        results = self._scatter([
+            (shard, lambda session: subtree(session, msg, start, next_path))
+            for shard in range(len(self.engines))])
+        replies = self._attach(heapq.merge(*results, key=lambda reply: reply.path))
+        return thread_rows(msg, replies, next_path)
+
+    ##########################################################################
+    # Likes
+
+    def liked_message_ids(self, user_id):
+        """Set of message ids `user_id` has liked."""
+
+        if not self.enabled:
+            return {message_id for (message_id,) in
+                    db.session.query(Likes.message_id).filter_by(user_id=user_id)}
+
+        rows = self._fetch(self.shard_for(user_id), lambda session: (
+            session.query(Likes.message_id).filter_by(user_id=user_id)))
+        return {message_id for (message_id,) in rows}
+
+    def count_likes(self, user_id):
+        """Number of messages `user_id` has liked."""
+
+        if not self.enabled:
+            return cached_scalar(db.session.query(func.count(Likes.id))
+                                 .filter(Likes.user_id == user_id),
+                                 ('likes', user_id))
+
+        session = self.sessions[self.shard_for(user_id)]()
+        try:
+            return (session.query(func.count(Likes.id))
+                    .filter(Likes.user_id == user_id).scalar())
+        finally:
+            session.close()
+
+    def toggle_like(self, user_id, message_id):
+        """Like the message, or unlike it if already liked; True if liked."""
+
+        def toggle(session, shard):
+            like = (session.query(Likes)
+                    .filter_by(user_id=user_id, message_id=message_id)
+                    .first())
+            if like:
+                session.delete(like)
+                return False
+
+            like = Likes(user_id=user_id, message_id=message_id)
+            if self.enabled:
+                like.id = self._next_id(session, shard)
+            session.add(like)
+            return True
+
+        if not self.enabled:
+            liked = toggle(db.session, None)
+            db.session.commit()
+            return liked
+
+        return self._write(user_id, toggle)
+
+    def is_liked(self, user_id, message_id):
+        def liked(session):
+            return (session.query(Likes.id)
+                    .filter_by(user_id=user_id, message_id=message_id)
+                    .limit(1))
+
+        if not self.enabled:
+            return liked(db.session).first() is not None
+
+        return bool(self._fetch(self.shard_for(user_id), liked))
+
+    def apply_likes(self, changes):
+        """Apply {(user_id, message_id): liked} in one transaction per shard:
+        multi-row inserts that skip likes already there, and deletes.
+
+        Returns {(user_id, message_id): timestamp} of the likes deleted.
+        """
+
+        now = datetime.utcnow()
+        likes = Likes.__table__
+
+        def apply(pairs):
+            def work(session, shard):
+                added = [{'user_id': user_id, 'message_id': message_id, 'timestamp': now}
+                         for (user_id, message_id), liked in pairs if liked]
+                removed = [key for key, liked in pairs if not liked]
+                if self.enabled:
+                    for row in added:
+                        row['id'] = self._next_id(session, shard)
+
+                for rows in _chunks(added, LIKE_BATCH_ROWS):
+                    session.execute(insert_ignoring_duplicates(session, likes).values(rows))
+
+                deleted = {}
+                for keys in _chunks(removed, LIKE_BATCH_ROWS):
+                    where = tuple_(likes.c.user_id, likes.c.message_id).in_(keys)
+                    deleted.update(
+                        ((row.user_id, row.message_id), row.timestamp)
+                        for row in session.execute(
+                            select([likes.c.user_id, likes.c.message_id,
+                                    likes.c.timestamp]).where(where)))
+                    session.execute(likes.delete().where(where))
+                return deleted
+            return work
+
+        if not self.enabled:
+            try:
+                deleted = apply(changes.items())(db.session, None)
+                mark_stale(db.session, 'likes', *{user_id for user_id, _ in changes})
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            return deleted
+
+        by_shard = defaultdict(list)
+        for (user_id, message_id), liked in changes.items():
+            by_shard[self._write_shard(user_id)].append(((user_id, message_id), liked))
+
+        deleted = {}
+        for pairs in by_shard.values():
+            # any of the users picks the shard they all share
+            (user_id, _), _ = pairs[0]
+            deleted.update(self._write(user_id, apply(pairs)))
+        return deleted
+
+    ##########################################################################
+    # Maintenance
+
+    def purge_user(self, user_id):
+        """Delete all of a user's messages and likes (and likes of them)."""
+
+        if not self.enabled:
+            return
+
+        shard = self._write_shard(user_id)
+        with self.engines[shard].begin() as conn:
+            message_ids = [row.id for row in conn.execute(
+                select([shard_messages.c.id])
+                .where(shard_messages.c.user_id == user_id))]
+            conn.execute(shard_messages.delete()
+                         .where(shard_messages.c.user_id == user_id))
+            conn.execute(shard_likes.delete()
+                         .where(shard_likes.c.user_id == user_id))
+
+        for engine in self.engines:
+            with engine.begin() as conn:
+                for start in range(0, len(message_ids), 1000):
+                    conn.execute(shard_likes.delete().where(
+                        shard_likes.c.message_id.in_(message_ids[start:start + 1000])))
+
+    def move_user(self, user_id, dest, batch_size=1000,
+                  grace=FREEZE_GRACE_SECONDS, settle=DIRECTORY_TTL):
+        """Move a user's messages and likes to shard `dest` while online.
+
+        1. copy rows in batches while the user keeps writing to the source
+        2. freeze the user's writes, wait `grace` for in-flight ones, and
+           copy/update/delete whatever changed since (by comparing rows)
+        3. point the directory at `dest` and unfreeze
+        4. after `settle` (cached directory entries have expired) delete
+           the rows from the source
+
+        Returns the number of rows copied.
+        """
+
+        src = self._lookup(user_id)[0]
+        if src == dest:
+            return 0
+
+        source, target = self.engines[src], self.engines[dest]
+        copied = sum(self._copy_rows(table, user_id, source, target, batch_size)
+                     for table in (shard_messages, shard_likes))
+
+        self._set_directory(user_id, src, frozen=True)
+        try:
+            time.sleep(grace)
+            copied += sum(self._sync_rows(table, user_id, source, target)
+                          for table in (shard_messages, shard_likes))
+        except Exception:
+            self._set_directory(user_id, src, frozen=False)
+            raise
+        self._set_directory(user_id, dest, frozen=False)
+
+        time.sleep(settle)
+        for table in (shard_messages, shard_likes):
+            self._delete_rows(table, user_id, source, batch_size)
+
+        return copied
+
+    def _copy_rows(self, table, user_id, source, target, batch_size):
+        copied, last_id = 0, None
+        while True:
+            query = (select([table]).where(table.c.user_id == user_id)
+                     .order_by(table.c.id).limit(batch_size))
+            if last_id is not None:
+                query = query.where(table.c.id > last_id)
+
+            with source.connect() as conn:
+                rows = [dict(row) for row in conn.execute(query)]
+            if not rows:
+                return copied
+
+            copied += self._insert_missing(table, target, rows)
+            last_id = rows[-1]['id']
+
+    def _insert_missing(self, table, target, rows):
+        with target.begin() as conn:
+            present = {row.id for row in conn.execute(
+                select([table.c.id])
+                .where(table.c.id.in_([row['id'] for row in rows])))}
+            rows = [row for row in rows if row['id'] not in present]
+            if rows:
+                conn.execute(table.insert(), rows)
+        return len(rows)
+
+    def _ids(self, table, user_id, engine):
+        with engine.connect() as conn:
+            return {row.id for row in conn.execute(
+                select([table.c.id]).where(table.c.user_id == user_id))}
+
+    def _sync_rows(self, table, user_id, source, target):
+        """Make the user's rows on `target` match `source` exactly."""
+
+        src_ids = self._ids(table, user_id, source)
+        dest_ids = self._ids(table, user_id, target)
+
+        new_ids = sorted(src_ids - dest_ids)
+        copied = 0
+        for start in range(0, len(new_ids), 1000):
+            with source.connect() as conn:
+                rows = [dict(row) for row in conn.execute(
+                    select([table])
+                    .where(table.c.id.in_(new_ids[start:start + 1000])))]
+            copied += self._insert_missing(table, target, rows)
+
+        # rows copied earlier may have changed since (a reply_count bump)
+        kept_ids = sorted(src_ids & dest_ids)
+        for start in range(0, len(kept_ids), 1000):
+            batch = kept_ids[start:start + 1000]
+            query = select([table]).where(table.c.id.in_(batch))
+            with source.connect() as conn:
+                rows = {row.id: dict(row) for row in conn.execute(query)}
+            with target.begin() as conn:
+                for row in conn.execute(query).fetchall():
+                    if dict(row) != rows[row.id]:
+                        conn.execute(table.update()
+                                     .where(table.c.id == row.id)
+                                     .values(rows[row.id]))
+                        copied += 1
+
+        gone_ids = sorted(dest_ids - src_ids)
+        with target.begin() as conn:
+            for start in range(0, len(gone_ids), 1000):
+                conn.execute(table.delete().where(
+                    table.c.id.in_(gone_ids[start:start + 1000])))
+
+        return copied
+
+    def _delete_rows(self, table, user_id, engine, batch_size):
+        while True:
+            with engine.begin() as conn:
+                ids = [row.id for row in conn.execute(
+                    select([table.c.id]).where(table.c.user_id == user_id)
+                    .limit(batch_size))]
+                if not ids:
+                    return
+                conn.execute(table.delete().where(table.c.id.in_(ids)))
+
+
+shards = ShardRouter()
+
+
+def connect_shards(app):
+    """Use the app's SHARD_URIS as message/like shards."""
+
+    shards.configure(app.config.get('SHARD_URIS', []))
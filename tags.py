@@ -0,0 +1,175 @@
+"""Hashtags and @mentions.
+
+Message text is stored as written, so finding "#topic" or "@someone" in
+it would mean a LIKE scan of every message. Instead `index_message`
+parses a new message's hashtags and mentions into the message_tags and
+mentions tables (on the primary, wherever the message itself lives).
+A tag's or a user's messages are then an index range scan of
+ix_message_tags_tag_timestamp / ix_mentions_user_timestamp, newest
+first, paged with a (timestamp, message id) cursor instead of an offset;
+the messages themselves come from `shards.messages_by_id`.
+
+Tags are case-insensitive and stored lowercased, and need a letter
+("#1" is not a tag). Mentions of usernames that don't exist are ignored.
+
+`index_messages` (`flask ops index-messages`, or the `index-messages`
+job) backfills messages written before this, or whose indexing failed:
+it walks each message table by id, INDEX_BATCH_ROWS messages per
+transaction, skipping rows already indexed, so it can be rerun any time.
+"""
+
+import re
+
+from sqlalchemy import select, and_, or_
+
+from follows import encode_cursor, decode_cursor
+from models import db, User, Message, MessageTag, Mention
+from sharding import shards, shard_messages, insert_ignoring_duplicates
+
+TAG_PAGE_SIZE = 50
+INDEX_BATCH_ROWS = 1000
+
+# longer tags are cut off
+MAX_TAG_LENGTH = 64
+
+TAG_RE = re.compile(r'(?<![\w#&])#(\w*[^\W\d_]\w*)')
+MENTION_RE = re.compile(r'(?<![\w@])@(\w+)')
+
+
+def normalize_tag(tag):
+    """The stored form of `tag` (without the #), or None if it isn't one."""
+
+    match = TAG_RE.fullmatch('#' + tag)
+    return match and match.group(1).lower()[:MAX_TAG_LENGTH]
+
+
+def extract(text):
+    """(set of tags, set of mentioned usernames) in a message's text."""
+
+    tags = {tag.lower()[:MAX_TAG_LENGTH] for tag in TAG_RE.findall(text)}
+    return tags, set(MENTION_RE.findall(text))
+
+
+##############################################################################
+# Indexing
+
+
+def _index_rows(messages):
+    """message_tags and mentions rows for `messages` (one username query)."""
+
+    tag_rows, mentioned = [], []
+    for msg in messages:
+        tags, usernames = extract(msg.text)
+        tag_rows += [{'tag': tag, 'message_id': msg.id, 'timestamp': msg.timestamp,
+                      'user_id': msg.user_id} for tag in tags]
+        if usernames:
+            mentioned.append((msg, usernames))
+
+    names = set().union(*(usernames for msg, usernames in mentioned))
+    user_ids = dict(db.session.query(User.username, User.id)
+                    .filter(User.username.in_(names), User.deleted_at.is_(None))) if names else {}
+
+    mention_rows = [{'user_id': user_ids[name], 'message_id': msg.id,
+                     'timestamp': msg.timestamp, 'author_id': msg.user_id}
+                    for msg, usernames in mentioned
+                    for name in usernames if name in user_ids]
+    return tag_rows, mention_rows
+
+
+def _insert_index_rows(messages):
+    tag_rows, mention_rows = _index_rows(messages)
+    for table, rows in ((MessageTag.__table__, tag_rows), (Mention.__table__, mention_rows)):
+        if rows:
+            db.session.execute(insert_ignoring_duplicates(db.session, table).values(rows))
+    return tag_rows, mention_rows
+
+
+def index_message(msg):
+    """Index a new message's tags and mentions in the current db.session
+    transaction; the caller commits. Returns the mentioned user ids."""
+
+    tag_rows, mention_rows = _insert_index_rows([msg])
+    return {row['user_id'] for row in mention_rows}
+
+
+def unindex_messages(conn, message_ids):
+    """Remove deleted messages from the index (`conn` may be db.session)."""
+
+    for table in (MessageTag.__table__, Mention.__table__):
+        conn.execute(table.delete().where(table.c.message_id.in_(message_ids)))
+
+
+def index_messages(batch_size=INDEX_BATCH_ROWS, on_progress=None):
+    """Index every stored message; returns (messages, tags, mentions)."""
+
+    if shards.enabled:
+        sources = [(engine, shard_messages) for engine in shards.engines]
+    else:
+        sources = [(db.engine, Message.__table__)]
+
+    totals = [0, 0, 0]
+    for engine, messages in sources:
+        columns = select([messages.c.id, messages.c.text, messages.c.timestamp,
+                          messages.c.user_id])
+        last_id = None
+        while True:
+            query = columns.order_by(messages.c.id).limit(batch_size)
+            if last_id is not None:
+                query = query.where(messages.c.id > last_id)
+            with engine.connect() as conn:
+                batch = conn.execute(query).fetchall()
+            if not batch:
+                break
+
+            last_id = batch[-1].id
+            tag_rows, mention_rows = _insert_index_rows(
+                [row for row in batch if '#' in row.text or '@' in row.text])
+            db.session.commit()
+
+            for i, count in enumerate((len(batch), len(tag_rows), len(mention_rows))):
+                totals[i] += count
+            if on_progress:
+                on_progress(*totals)
+
+    return tuple(totals)
+
+
+##############################################################################
+# Timelines
+
+
+def _page(table, key_column, key, before, limit):
+    """One page of messages from an index table, newest first: (messages,
+    cursor for the next page or None). ValueError for a bad cursor."""
+
+    query = (select([table.c.message_id, table.c.timestamp])
+             .where(key_column == key)
+             .order_by(table.c.timestamp.desc(), table.c.message_id.desc())
+             .limit(limit + 1))
+    if before:
+        timestamp, last_id = decode_cursor(before)
+        query = query.where(or_(table.c.timestamp < timestamp,
+                                and_(table.c.timestamp == timestamp,
+                                     table.c.message_id < last_id)))
+
+    rows = db.session.execute(query).fetchall()
+    messages = shards.messages_by_id([row.message_id for row in rows[:limit]])
+    if len(rows) <= limit:
+        return messages, None
+
+    last = rows[limit - 1]
+    return messages, encode_cursor(last.timestamp, last.message_id)
+
+
+def tag_page(tag, before=None, limit=TAG_PAGE_SIZE):
+    """Messages tagged `tag` (normalized), newest first, and the next cursor."""
+
+    table = MessageTag.__table__
+    return _page(table, table.c.tag, tag, before, limit)
+
+
+def mentions_page(user_id, before=None, limit=TAG_PAGE_SIZE):
+    """Messages mentioning `user_id`, newest first, and the next cursor."""
+
+    table = Mention.__table__
+    return _page(table, table.c.user_id, user_id, before, limit)
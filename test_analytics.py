@@ -0,0 +1,115 @@
+"""Analytics export and engagement stats tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_analytics.py
+
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import numpy as np
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from export import export_all
+from analytics import (Export, posting_rates, like_ratios, follower_growth,
+                       follower_history, top)
+
+db.create_all()
+
+NOW = datetime(2022, 6, 30)
+
+
+class AnalyticsTestCase(TestCase):
+    """Test stats computed from an export of a small known dataset."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        users = [User.signup(f"stats{i}", f"stats{i}@test.com", "password", None)
+                 for i in range(3)]
+        db.session.commit()
+        self.u0, self.u1, self.u2 = [user.id for user in users]
+
+        # u0 posts 6 messages over the last 3 days, u1 one long ago
+        messages = [Message(text=f"m{i}", user_id=self.u0,
+                            timestamp=NOW - timedelta(hours=12 * i))
+                    for i in range(6)]
+        messages.append(Message(text="old", user_id=self.u1,
+                                timestamp=NOW - timedelta(days=100)))
+        db.session.add_all(messages)
+        db.session.commit()
+
+        # u0's first three messages get liked by u1
+        db.session.add_all([Likes(user_id=self.u1, message_id=msg.id)
+                            for msg in messages[:3]])
+
+        # u0 had one follower long ago and gained two this week
+        db.session.add_all([
+            Follows(user_following_id=self.u1, user_being_followed_id=self.u0,
+                    timestamp=NOW - timedelta(days=60)),
+            Follows(user_following_id=self.u2, user_being_followed_id=self.u0,
+                    timestamp=NOW - timedelta(days=2)),
+            Follows(user_following_id=self.u0, user_being_followed_id=self.u1,
+                    timestamp=NOW - timedelta(days=1)),
+        ])
+        db.session.commit()
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.export_dir = os.path.join(self.dir.name, 'analytics')
+        self.rows = export_all(self.export_dir, chunk_rows=2)
+        self.data = Export(self.export_dir)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_export(self):
+        self.assertEqual(self.rows, {'messages': 7, 'likes': 3, 'follows': 3})
+        self.assertIsInstance(self.data.messages['id'], np.memmap)
+        self.assertEqual(self.data.messages['timestamp'].dtype,
+                         np.dtype('datetime64[us]'))
+
+    def test_reexport_replaces(self):
+        Likes.query.delete()
+        db.session.commit()
+
+        rows = export_all(self.export_dir)
+
+        self.assertEqual(rows['likes'], 0)
+        self.assertEqual(len(Export(self.export_dir).likes['id']), 0)
+        self.assertEqual(os.listdir(self.dir.name), ['analytics'])
+
+    def test_posting_rates(self):
+        rates = posting_rates(self.data, days=3, now=NOW)
+
+        self.assertEqual(rates[self.u0], 2)
+        self.assertEqual(rates[self.u1], 0)
+
+    def test_like_ratios(self):
+        ratios = like_ratios(self.data)
+
+        self.assertEqual(ratios[self.u0], 0.5)
+        self.assertEqual(ratios[self.u1], 0)
+        self.assertEqual(top(ratios), [(self.u0, 0.5)])
+
+    def test_follower_growth(self):
+        new, growth = follower_growth(self.data, days=7, now=NOW)
+
+        self.assertEqual(new[self.u0], 1)
+        self.assertEqual(growth[self.u0], 1.0)
+        self.assertEqual(new[self.u1], 1)
+        self.assertEqual(growth[self.u1], 0)
+
+        history = follower_history(self.data, self.u0, bucket_days=30,
+                                   buckets=3, now=NOW)
+        self.assertEqual(list(history), [1, 0, 1])
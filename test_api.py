@@ -0,0 +1,197 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from api import BATCH_LIMIT
+from cache import cache
+from follow_graph import follow_graph
+from timeline_markers import marker_key
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ApiTestCase(TestCase):
+    """Test the /api/v1 endpoints."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.users = [User.signup(f"apiuser{i}", f"apiuser{i}@test.com", "password", None)
+                      for i in range(3)]
+        db.session.commit()
+        self.me, self.friend, self.stranger = [user.id for user in self.users]
+
+        db.session.add(Follows(user_following_id=self.me, user_being_followed_id=self.friend))
+
+        start = datetime(2020, 1, 1)
+        self.messages = [Message(text=f"message {i}", user_id=user_id,
+                                 timestamp=start + timedelta(minutes=i))
+                         for i, user_id in enumerate([self.me, self.friend, self.stranger] * 3)]
+        db.session.add_all(self.messages)
+        db.session.commit()
+        self.message_ids = [msg.id for msg in self.messages]
+
+        self.client = app.test_client()
+
+    def login(self, client, user_id):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_timeline(self):
+        with self.client as c:
+            self.assertEqual(c.get('/api/v1/timeline').status_code, 401)
+            self.login(c, self.me)
+
+            data = c.get('/api/v1/timeline?limit=4').get_json()
+            self.assertEqual([m['text'] for m in data['messages']],
+                             ["message 7", "message 6", "message 4", "message 3"])
+            self.assertEqual(set(data['users']), {str(self.me), str(self.friend)})
+            self.assertEqual(data['users'][str(self.me)]['username'], "apiuser0")
+
+            data = c.get(f"/api/v1/timeline?limit=4&before={data['next']}").get_json()
+            self.assertEqual([m['text'] for m in data['messages']],
+                             ["message 1", "message 0"])
+            self.assertIsNone(data['next'])
+
+            self.assertEqual(c.get('/api/v1/timeline?before=junk').status_code, 400)
+            self.assertEqual(c.get('/api/v1/timeline?limit=0').get_json(),
+                             {'error': "limit must be between 1 and 200."})
+
+    def test_timeline_since(self):
+        cache.clear()
+        graph_dir = tempfile.TemporaryDirectory()
+        follow_graph.configure(graph_dir.name)
+        self.addCleanup(graph_dir.cleanup)
+        self.addCleanup(follow_graph.configure, app.config['FOLLOW_GRAPH_DIR'])
+
+        def post(user_id, text, minutes):
+            msg = Message(text=text, user_id=user_id,
+                          timestamp=datetime(2020, 1, 2) + timedelta(minutes=minutes))
+            db.session.add(msg)
+            db.session.commit()
+            return msg.id
+
+        with self.client as c:
+            self.login(c, self.me)
+            newest = c.get('/api/v1/timeline?limit=1').get_json()['messages'][0]['id']
+
+            resp = c.get(f'/api/v1/timeline?since_id={newest}')
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+
+            # not on this timeline
+            post(self.stranger, "elsewhere", 0)
+            self.assertEqual(c.get(f'/api/v1/timeline?since_id={newest}').status_code, 304)
+
+            first = post(self.friend, "first", 1)
+            post(self.me, "second", 2)
+            data = c.get(f'/api/v1/timeline?since_id={newest}').get_json()
+            self.assertEqual([m['text'] for m in data['messages']], ["second", "first"])
+            self.assertFalse(data['gap'])
+
+            data = c.get(f'/api/v1/timeline?since_id={newest}&limit=1').get_json()
+            self.assertEqual([m['text'] for m in data['messages']], ["second"])
+            self.assertTrue(data['gap'])
+
+            data = c.get(f'/api/v1/timeline?since_id={first}').get_json()
+            self.assertEqual([m['text'] for m in data['messages']], ["second"])
+
+            self.assertEqual(c.get('/api/v1/timeline?since_id=999999').status_code, 404)
+            self.assertEqual(c.get('/api/v1/timeline?since_id=x').status_code, 400)
+
+    def test_timeline_since_per_process_cache(self):
+        graph_dir = tempfile.TemporaryDirectory()
+        follow_graph.configure(graph_dir.name)
+        self.addCleanup(graph_dir.cleanup)
+        self.addCleanup(follow_graph.configure, app.config['FOLLOW_GRAPH_DIR'])
+
+        with self.client as c:
+            self.login(c, self.me)
+            newest = c.get('/api/v1/timeline?limit=1').get_json()['messages'][0]['id']
+            self.assertEqual(newest, self.message_ids[7])
+
+            msg = Message(text="from another worker", user_id=self.friend)
+            db.session.add(msg)
+            db.session.commit()
+            # what this process's cache held before the other one's insert
+            cache.set(marker_key(self.friend), (self.messages[7].timestamp, newest))
+
+            data = c.get(f'/api/v1/timeline?since_id={newest}').get_json()
+            self.assertEqual([m['text'] for m in data['messages']],
+                             ["from another worker"])
+
+    def test_profile_and_follows(self):
+        with self.client as c:
+            profile = c.get(f'/api/v1/users/{self.friend}').get_json()['user']
+            self.assertEqual(profile['username'], "apiuser1")
+            self.assertEqual(profile['followers_count'], 1)
+            self.assertNotIn('followed', profile)
+            self.assertEqual(c.get('/api/v1/users/999999').status_code, 404)
+
+            self.login(c, self.stranger)
+            resp = c.post(f'/api/v1/users/{self.friend}/follow')
+            self.assertEqual(resp.get_json(), {'followed': True})
+
+            data = c.get(f'/api/v1/users/{self.friend}/followers?limit=1').get_json()
+            self.assertEqual([u['id'] for u in data['users']], [self.stranger])
+            data = c.get(f"/api/v1/users/{self.friend}/followers?after={data['next']}").get_json()
+            self.assertEqual(data['users'], [{
+                'id': self.me, 'username': "apiuser0", 'image_url': "/static/images/default-pic.png",
+                'header_image_url': "/static/images/warbler-hero.jpg", 'bio': None,
+                'followed': False}])
+            self.assertIsNone(data['next'])
+
+            resp = c.post(f'/api/v1/users/{self.friend}/follow')
+            self.assertEqual(resp.get_json(), {'followed': False})
+            self.assertEqual(User.query.get(self.friend).followers_count, 1)
+
+    def test_like(self):
+        message_id = self.message_ids[1]
+
+        with self.client as c:
+            self.assertEqual(c.post(f'/api/v1/messages/{message_id}/like').status_code, 401)
+            self.login(c, self.me)
+
+            self.assertEqual(c.post(f'/api/v1/messages/{message_id}/like').get_json(),
+                             {'liked': True})
+            data = c.get(f'/api/v1/messages/{message_id}').get_json()
+            self.assertTrue(data['message']['liked'])
+            self.assertEqual(list(data['users']), [str(self.friend)])
+
+            self.assertEqual(c.post(f'/api/v1/messages/{message_id}/like').get_json(),
+                             {'liked': False})
+            self.assertEqual(c.post('/api/v1/messages/999999/like').status_code, 404)
+
+    def test_batch(self):
+        with self.client as c:
+            resp = c.post('/api/v1/batch', json={
+                'users': [self.me, 999999],
+                'messages': [self.message_ids[2], 999999]})
+            data = resp.get_json()
+
+            self.assertEqual(set(data['users']), {str(self.me), str(self.stranger)})
+            self.assertEqual(list(data['messages']), [str(self.message_ids[2])])
+            self.assertFalse(data['messages'][str(self.message_ids[2])]['liked'])
+
+            resp = c.post('/api/v1/batch', json={'users': list(range(BATCH_LIMIT + 1))})
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(c.post('/api/v1/batch', json=[1]).status_code, 400)
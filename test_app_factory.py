@@ -0,0 +1,66 @@
+"""App factory tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_app_factory.py
+
+
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import create_app
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class AppFactoryTestCase(TestCase):
+    """Test building the app and what importing it costs."""
+
+    def test_import_is_lazy(self):
+        code = ("import sys, app; "
+                "assert app._app is None; "
+                "heavy = {'flask_debugtoolbar', 'turtle', 'crypt', 'wtforms', 'numpy'}; "
+                "print(sorted(heavy & set(sys.modules)))")
+        out = subprocess.run([sys.executable, '-c', code], cwd=HERE, check=True,
+                             stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(out.stdout.strip(), '[]')
+
+    def test_create_app(self):
+        app = create_app({'SECRET_KEY': 'test-key', 'TESTING': True})
+
+        self.assertEqual(app.config['SECRET_KEY'], 'test-key')
+        self.assertEqual(app.config['SQLALCHEMY_DATABASE_URI'], os.environ['DATABASE_URL'])
+        self.assertIn('users.list_users', app.view_functions)
+        self.assertIn('worker', app.cli.commands)
+        self.assertNotIn('debugtoolbar', app.blueprints)
+
+        resp = app.test_client().get('/')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Pragma'], 'no-cache')
+
+    def test_ready(self):
+        app = create_app({'TESTING': True})
+
+        resp = app.test_client().get('/ready')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json, {'ready': True, 'pid': os.getpid()})
+
+    def test_stats_need_token(self):
+        app = create_app({'TESTING': True, 'OPS_TOKEN': ''})
+        for path in ('/cache/stats', '/jobs/stats'):
+            self.assertEqual(app.test_client().get(path).status_code, 404)
+
+        app = create_app({'TESTING': True, 'OPS_TOKEN': 'sesame'})
+        with app.test_client() as c:
+            for path in ('/cache/stats', '/jobs/stats'):
+                self.assertEqual(c.get(path).status_code, 403)
+                self.assertEqual(c.get(path, headers={
+                    'Authorization': 'Bearer wrong'}).status_code, 403)
+                resp = c.get(path, headers={'Authorization': 'Bearer sesame'})
+                self.assertEqual(resp.status_code, 200)
+            self.assertIn('hits', c.get('/cache/stats', headers={
+                'Authorization': 'Bearer sesame'}).json)
@@ -0,0 +1,191 @@
+"""Cache backend tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase, mock
+
+from cache import LRUCache, SharedMemoryCache, RedisCache, cache_from_url
+from resp_standin import RespStandIn
+
+
+class BackendTests:
+    """Behaviour every backend must share."""
+
+    def test_set_get(self):
+        self.cache.set('a', {'x': [1, 2]})
+
+        self.assertEqual(self.cache.get('a'), {'x': [1, 2]})
+        self.assertIsNone(self.cache.get('missing'))
+
+    def test_ttl(self):
+        self.cache.set('short', 'value', ttl=0.05)
+        time.sleep(0.1)
+
+        self.assertIsNone(self.cache.get('short'))
+
+    def test_delete_many(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.delete_many(['a', 'b'])
+
+        self.assertEqual(self.cache.get_many(['a', 'b']), {})
+
+    def test_incr(self):
+        self.assertEqual(self.cache.incr('n'), 1)
+        self.assertEqual(self.cache.incr('n', 5), 6)
+        self.assertEqual(self.cache.get('n'), 6)
+
+    def test_add(self):
+        self.assertTrue(self.cache.add('k', 1))
+        self.assertFalse(self.cache.add('k', 2))
+        self.assertEqual(self.cache.get('k'), 1)
+
+    def test_single_flight(self):
+        """Concurrent misses on one key compute it once"""
+
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return 42
+
+        threads = [threading.Thread(target=self.cache.get_or_set,
+                                    args=('hot', compute))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.cache.get('hot'), 42)
+
+    def test_stats(self):
+        self.cache.set('a', 1)
+        self.cache.get('a')
+        self.cache.get('b')
+
+        stats = self.cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+
+class LRUCacheTestCase(BackendTests, TestCase):
+
+    def setUp(self):
+        self.cache = LRUCache()
+
+    def test_size_eviction(self):
+        """Least recently used entries go first once over max_bytes"""
+
+        small = LRUCache(max_bytes=1000)
+        for i in range(20):
+            small.set(f'k{i}', 'x' * 100)
+            small.get('k0')
+
+        self.assertLessEqual(small.size, 1000)
+        self.assertEqual(small.get('k0'), 'x' * 100)
+        self.assertIsNone(small.get('k1'))
+        self.assertGreater(small.stats['evictions'], 0)
+
+
+class SharedMemoryCacheTestCase(BackendTests, TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'cache')
+        self.cache = SharedMemoryCache(self.path, size=1 << 20)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_shared_across_processes(self):
+        """A value set in a forked worker is visible to the parent"""
+
+        pid = os.fork()
+        if pid == 0:
+            SharedMemoryCache(self.path).set('from-child', 'hello')
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.assertEqual(self.cache.get('from-child'), 'hello')
+
+    def test_too_large(self):
+        self.cache.set('big', 'x' * 10000)
+
+        self.assertIsNone(self.cache.get('big'))
+
+    def test_too_large_overwrite(self):
+        """A value too big to store drops the one it replaces"""
+
+        self.cache.set('k', 'old')
+        self.cache.set('k', 'x' * 10000)
+
+        self.assertIsNone(self.cache.get('k'))
+
+    def test_other_size_reuses_geometry(self):
+        """A worker started with another size maps the existing table"""
+
+        self.cache.set('kept', 1)
+        smaller = SharedMemoryCache(self.path, size=1 << 16)
+
+        self.assertEqual(smaller.sets, self.cache.sets)
+        self.assertEqual(smaller.get('kept'), 1)
+        # every set, including those past the smaller size's end
+        for i in range(2000):
+            smaller.set(f"key{i}", i)
+        self.assertEqual(self.cache.get('key1999'), 1999)
+
+
+class RedisCacheTestCase(BackendTests, TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = RespStandIn(('127.0.0.1', 0))
+        cls.host, cls.port = cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.cache = cache_from_url(f"redis://{self.host}:{self.port}/0")
+        self.cache.clear()
+
+    def test_from_url(self):
+        self.assertIsInstance(self.cache, RedisCache)
+
+    def test_lost_reply(self):
+        """Only commands that are safe to run twice are retried"""
+
+        self.cache.set('n', 1)
+        read_reply = self.cache._read_reply
+
+        def lose_reply(reader):
+            read_reply(reader)
+            raise ConnectionError("connection closed by cache server")
+
+        with mock.patch.object(self.cache, '_read_reply', side_effect=lose_reply):
+            with self.assertRaises(ConnectionError):
+                self.cache.incr('n')
+        self.assertEqual(self.cache.get('n'), 2)
+
+        calls = []
+
+        def lose_first_reply(reader):
+            calls.append(1)
+            if len(calls) == 1:
+                read_reply(reader)
+                raise ConnectionError("connection closed by cache server")
+            return read_reply(reader)
+
+        with mock.patch.object(self.cache, '_read_reply', side_effect=lose_first_reply):
+            self.assertEqual(self.cache.get('n'), 2)
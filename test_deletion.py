@@ -0,0 +1,96 @@
+"""Account deletion tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_deletion.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from deletion import purge_user, purge_pending, purge_progress, Throttle
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class DeletionTestCase(TestCase):
+    """Test marking accounts deleted and purging them."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.doomed = User.signup("doomed", "doomed@test.com", "password", None)
+        self.other = User.signup("other", "other@test.com", "password", None)
+        db.session.commit()
+        self.doomed_id, self.other_id = self.doomed.id, self.other.id
+
+        messages = [Message(text=f"bye {i}", user_id=self.doomed_id) for i in range(5)]
+        kept = Message(text="stays", user_id=self.other_id)
+        db.session.add_all(messages + [kept])
+        db.session.commit()
+
+        db.session.add_all([Likes(user_id=self.other_id, message_id=msg.id)
+                            for msg in messages[:3]])
+        db.session.add(Likes(user_id=self.doomed_id, message_id=kept.id))
+        db.session.add_all([
+            Follows(user_following_id=self.doomed_id, user_being_followed_id=self.other_id),
+            Follows(user_following_id=self.other_id, user_being_followed_id=self.doomed_id),
+        ])
+        db.session.commit()
+
+        self.client = app.test_client()
+        self.no_pause = Throttle(duty=1, min_pause=0)
+
+    def test_delete_marks_and_logs_out(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.doomed_id
+
+            resp = c.post('/users/delete')
+            self.assertEqual(resp.status_code, 302)
+
+            with c.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+
+            self.assertEqual(c.get(f'/users/{self.doomed_id}').status_code, 404)
+            self.assertNotIn('@doomed', c.get('/users').get_data(as_text=True))
+
+        # nothing purged yet, but logging in no longer works
+        self.assertEqual(Message.query.filter_by(user_id=self.doomed_id).count(), 5)
+        self.assertFalse(User.authenticate("doomed", "password"))
+
+    def test_purge(self):
+        self.doomed.deleted_at = db.func.now()
+        db.session.commit()
+
+        self.assertEqual(purge_pending(batch_size=2, throttle=self.no_pause), 1)
+
+        self.assertIsNone(User.query.get(self.doomed_id))
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+
+        progress = purge_progress(self.doomed_id)
+        self.assertTrue(progress['done'])
+        self.assertEqual(progress['deleted']['messages'], 5)
+        self.assertEqual(progress['deleted']['likes'], 1)
+        self.assertEqual(progress['deleted']['follows'], 2)
+
+    def test_purge_reports_each_batch(self):
+        seen = []
+        purge_user(self.doomed_id, batch_size=2, throttle=self.no_pause,
+                   on_progress=lambda progress: seen.append(
+                       progress['deleted'].get('messages', 0)))
+
+        self.assertEqual(seen[:3], [2, 4, 5])
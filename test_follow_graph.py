@@ -0,0 +1,137 @@
+"""Follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from follow_graph import FollowGraph, SharedFollowGraph, follow_graph
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FollowGraphTestCase(TestCase):
+    """Test graph queries on a small in-memory graph."""
+
+    def setUp(self):
+        # 1 <-> 2, 1 -> 3, 3 -> 2, 4 -> 1
+        self.graph = FollowGraph.from_edges([1, 2, 1, 3, 4], [2, 1, 3, 2, 1])
+
+    def test_membership_and_degree(self):
+        self.assertTrue(self.graph.is_following(1, 3))
+        self.assertFalse(self.graph.is_following(3, 1))
+        self.assertFalse(self.graph.is_following(99, 1))
+        self.assertEqual(self.graph.following_count(1), 2)
+        self.assertEqual(self.graph.follower_count(2), 2)
+        self.assertEqual(list(self.graph.followers(1)), [2, 4])
+
+    def test_intersections(self):
+        self.assertEqual(list(self.graph.mutuals(1)), [2])
+        self.assertEqual(list(self.graph.common_following(1, 3)), [2])
+        # followers of 1 are 2 and 4; 2's follower 1 is excluded
+        self.assertEqual(list(self.graph.followers_of_followers(1)), [3])
+
+    def test_overlay(self):
+        self.graph.apply(3, 1, True)
+        self.graph.apply(1, 2, False)
+        self.graph.apply(5, 1, True)
+
+        self.assertTrue(self.graph.is_following(3, 1))
+        self.assertFalse(self.graph.is_following(1, 2))
+        self.assertEqual(list(self.graph.following(1)), [3])
+        self.assertEqual(list(self.graph.followers(1)), [2, 3, 4, 5])
+        self.assertEqual(self.graph.follower_count(1), 4)
+
+        self.graph.remove_user(1)
+        self.assertEqual(self.graph.follower_count(1), 0)
+        self.assertEqual(list(self.graph.following(3)), [2])
+
+
+class SharedFollowGraphTestCase(TestCase):
+    """Test the snapshot and journal shared between workers."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        users = [User.signup(f"graph{i}", f"graph{i}@test.com", "password", None)
+                 for i in range(3)]
+        db.session.commit()
+        self.u0, self.u1, self.u2 = [user.id for user in users]
+
+        db.session.add(Follows(user_following_id=self.u0,
+                               user_being_followed_id=self.u1))
+        db.session.commit()
+
+        self.dir = tempfile.TemporaryDirectory()
+        follow_graph.configure(self.dir.name)
+
+        # another worker sharing the same directory
+        self.other = SharedFollowGraph()
+        self.other.configure(self.dir.name)
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        follow_graph.configure(app.config['FOLLOW_GRAPH_DIR'])
+        self.dir.cleanup()
+
+    def test_reads_table_until_built(self):
+        self.assertTrue(follow_graph.is_following(self.u0, self.u1))
+        self.assertFalse(follow_graph.is_following(self.u1, self.u0))
+        self.assertFalse(os.path.exists(os.path.join(self.dir.name, 'current')))
+
+        follow_graph.ensure_snapshot()
+        self.assertEqual(follow_graph.graph().num_nodes, self.u1 + 1)
+        self.assertTrue(follow_graph.is_following(self.u0, self.u1))
+
+    def test_follow_routes_update_other_workers(self):
+        follow_graph.build()
+        self.assertEqual(self.other.follower_count(self.u2), 0)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u0
+
+            c.post(f'/users/follow/{self.u2}')
+            c.post(f'/users/stop-following/{self.u1}')
+
+        self.assertTrue(self.other.is_following(self.u0, self.u2))
+        self.assertFalse(self.other.is_following(self.u0, self.u1))
+
+    def test_rebuild(self):
+        follow_graph.build()
+        self.other.graph()
+
+        db.session.add(Follows(user_following_id=self.u2,
+                               user_being_followed_id=self.u0))
+        db.session.commit()
+        follow_graph.add_follow(self.u2, self.u0)
+        self.assertTrue(self.other.is_following(self.u2, self.u0))
+        self.assertEqual(self.other.graph().pending_changes, 1)
+
+        self.assertEqual(follow_graph.build(), 2)
+
+        self.assertEqual(self.other.graph().pending_changes, 0)
+        self.assertEqual(list(self.other.followers(self.u0)), [self.u2])
+
+        # the new snapshot starts an empty journal; the old one is gone
+        snapshots = [name for name in os.listdir(self.dir.name)
+                     if name.startswith('snapshot-')]
+        self.assertEqual(len(snapshots), 1)
+        self.assertEqual(os.path.getsize(
+            os.path.join(self.dir.name, snapshots[0], 'journal')), 0)
@@ -0,0 +1,174 @@
+"""Set-based follow tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follows.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from follows import (follow_users, unfollow_users, recount_follows, follow_page,
+                     BULK_FOLLOW_LIMIT)
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FollowsTestCase(TestCase):
+    """Test following and unfollowing without loading collections."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.users = [User.signup(f"user{i}", f"user{i}@test.com", "password", None)
+                      for i in range(5)]
+        db.session.commit()
+        self.ids = [user.id for user in self.users]
+
+        self.client = app.test_client()
+
+    def followed_by(self, user_id):
+        return {follow.user_being_followed_id for follow in
+                Follows.query.filter_by(user_following_id=user_id)}
+
+    def test_follow_users(self):
+        me, *others = self.ids
+        self.users[4].deleted_at = db.func.now()
+        db.session.commit()
+
+        followed = follow_users(me, others[:2])
+        db.session.commit()
+        self.assertEqual(sorted(followed), others[:2])
+
+        # existing follows, deleted users and yourself are skipped
+        followed = follow_users(me, others + [me, 999999])
+        db.session.commit()
+        self.assertEqual(sorted(followed), others[:3])
+        self.assertEqual(self.followed_by(me), set(others[:3]))
+
+        self.assertEqual(unfollow_users(me, [others[0], others[3]]), 1)
+        db.session.commit()
+        self.assertEqual(self.followed_by(me), set(others[1:3]))
+
+    def test_bulk_endpoint(self):
+        me, *others = self.ids
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = me
+
+            resp = c.post('/users/follow/bulk', json={'user_ids': others})
+            self.assertEqual(resp.get_json(), {'followed': 4})
+            self.assertEqual(self.followed_by(me), set(others))
+
+            resp = c.post('/users/follow/bulk',
+                          data={'user_ids': others[:2], 'unfollow': 'true'})
+            self.assertEqual(resp.get_json(), {'unfollowed': 2})
+            self.assertEqual(self.followed_by(me), set(others[2:]))
+
+            resp = c.post('/users/follow/bulk',
+                          json={'user_ids': list(range(BULK_FOLLOW_LIMIT + 1))})
+            self.assertEqual(resp.status_code, 400)
+
+    def test_bulk_endpoint_rejects_bad_bodies(self):
+        me, *others = self.ids
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = me
+
+            # a string would otherwise be read digit by digit
+            resp = c.post('/users/follow/bulk', json={'user_ids': str(others[0])})
+            self.assertEqual(resp.status_code, 400)
+
+            resp = c.post('/users/follow/bulk', json=others)
+            self.assertEqual(resp.status_code, 400)
+
+        self.assertEqual(self.followed_by(me), set())
+
+    def test_single_follow_routes(self):
+        me, other = self.ids[:2]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = me
+
+            c.post(f'/users/follow/{other}')
+            c.post(f'/users/follow/{other}')
+            self.assertEqual(self.followed_by(me), {other})
+
+            c.post(f'/users/stop-following/{other}')
+            self.assertEqual(self.followed_by(me), set())
+
+    def counts(self, user_id):
+        user = User.query.get(user_id)
+        db.session.refresh(user)
+        return user.followers_count, user.following_count
+
+    def test_counts(self):
+        me, *others = self.ids
+
+        follow_users(me, others)
+        db.session.commit()
+        self.assertEqual(self.counts(me), (0, 4))
+        self.assertEqual(self.counts(others[0]), (1, 0))
+
+        unfollow_users(me, others[:3])
+        db.session.commit()
+        self.assertEqual(self.counts(me), (0, 1))
+        self.assertEqual(self.counts(others[0]), (0, 0))
+
+        # ORM writes are counted too
+        db.session.add(Follows(user_following_id=others[0], user_being_followed_id=me))
+        self.users[1].following.append(self.users[2])
+        db.session.commit()
+        self.assertEqual(self.counts(me), (1, 1))
+        self.assertEqual(self.counts(others[0]), (0, 2))
+        self.assertEqual(self.counts(others[1]), (1, 0))
+
+        User.query.update({'followers_count': 7, 'following_count': 7})
+        recount_follows()
+        db.session.commit()
+        self.assertEqual(self.counts(me), (1, 1))
+        self.assertEqual(self.counts(others[3]), (1, 0))
+
+    def test_follow_page(self):
+        me, *others = self.ids
+        start = datetime(2020, 1, 1)
+        db.session.add_all([
+            Follows(user_following_id=other, user_being_followed_id=me,
+                    timestamp=start + timedelta(minutes=i))
+            for i, other in enumerate(others)])
+        db.session.commit()
+
+        seen, cursor = [], None
+        while True:
+            users, cursor = follow_page(me, 'followers', cursor, limit=3)
+            seen += [user.id for user in users]
+            if cursor is None:
+                break
+        self.assertEqual(seen, others[::-1])
+
+        users, cursor = follow_page(others[0], 'following')
+        self.assertEqual(([user.username for user in users], cursor), (['user0'], None))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = me
+
+            self.assertEqual(c.get(f'/users/{me}/followers?after=nope').status_code, 400)
+            html = c.get(f'/users/{me}/followers').get_data(as_text=True)
+            self.assertIn(f'<a href="/users/{me}/followers">4</a>', html)
+            self.assertIn('@user4', html)
@@ -0,0 +1,142 @@
+"""Fragment cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragments.py
+
+
+import os
+from unittest import TestCase
+
+from flask import render_template_string
+
+from models import db, User, Message, Follows
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from cache import cache
+from fragments import clear_fragment_cache, version_key
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class FragmentCacheTestCase(TestCase):
+    """Test caching of rendered message/user cards."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        clear_fragment_cache()
+
+        self.client = app.test_client()
+
+        self.user = User.signup(username="fraguser",
+                                email="frag@test.com",
+                                password="password",
+                                image_url=None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        msg = Message(text="first version", user_id=self.user_id)
+        db.session.add(msg)
+        db.session.commit()
+        self.msg_id = msg.id
+
+    def test_hit_skips_render(self):
+        """A second render of the same version comes from the cache"""
+
+        renders = []
+        template = ("{% call cache_fragment('card', msg) %}"
+                    "{{ count(msg) }}{% endcall %}")
+
+        with app.test_request_context():
+            msg = Message.query.get(self.msg_id)
+            for _ in range(3):
+                render_template_string(template, msg=msg,
+                                       count=renders.append)
+
+        self.assertEqual(len(renders), 1)
+
+    def test_message_update_invalidates(self):
+        """Editing a message re-renders its card on the timeline"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            html = c.get('/').get_data(as_text=True)
+            self.assertIn('first version', html)
+
+            msg = Message.query.get(self.msg_id)
+            msg.text = "second version"
+            db.session.commit()
+
+            html = c.get('/').get_data(as_text=True)
+            self.assertIn('second version', html)
+            self.assertNotIn('first version', html)
+
+    def test_evicted_version_misses(self):
+        """Losing a version token never brings back an older fragment"""
+
+        template = "{% call cache_fragment('card', msg) %}{{ msg.text }}{% endcall %}"
+
+        with app.test_request_context():
+            msg = Message.query.get(self.msg_id)
+            render_template_string(template, msg=msg)
+
+            msg.text = "second version"
+            db.session.commit()
+            cache.delete(version_key(msg))
+
+            self.assertEqual(render_template_string(template, msg=msg), "second version")
+
+    def test_token_changes_at_commit(self):
+        """A flushed but uncommitted edit keeps the old token"""
+
+        with app.test_request_context():
+            msg = Message.query.get(self.msg_id)
+            key = version_key(msg)
+            render_template_string("{% call cache_fragment('card', msg) %}{% endcall %}", msg=msg)
+            token = cache.get(key)
+
+            msg.text = "second version"
+            db.session.flush()
+            self.assertEqual(cache.get(key), token)
+
+            db.session.commit()
+            self.assertNotEqual(cache.get(key), token)
+
+    def test_author_update_invalidates(self):
+        """Renaming the author re-renders their message cards"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.get('/')
+
+            user = User.query.get(self.user_id)
+            user.username = "renamed"
+            db.session.commit()
+
+            html = c.get('/').get_data(as_text=True)
+            self.assertIn('@renamed', html)
+            self.assertNotIn('@fraguser', html)
+
+    def test_user_card_bio_invalidates(self):
+        """Changing a bio re-renders the card on /users"""
+
+        self.assertIn('BIO: None', self.client.get('/users').get_data(as_text=True))
+
+        user = User.query.get(self.user_id)
+        user.bio = "new bio"
+        db.session.commit()
+
+        html = self.client.get('/users').get_data(as_text=True)
+        self.assertIn('BIO: new bio', html)
@@ -0,0 +1,236 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+import jobs
+from app import app, CURR_USER_KEY
+from jobs import JobQueue, Worker, CronSchedule, queue
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class JobQueueTestCase(TestCase):
+    """Test queueing, retries, dedupe and periodic jobs."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.queue = JobQueue()
+        self.queue.configure(os.path.join(self.dir.name, 'jobs.sqlite'))
+        self.worker = Worker(app, self.queue)
+
+        self.calls = []
+        self.failures = 0
+
+        @self.queue.job('record')
+        def record(value, times=1):
+            self.calls.extend([value] * times)
+
+        @self.queue.job('flaky', max_attempts=3)
+        def flaky():
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError("not yet")
+            self.calls.append('flaky')
+
+        self.base = jobs.RETRY_BASE_SECONDS
+        jobs.RETRY_BASE_SECONDS = 0
+        self.lease = jobs.LEASE_SECONDS
+
+    def tearDown(self):
+        jobs.RETRY_BASE_SECONDS = self.base
+        jobs.LEASE_SECONDS = self.lease
+        self.dir.cleanup()
+
+    def state(self, job_id):
+        return self.queue._conn().execute(
+            "SELECT state, attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def test_run_with_args(self):
+        self.queue.enqueue('record', 'a', times=2)
+        self.queue.enqueue('record', 'b')
+
+        self.assertEqual(self.worker.run_pending(), 2)
+        self.assertEqual(self.calls, ['a', 'a', 'b'])
+
+        stats = self.queue.stats()['record']
+        self.assertEqual(stats['done'], 2)
+        self.assertIsNotNone(stats['run_seconds']['p95'])
+
+    def test_dedupe(self):
+        first = self.queue.enqueue('record', 1, dedupe_key='once')
+        self.assertIsNone(self.queue.enqueue('record', 2, dedupe_key='once'))
+
+        self.worker.run_pending()
+        self.assertIsNotNone(self.queue.enqueue('record', 3, dedupe_key='once'))
+        self.assertEqual(self.state(first), ('done', 1))
+
+    def test_retry_then_succeed(self):
+        self.failures = 1
+        job_id = self.queue.enqueue('flaky')
+
+        self.assertEqual(self.worker.run_pending(), 2)
+        self.assertEqual(self.state(job_id), ('done', 2))
+        self.assertEqual(self.calls, ['flaky'])
+
+    def test_gives_up(self):
+        self.failures = 5
+        job_id = self.queue.enqueue('flaky')
+
+        self.worker.run_pending()
+
+        self.assertEqual(self.state(job_id), ('failed', 3))
+        self.assertEqual(self.queue.stats()['flaky']['failed'], 1)
+
+    def test_backoff_delays_retry(self):
+        jobs.RETRY_BASE_SECONDS = 60
+        self.failures = 1
+        job_id = self.queue.enqueue('flaky')
+
+        self.assertEqual(self.worker.run_pending(), 1)
+        self.assertEqual(self.state(job_id), ('queued', 1))
+
+    def test_lease_renewed_while_running(self):
+        jobs.LEASE_SECONDS = 0.3
+
+        @self.queue.job('slow')
+        def slow():
+            time.sleep(1)
+            self.calls.append(self.queue.claim('other worker'))
+
+        job_id = self.queue.enqueue('slow')
+
+        self.assertEqual(self.worker.run_pending(), 1)
+        self.assertEqual(self.calls, [None])
+        self.assertEqual(self.state(job_id), ('done', 1))
+
+    def test_expired_lease_on_last_attempt_fails(self):
+        jobs.LEASE_SECONDS = 0
+        job_id = self.queue.enqueue('flaky')
+
+        # three workers die holding it
+        for worker in ('a', 'b', 'c'):
+            self.assertIsNotNone(self.queue.claim(worker))
+            time.sleep(0.01)
+
+        self.assertIsNone(self.queue.claim('d'))
+        self.assertEqual(self.state(job_id), ('failed', 3))
+
+    def test_lost_lease_cannot_finish(self):
+        jobs.LEASE_SECONDS = 0
+        job_id = self.queue.enqueue('record', 1)
+        stale = self.queue.claim('a')
+        time.sleep(0.01)
+        jobs.LEASE_SECONDS = 60
+        current = self.queue.claim('b')
+
+        self.assertFalse(self.queue.complete(stale, 'a'))
+        self.assertFalse(self.queue.fail(stale, 'a', "late"))
+        self.assertEqual(self.state(job_id), ('running', 2))
+
+        self.assertTrue(self.queue.complete(current, 'b'))
+        self.assertEqual(self.state(job_id), ('done', 2))
+
+    def test_unknown_job_fails(self):
+        job_id = self.queue.enqueue('flaky')
+        del self.queue.registry['flaky']
+
+        # retried without backoff, up to its max_attempts
+        self.assertEqual(self.worker.run_pending(), 3)
+        state, error = self.queue._conn().execute(
+            "SELECT state, last_error FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        self.assertEqual(state, 'failed')
+        self.assertIn('UnknownJob', error)
+
+    def test_cron_either_day(self):
+        # the 1st of the month, and every Monday
+        schedule = CronSchedule('0 9 1 * 1')
+
+        self.assertTrue(schedule.matches(datetime(2022, 6, 1, 9, 0)))  # Wednesday
+        self.assertTrue(schedule.matches(datetime(2022, 6, 6, 9, 0)))  # Monday
+        self.assertFalse(schedule.matches(datetime(2022, 6, 7, 9, 0)))
+
+        # with one of them unrestricted, both must match
+        self.assertFalse(CronSchedule('0 9 */2 * 1').matches(datetime(2022, 6, 1, 9, 0)))
+
+    def test_cron(self):
+        schedule = CronSchedule('*/15 9-17 * * 1-5')
+
+        self.assertTrue(schedule.matches(datetime(2022, 6, 1, 9, 30)))
+        self.assertFalse(schedule.matches(datetime(2022, 6, 1, 9, 31)))
+        self.assertFalse(schedule.matches(datetime(2022, 6, 4, 9, 30)))  # Saturday
+        self.assertTrue(schedule.due(datetime(2022, 6, 1, 9, 1),
+                                     datetime(2022, 6, 1, 9, 16)))
+
+        self.queue.periodic('*/15 * * * *', 'record', 'tick')
+        self.assertEqual(self.queue.enqueue_due(datetime(2022, 6, 1, 9, 1)), [])
+        self.assertEqual(self.queue.enqueue_due(datetime(2022, 6, 1, 9, 16)), ['record'])
+        self.assertEqual(self.queue.enqueue_due(datetime(2022, 6, 1, 9, 16)), [])
+
+        self.worker.run_pending()
+        self.assertEqual(self.calls, ['tick'])
+
+    def test_thread_pool(self):
+        for i in range(20):
+            self.queue.enqueue('record', i)
+
+        worker = Worker(app, self.queue, threads=4, poll_seconds=0.05)
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+
+        deadline = time.time() + 10
+        while len(self.calls) < 20 and time.time() < deadline:
+            time.sleep(0.05)
+        worker.stop()
+        thread.join()
+
+        self.assertEqual(sorted(self.calls), list(range(20)))
+
+
+class PurgeJobTestCase(TestCase):
+    """Test that deleting an account queues its purge."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.dir = tempfile.TemporaryDirectory()
+        queue.configure(os.path.join(self.dir.name, 'jobs.sqlite'))
+
+        user = User.signup("leaving", "leaving@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+    def tearDown(self):
+        queue.configure(app.config['JOBS_DB_PATH'])
+        self.dir.cleanup()
+
+    def test_delete_queues_purge(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            c.post('/users/delete')
+
+        self.assertIsNotNone(User.query.get(self.user_id))
+        db.session.remove()
+
+        self.assertEqual(Worker(app).run_pending(), 1)
+        self.assertIsNone(User.query.get(self.user_id))
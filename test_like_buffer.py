@@ -0,0 +1,171 @@
+"""Like buffer tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_like_buffer.py
+
+
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from like_buffer import like_buffer, LOG_RECORD
+from trending import trending
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class LikeBufferTestCase(TestCase):
+    """Test buffering like toggles and writing them in batches."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.users = [User.signup(f"liker{i}", f"liker{i}@test.com", "password", None)
+                      for i in range(2)]
+        db.session.commit()
+        self.me, self.author = [user.id for user in self.users]
+
+        self.messages = [Message(text=f"message {i}", user_id=self.author) for i in range(3)]
+        db.session.add_all(self.messages)
+        db.session.commit()
+        self.message_ids = [msg.id for msg in self.messages]
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.app_config = dict(app.config)
+        app.config['LIKE_BUFFER_DIR'] = self.tmp.name
+        # only explicit flushes in these tests
+        app.config['LIKE_FLUSH_MS'] = 60_000
+
+        like_buffer.configure(app)
+        self.buffer = like_buffer
+        trending_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(trending_dir.cleanup)
+        trending.configure(os.path.join(trending_dir.name, 'trending.bin'))
+
+    def tearDown(self):
+        self.buffer.close()
+        app.config.update(self.app_config)
+        self.buffer.configure(app)
+        trending.configure(app.config['TRENDING_PATH'])
+
+    def liked(self):
+        return {(like.user_id, like.message_id) for like in Likes.query}
+
+    def test_toggle_and_flush(self):
+        first, second, third = self.message_ids
+        db.session.add(Likes(user_id=self.me, message_id=third))
+        db.session.commit()
+
+        with app.app_context():
+            self.assertTrue(self.buffer.toggle(self.me, first))
+            self.assertFalse(self.buffer.toggle(self.me, first))
+            self.assertTrue(self.buffer.toggle(self.me, first))
+            self.assertTrue(self.buffer.toggle(self.me, second))
+            self.assertFalse(self.buffer.toggle(self.me, third))
+
+            # nothing written yet, but this process sees its own toggles
+            self.assertEqual(self.liked(), {(self.me, third)})
+            self.assertEqual(self.buffer.overlay(self.me, {third}), {first, second})
+            self.assertEqual(self.buffer.overlay(self.author, set()), set())
+
+            # the net change: two inserts and a delete
+            self.assertEqual(self.buffer.flush(), 3)
+            self.assertEqual(self.buffer.flush(), 0)
+
+        db.session.expire_all()
+        self.assertEqual(self.liked(), {(self.me, first), (self.me, second)})
+        # the written log is gone
+        names = sorted(os.listdir(self.tmp.name))
+        self.assertEqual(names[0], '.recover.lock')
+        self.assertEqual([name.split('.', 1)[1] for name in names[1:]], ['lock', 'log'])
+        self.assertTrue(names[1].startswith(f"likes-{os.getpid()}-"))
+
+    def test_recover(self):
+        first, second, third = self.message_ids
+
+        # a process that had our pid before us, and left its lock file unlocked
+        dead = f"likes-{os.getpid()}-0123456789ab"
+        open(os.path.join(self.tmp.name, f"{dead}.lock"), 'w').close()
+        log_path = os.path.join(self.tmp.name, f"{dead}.log")
+        with open(f"{log_path}.00000001.flushing", 'wb') as f:
+            f.write(LOG_RECORD.pack(self.me, first, True))
+            f.write(LOG_RECORD.pack(self.me, second, True))
+        with open(log_path, 'wb') as f:
+            f.write(LOG_RECORD.pack(self.me, second, False))
+            f.write(LOG_RECORD.pack(self.me, third, True))
+            # cut off by the crash
+            f.write(LOG_RECORD.pack(self.me, first, False)[:5])
+
+        with app.app_context():
+            self.assertTrue(self.buffer.toggle(self.author, first))
+            self.buffer.flush()
+
+        db.session.expire_all()
+        self.assertEqual(self.liked(), {(self.me, first), (self.me, third), (self.author, first)})
+        self.assertFalse([name for name in os.listdir(self.tmp.name) if dead in name])
+
+        # recovered likes count like flushed ones
+        scores = dict(trending.top())
+        self.assertEqual(set(scores), {first, third})
+        self.assertAlmostEqual(scores[first], 2, places=2)
+        self.assertAlmostEqual(scores[third], 1, places=2)
+
+    def test_running_process_logs_left_alone(self):
+        running = "likes-1-0123456789ab"
+        lock_path = os.path.join(self.tmp.name, f"{running}.lock")
+        with open(os.path.join(self.tmp.name, f"{running}.log"), 'wb') as f:
+            f.write(LOG_RECORD.pack(self.me, self.message_ids[0], True))
+
+        # another process holding its lock, as a live buffer does
+        holder = subprocess.Popen(
+            [sys.executable, '-c',
+             'import fcntl, sys; f = open(sys.argv[1], "w"); '
+             'fcntl.lockf(f, fcntl.LOCK_EX); print(flush=True); sys.stdin.read()',
+             lock_path],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.addCleanup(holder.wait)
+        self.addCleanup(holder.stdin.close)
+        holder.stdout.readline()
+
+        with app.app_context():
+            self.buffer.toggle(self.author, self.message_ids[1])
+            self.assertEqual(self.buffer.recover(), 0)
+
+        self.assertEqual(self.liked(), set())
+        self.assertIn(f"{running}.log", os.listdir(self.tmp.name))
+
+    def test_handle_like(self):
+        message_id = self.message_ids[0]
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.me
+
+            resp = c.post(f'/users/handle_like/{message_id}',
+                          headers={'X-Requested-With': 'XMLHttpRequest'})
+            self.assertEqual(resp.get_json(), {'liked': True})
+
+            # the form post writes before redirecting
+            resp = c.post(f'/users/handle_like/{message_id}')
+            self.assertEqual(resp.status_code, 302)
+            db.session.expire_all()
+            self.assertEqual(self.liked(), set())
+
+            resp = c.post('/users/handle_like/999999',
+                          headers={'X-Requested-With': 'XMLHttpRequest'})
+            self.assertEqual(resp.status_code, 404)
+        self.assertEqual(self.buffer.overlay(self.me, set()), set())
@@ -0,0 +1,106 @@
+"""Live timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_live.py
+
+
+import asyncio
+import os
+import socket
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from follow_graph import FollowGraph
+from live import Hub, Subscriber, LiveServer, SocketTransport, transport_for
+
+
+class LiveTestCase(TestCase):
+    """Test fanning new messages out to open event streams."""
+
+    def setUp(self):
+        # 2 and 3 follow 1
+        self.graph = FollowGraph.from_edges([2, 3], [1, 1])
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_hub(self):
+        async def run():
+            hub = Hub(self.graph.followers)
+            author, follower, other = Subscriber(1), Subscriber(2), Subscriber(4)
+            small = Subscriber(3, max_pending=2)
+            for subscriber in (author, follower, other, small):
+                hub.subscribe(subscriber)
+
+            for message_id in (10, 11, 12):
+                hub.deliver(1, message_id)
+
+            self.assertEqual(author.take(), ([10, 11, 12], False))
+            self.assertEqual(follower.take(), ([10, 11, 12], False))
+            self.assertFalse(other.ready.is_set())
+            # too far behind: told to reload instead
+            self.assertEqual(small.take(), ([], True))
+            self.assertFalse(small.ready.is_set())
+
+            hub.unsubscribe(follower)
+            hub.deliver(1, 13)
+            self.assertEqual(follower.pending, [])
+            self.assertEqual(list(hub.subscribers), [1, 4, 3])
+
+        asyncio.run(run())
+
+    def test_transport_for(self):
+        self.assertIsNone(transport_for(''))
+        self.assertEqual(transport_for('unix:///tmp/x/live.sock').path, '/tmp/x/live.sock')
+        with self.assertRaises(ValueError):
+            transport_for('carrier-pigeon://')
+
+    def test_stream(self):
+        transport = SocketTransport(os.path.join(self.tmp.name, 'live.sock'))
+        serializer = app.session_interface.get_signing_serializer(app)
+        cookie = f"session={serializer.dumps({CURR_USER_KEY: 2})}"
+
+        async def get(port, headers=""):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(f"GET /live HTTP/1.1\r\nHost: x\r\n{headers}\r\n".encode())
+            await writer.drain()
+            status = await reader.readline()
+            await reader.readuntil(b'\r\n\r\n')
+            return status, reader, writer
+
+        async def run():
+            hub = Hub(self.graph.followers)
+            await transport.subscribe(hub.deliver)
+
+            listener = socket.socket()
+            listener.bind(('127.0.0.1', 0))
+            listener.listen()
+            live_server = LiveServer(app, hub)
+            server = await asyncio.start_server(live_server.handle, sock=listener)
+            port = listener.getsockname()[1]
+
+            status, reader, writer = await get(port)
+            self.assertIn(b'401', status)
+            writer.close()
+
+            status, reader, writer = await get(port, f"Cookie: {cookie}\r\n")
+            self.assertIn(b'200', status)
+            self.assertEqual(await reader.readuntil(b'\n\n'), b'retry: 5000\n\n')
+
+            transport.publish(1, 20)
+            transport.publish(4, 21)
+            transport.publish(1, 22)
+            event = await asyncio.wait_for(reader.readuntil(b'\n\n'), 5)
+            self.assertEqual(event, b'id: 22\nevent: messages\ndata: [20, 22]\n\n')
+
+            writer.close()
+            server.close()
+            live_server.close_streams()
+            await server.wait_closed()
+
+        asyncio.run(run())
@@ -0,0 +1,134 @@
+"""Notification tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_notifications.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Likes, Follows, Notification
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from like_buffer import like_buffer
+from notifications import notify, prune
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class NotificationsTestCase(TestCase):
+    """Test recording, folding and reading notifications."""
+
+    def setUp(self):
+        Notification.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.users = [User.signup(f"notified{i}", f"notified{i}@test.com", "password", None)
+                      for i in range(4)]
+        db.session.commit()
+        self.author, *self.fans = [user.id for user in self.users]
+
+        msg = Message(text="like me", user_id=self.author)
+        db.session.add(msg)
+        db.session.commit()
+        self.message_id = msg.id
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.buffer_dir = app.config['LIKE_BUFFER_DIR']
+        app.config['LIKE_BUFFER_DIR'] = self.tmp.name
+        like_buffer.configure(app)
+
+    def tearDown(self):
+        like_buffer.close()
+        app.config['LIKE_BUFFER_DIR'] = self.buffer_dir
+        like_buffer.configure(app)
+
+    def login(self, client, user_id):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def unread(self):
+        db.session.expire_all()
+        return User.query.get(self.author).unread_notifications
+
+    def test_likes_fold(self):
+        with app.app_context():
+            for user_id in self.fans + [self.author]:
+                like_buffer.toggle(user_id, self.message_id)
+            # unliked and liked again before the flush: still one like
+            like_buffer.toggle(self.fans[0], self.message_id)
+            like_buffer.toggle(self.fans[0], self.message_id)
+            like_buffer.flush()
+
+        notification = Notification.query.one()
+        self.assertEqual((notification.recipient_id, notification.kind, notification.message_id,
+                          notification.actor_id, notification.actor_count),
+                         (self.author, 'like', self.message_id, self.fans[2], 3))
+        self.assertEqual(self.unread(), 1)
+
+        with app.test_client() as c:
+            self.login(c, self.author)
+            resp = c.get('/notifications')
+            self.assertIn(b"notified3</a>", resp.data)
+            self.assertIn(b"and 2 others", resp.data)
+            self.assertIn(b"liked your warble", resp.data)
+            self.assertIn(b"list-group-item-info", resp.data)
+        self.assertEqual(self.unread(), 0)
+
+        # read: the next like starts a new row
+        with app.app_context():
+            like_buffer.toggle(self.fans[0], self.message_id)
+            like_buffer.flush()
+            like_buffer.toggle(self.fans[0], self.message_id)
+            like_buffer.flush()
+        self.assertEqual(Notification.query.count(), 2)
+        self.assertEqual(self.unread(), 1)
+
+    def test_follows_and_mentions(self):
+        with app.test_client() as c:
+            for fan in self.fans[:2]:
+                self.login(c, fan)
+                c.post(f'/users/follow/{self.author}')
+            c.post('/messages/new', data={'text': "hi @notified0 and @notified0"})
+
+            self.login(c, self.author)
+            self.assertIn(b'badge-danger">2</span>', c.get('/').data)
+
+            data = c.get('/api/v1/notifications').get_json()
+            self.assertEqual([(n['kind'], n['actor_id'], n['actor_count'], n['read'])
+                              for n in data['notifications']],
+                             [('mention', self.fans[1], 1, False),
+                              ('follow', self.fans[1], 2, False)])
+            self.assertEqual(data['unread'], 2)
+            self.assertEqual(set(data['users']), {str(self.fans[1])})
+            self.assertEqual([m['text'] for m in data['messages'].values()],
+                             ["hi @notified0 and @notified0"])
+
+            self.assertEqual(c.post('/api/v1/notifications/read').get_json(), {'unread': 0})
+            self.assertNotIn(b'badge-danger', c.get('/').data)
+
+        self.assertEqual(prune(days=0), 2)
+
+    def test_notify(self):
+        notify(self.author, 'follow', [self.author])
+        self.assertEqual(Notification.query.count(), 0)
+
+        db.session.add(Notification(recipient_id=self.author, kind='follow',
+                                    actor_id=self.fans[0]))
+        db.session.flush()
+        notify(self.author, 'follow', [self.fans[1], self.fans[2]])
+        db.session.commit()
+
+        notification = Notification.query.one()
+        self.assertEqual((notification.actor_id, notification.actor_count), (self.fans[2], 3))
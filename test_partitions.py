@@ -0,0 +1,127 @@
+"""Message partitioning and archive tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_partitions.py
+
+
+import os
+import tempfile
+from collections import namedtuple
+from datetime import date, datetime
+from unittest import TestCase, skipUnless
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from partitions import (archive_rows, add_to_manifest, find_archived_message,
+                        partition_messages, ensure_partitions, partitions,
+                        archive_partitions, add_months, is_partitioned)
+
+db.create_all()
+
+Row = namedtuple('Row', 'id text timestamp user_id')
+
+
+class ArchiveTestCase(TestCase):
+    """Test writing and resolving archived messages."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        user = User.signup("archived", "archived@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.archive_dir = self.dir.name
+        app.config['MESSAGE_ARCHIVE_DIR'] = self.archive_dir
+
+        rows = [Row(i, f"old warble {i} ✓", datetime(2020, 1, 1, 12, i), self.user_id)
+                for i in range(1, 26)]
+        add_to_manifest(self.archive_dir,
+                        archive_rows(rows, self.archive_dir, 'messages_y2020m01',
+                                     chunk_rows=10))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_chunks(self):
+        self.assertEqual(len(os.listdir(os.path.join(self.archive_dir,
+                                                     'messages_y2020m01'))), 3)
+
+    def test_find_archived(self):
+        msg = find_archived_message(self.archive_dir, 17)
+
+        self.assertEqual(msg.text, "old warble 17 ✓")
+        self.assertEqual(msg.timestamp, datetime(2020, 1, 1, 12, 17))
+        self.assertEqual(msg.user.username, "archived")
+        self.assertIsNone(find_archived_message(self.archive_dir, 99))
+
+    def test_show_archived_message(self):
+        resp = app.test_client().get('/messages/5')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("old warble 5", resp.get_data(as_text=True))
+
+
+@skipUnless(db.engine.dialect.name == 'postgresql', "partitioning needs Postgres")
+class PartitionTestCase(TestCase):
+    """Test monthly partitions and archival of old ones."""
+
+    def setUp(self):
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+        user = User.signup("partitioned", "part@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        self.dir.cleanup()
+
+    def test_partition_and_archive(self):
+        old = Message(text="from last year", user_id=self.user_id,
+                      timestamp=datetime(2021, 3, 4))
+        db.session.add(old)
+        db.session.flush()
+        old_id = old.id
+        db.session.commit()
+        # a session left in a transaction would hold a lock on messages that
+        # the ALTER TABLEs below wait for
+        db.session.remove()
+
+        today = date.today().replace(day=1)
+        with db.engine.begin() as conn:
+            partition_messages(conn)
+            ensure_partitions(conn, months_ahead=2)
+
+            self.assertTrue(is_partitioned(conn))
+            months = [month for name, month in partitions(conn)]
+            self.assertEqual(months[0], date(2021, 3, 1))
+            self.assertEqual(months[-1], add_months(today, 3))
+
+        db.session.add(Message(text="new", user_id=self.user_id))
+        db.session.commit()
+        db.session.remove()
+
+        with db.engine.begin() as conn:
+            archived = archive_partitions(conn, self.dir.name, after_months=6)
+
+        self.assertIn('messages_y2021m03', archived)
+        self.assertIsNone(Message.query.get(old_id))
+        self.assertEqual(Message.query.count(), 1)
+        self.assertEqual(find_archived_message(self.dir.name, old_id).text,
+                         "from last year")
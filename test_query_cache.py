@@ -0,0 +1,151 @@
+"""Query result cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_cache.py
+
+
+import os
+from unittest import TestCase
+
+from flask import g
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from cache import cache
+from query_cache import cached_all, mark_stale, _cache_key
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class QueryCacheTestCase(TestCase):
+    """Test caching and invalidation of query results."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+        cache.clear()
+
+        self.client = app.test_client()
+
+        u1 = User.signup("qcuser1", "qc1@test.com", "password", None)
+        u2 = User.signup("qcuser2", "qc2@test.com", "password", None)
+        db.session.commit()
+        self.u1_id, self.u2_id = u1.id, u2.id
+
+        db.session.add(Message(text="cached message", user_id=self.u1_id))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def messages_query(self, user_id):
+        return Message.query.filter(Message.user_id == user_id)
+
+    def test_hit_does_not_query(self):
+        """A second read is served from the cache, not the database"""
+
+        with app.test_request_context():
+            g.cache_queries = True
+            cached_all(self.messages_query(self.u1_id), ('messages', self.u1_id))
+
+            # written behind the ORM's back, so nothing is invalidated
+            db.session.execute(Message.__table__.insert().values(
+                text="sneaky", user_id=self.u1_id, timestamp=db.func.now()))
+
+            msgs = cached_all(self.messages_query(self.u1_id), ('messages', self.u1_id))
+            self.assertEqual([m.text for m in msgs], ["cached message"])
+
+    def test_consistent_after_write_in_same_request(self):
+        """A flushed (uncommitted) write is visible to the next cached read"""
+
+        with app.test_request_context():
+            g.cache_queries = True
+            cached_all(self.messages_query(self.u1_id), ('messages', self.u1_id))
+
+            db.session.add(Message(text="fresh", user_id=self.u1_id))
+            db.session.flush()
+
+            msgs = cached_all(self.messages_query(self.u1_id), ('messages', self.u1_id))
+            self.assertIn("fresh", [m.text for m in msgs])
+
+    def test_other_partition_untouched(self):
+        """A write by one user leaves another user's entries valid"""
+
+        with app.test_request_context():
+            query = self.messages_query(self.u1_id)
+            key = _cache_key(query, [('messages', self.u1_id)])
+
+            db.session.add(Message(text="elsewhere", user_id=self.u2_id))
+            db.session.commit()
+
+            self.assertEqual(_cache_key(query, [('messages', self.u1_id)]), key)
+
+    def test_evicted_version_misses(self):
+        """Losing a version never brings back an entry from before a write"""
+
+        with app.test_request_context():
+            query = self.messages_query(self.u1_id)
+            key = _cache_key(query, [('messages', self.u1_id)])
+
+            cache.delete(f"qversion:messages:{self.u1_id}")
+            self.assertNotEqual(_cache_key(query, [('messages', self.u1_id)]), key)
+
+    def test_counter_write_scoped_to_user(self):
+        """Counter updates leave other users' follow pages cached; renames don't"""
+
+        with app.test_request_context():
+            query = User.query.filter(User.id == self.u2_id)
+            key = _cache_key(query, ['users'])
+
+            # what notifications do for an unread count
+            mark_stale(db.session, 'users', self.u1_id)
+            db.session.commit()
+            self.assertEqual(_cache_key(query, ['users']), key)
+
+            User.query.get(self.u1_id).bio = "new bio"
+            db.session.commit()
+            self.assertNotEqual(_cache_key(query, ['users']), key)
+
+    def test_follow_refreshes_following_page(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = c.get(f'/users/{self.u1_id}/following').get_data(as_text=True)
+            self.assertNotIn('@qcuser2', html)
+
+            c.post(f'/users/follow/{self.u2_id}')
+
+            html = c.get(f'/users/{self.u1_id}/following').get_data(as_text=True)
+            self.assertIn('@qcuser2', html)
+
+    def test_no_password_in_cache(self):
+        """Cached users leave out password hashes, even fully loaded ones"""
+
+        db.session.add(Follows(user_being_followed_id=self.u2_id, user_following_id=self.u1_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+            # qcuser1, the viewer (g.user), is in the list
+            c.get(f'/users/{self.u2_id}/followers')
+            html = c.get(f'/users/{self.u2_id}/followers').get_data(as_text=True)
+            self.assertIn('@qcuser1', html)
+
+        # the test app uses the per-process LRU: entries are (expiry, pickle)
+        password = User.query.get(self.u1_id).password.encode()
+        blobs = [blob for expires_at, blob in cache._data.values() if isinstance(blob, bytes)]
+        self.assertTrue(any(b'qcuser1' in blob for blob in blobs))
+        self.assertFalse(any(password in blob for blob in blobs))
@@ -0,0 +1,121 @@
+"""Who-to-follow recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_recommendations.py
+
+
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from cache import cache
+from follow_graph import follow_graph
+from jobs import queue
+from recommendations import refresh, recommendations_for
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class RecommendationTestCase(TestCase):
+    """Test suggestions for a user on a small follow graph."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+        cache.clear()
+
+        users = {name: User.signup(name, f"{name}@test.com", "password", None)
+                 for name in ("alice", "bob", "carol", "dave", "erin")}
+        db.session.commit()
+        self.ids = {name: user.id for name, user in users.items()}
+
+        # alice -> bob -> carol, dave; erin follows alice and dave
+        for follower, followed in (("alice", "bob"), ("bob", "carol"),
+                                   ("bob", "dave"), ("erin", "alice"),
+                                   ("erin", "dave")):
+            db.session.add(Follows(user_following_id=self.ids[follower],
+                                   user_being_followed_id=self.ids[followed]))
+        db.session.add_all([Message(text=f"dave {i}", user_id=self.ids["dave"])
+                            for i in range(3)])
+        db.session.commit()
+
+        self.dir = tempfile.TemporaryDirectory()
+        follow_graph.configure(self.dir.name)
+        queue.configure(os.path.join(self.dir.name, 'jobs.sqlite'))
+
+    def tearDown(self):
+        follow_graph.configure(app.config['FOLLOW_GRAPH_DIR'])
+        queue.configure(app.config['JOBS_DB_PATH'])
+        self.dir.cleanup()
+
+    def test_ranking(self):
+        suggested = recommendations_for(self.ids["alice"])
+
+        # dave: friend of a friend, followed by alice's follower, and active
+        self.assertEqual([user.username for user in suggested], ["dave", "carol"])
+
+    def test_skips_soft_deleted(self):
+        dave = User.query.get(self.ids["dave"])
+        dave.deleted_at = db.func.now()
+        db.session.commit()
+
+        self.assertEqual([user.username for user in
+                          recommendations_for(self.ids["alice"])], ["carol"])
+
+    def test_refresh_only_stale(self):
+        refreshed, seconds = refresh()
+        self.assertEqual(refreshed, 5)
+
+        self.assertEqual(refresh()[0], 0)
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids["alice"]
+            c.post(f'/users/follow/{self.ids["dave"]}')
+
+        # alice and dave's follows changed
+        self.assertEqual(refresh()[0], 2)
+        self.assertEqual([user.username for user in
+                          recommendations_for(self.ids["alice"])], ["carol"])
+
+    def test_stale_served_while_refreshing(self):
+        alice = self.ids["alice"]
+        recommendations_for(alice)
+        db.session.add(Follows(user_following_id=alice,
+                               user_being_followed_id=self.ids["dave"]))
+        db.session.commit()
+
+        # the old suggestions, until the queued job has run
+        self.assertEqual([user.username for user in recommendations_for(alice)],
+                         ["dave", "carol"])
+        recommendations_for(alice)
+        jobs = queue._conn().execute("SELECT name, args FROM jobs").fetchall()
+        self.assertEqual(jobs, [('refresh-recommendations',
+                                 json.dumps([[[alice]], {}]))])
+
+        fn = queue.registry['refresh-recommendations'][0]
+        fn(*json.loads(jobs[0][1])[0])
+        self.assertEqual([user.username for user in recommendations_for(alice)],
+                         ["carol"])
+
+    def test_home_sidebar(self):
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids["alice"]
+
+            html = c.get('/').get_data(as_text=True)
+
+        self.assertIn('Who to follow', html)
+        self.assertIn('@dave', html)
@@ -0,0 +1,160 @@
+"""Read-replica routing tests."""
+
+# run these tests like:
+#
+#    createdb warbler-test-replica
+#    python -m unittest test_routing.py
+#
+# The replica is a separate, unreplicated database, so every test can tell
+# which one served a query by what it sees.
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from cache import cache
+from routing import READ_YOUR_WRITES_KEY
+
+REPLICA_URI = "postgresql:///warbler-test-replica"
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class RoutingTestCase(TestCase):
+    """Test which database serves each kind of request."""
+
+    def setUp(self):
+        """Point the app at a replica holding different data."""
+
+        db.configure_replicas(app, [REPLICA_URI])
+        self.replica = db.get_engine(app, bind='replica_0')
+        db.Model.metadata.drop_all(bind=self.replica)
+        db.Model.metadata.create_all(bind=self.replica)
+
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+        cache.clear()
+
+        self.user = User.signup("primaryuser", "p@test.com", "password", None)
+        other = User.signup("otheruser", "o@test.com", "password", None)
+        db.session.commit()
+        self.user_id, self.other_id = self.user.id, other.id
+
+        # same ids on the replica, different usernames
+        for user_id, username in ((self.user_id, "replicauser"),
+                                  (self.other_id, "replicaother")):
+            self.replica.execute(User.__table__.insert().values(
+                id=user_id, username=username, email=f"{username}@test.com",
+                password="x"))
+
+        # start the requests with a session that has not written yet
+        db.session.remove()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.configure_replicas(app, [])
+
+    def test_get_reads_replica(self):
+        html = self.client.get('/users').get_data(as_text=True)
+
+        self.assertIn('@replicauser', html)
+        self.assertNotIn('@primaryuser', html)
+
+    def test_write_goes_to_primary(self):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post(f'/users/follow/{self.other_id}')
+
+        self.assertEqual(Follows.query.count(), 1)
+        count = self.replica.execute(
+            db.select([db.func.count()]).select_from(Follows.__table__)).scalar()
+        self.assertEqual(count, 0)
+
+    def test_read_your_writes_window(self):
+        """Right after a write the same browser reads from the primary"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post(f'/users/follow/{self.other_id}')
+
+            with c.session_transaction() as sess:
+                self.assertIn(READ_YOUR_WRITES_KEY, sess)
+
+            html = c.get('/users').get_data(as_text=True)
+            self.assertIn('@primaryuser', html)
+
+            with c.session_transaction() as sess:
+                sess[READ_YOUR_WRITES_KEY] = 0
+
+            # cards rendered from the primary's (different) rows
+            cache.clear()
+
+            html = c.get('/users').get_data(as_text=True)
+            self.assertIn('@replicauser', html)
+
+    def test_reads_after_write_in_session(self):
+        """Once a session has flushed a write, it stays on the primary"""
+
+        with app.test_request_context('/users'):
+            self.assertEqual(User.query.get(self.user_id).username, "replicauser")
+            db.session.remove()
+
+            db.session.add(Message(text="hi", user_id=self.user_id))
+            db.session.flush()
+
+            user = User.query.filter_by(id=self.user_id).one()
+            self.assertEqual(user.username, "primaryuser")
+            db.session.rollback()
+
+    def test_replica_reads_not_cached(self):
+        """Rows from a (possibly lagging) replica don't go into the query cache"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+            c.get(f'/users/{self.user_id}/following')
+
+        self.assertFalse([key for key in cache._data if key.startswith('query:')])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[READ_YOUR_WRITES_KEY] = float('inf')
+            c.get(f'/users/{self.user_id}/following')
+
+        self.assertTrue([key for key in cache._data if key.startswith('query:')])
+
+    def test_one_replica_per_session(self):
+        """Every read of a request goes to the replica its first read picked"""
+
+        db.configure_replicas(app, [REPLICA_URI, REPLICA_URI])
+
+        with app.test_request_context('/users'):
+            session = db.session()
+            engines = {session.get_bind(User.__mapper__) for _ in range(4)}
+            self.assertEqual(len(engines), 1)
+            db.session.remove()
+
+            # the next session takes the next replica
+            self.assertNotIn(db.session().get_bind(User.__mapper__), engines)
+
+    def test_unhealthy_replica_skipped(self):
+        db.configure_replicas(app, ["postgresql://nobody@127.0.0.1:1/nothing"])
+
+        html = self.client.get('/users').get_data(as_text=True)
+
+        self.assertIn('@primaryuser', html)
@@ -0,0 +1,193 @@
+"""Message/like sharding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sharding.py
+#
+# The shards are throwaway SQLite files; users stay on warbler-test.
+
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
+
+from sqlalchemy import select, func
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User, Message, Follows, Likes, ShardDirectory
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from cache import cache
+from sharding import shards, shard_messages, shard_likes, SHARD_SLOTS
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ShardingTestCase(TestCase):
+    """Test routing of messages and likes to three shards."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        shards.configure([f"sqlite:///{self.dir.name}/shard{i}.db"
+                          for i in range(3)])
+        shards.create_tables()
+
+        ShardDirectory.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+        cache.clear()
+
+        self.users = [User.signup(f"sharduser{i}", f"s{i}@test.com",
+                                  "password", None) for i in range(3)]
+        db.session.commit()
+        self.user_ids = [user.id for user in self.users]
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        shards.configure([])
+        self.dir.cleanup()
+
+    def count(self, table, shard, user_id):
+        with shards.engines[shard].connect() as conn:
+            return conn.execute(select([func.count()]).select_from(table)
+                                .where(table.c.user_id == user_id)).scalar()
+
+    def test_message_goes_to_home_shard(self):
+        user_id = self.user_ids[0]
+        msg = shards.add_message(user_id, "hello shard")
+
+        home = shards.home_shard(user_id)
+        self.assertEqual(self.count(shard_messages, home, user_id), 1)
+        self.assertEqual(msg.id % SHARD_SLOTS, home)
+        self.assertEqual(Message.query.count(), 0)
+
+    def test_timeline_merges_by_timestamp(self):
+        start = datetime(2022, 1, 1)
+        for i in range(9):
+            user_id = self.user_ids[i % 3]
+            msg = shards.add_message(user_id, f"msg {i}")
+            with shards.engines[shards.home_shard(user_id)].begin() as conn:
+                conn.execute(shard_messages.update()
+                             .where(shard_messages.c.id == msg.id)
+                             .values(timestamp=start + timedelta(minutes=i)))
+
+        timeline = shards.messages_for(self.user_ids, limit=5)
+
+        self.assertEqual([m.text for m in timeline],
+                         ["msg 8", "msg 7", "msg 6", "msg 5", "msg 4"])
+        # authors load from the primary
+        self.assertEqual(timeline[0].user.username, "sharduser2")
+
+        newer = shards.messages_for(self.user_ids, after=(timeline[1].timestamp, timeline[1].id))
+        self.assertEqual([m.text for m in newer], ["msg 8"])
+
+        newest = shards.newest_messages(self.user_ids)
+        self.assertEqual({user_id: message_id for user_id, (_, message_id) in newest.items()},
+                         {m.user_id: m.id for m in timeline[:3]})
+
+    def test_likes_and_lookup(self):
+        msg = shards.add_message(self.user_ids[1], "like me")
+
+        self.assertTrue(shards.toggle_like(self.user_ids[0], msg.id))
+        self.assertEqual(shards.liked_message_ids(self.user_ids[0]), {msg.id})
+        self.assertEqual(shards.count_likes(self.user_ids[0]), 1)
+        self.assertEqual(shards.get_message(msg.id).text, "like me")
+
+        self.assertFalse(shards.toggle_like(self.user_ids[0], msg.id))
+        self.assertEqual(shards.count_likes(self.user_ids[0]), 0)
+
+    def test_like_unique_on_shard(self):
+        user_id = self.user_ids[0]
+        msg = shards.add_message(self.user_ids[1], "like me once")
+        shards.toggle_like(user_id, msg.id)
+
+        with shards.engines[shards.home_shard(user_id)].connect() as conn:
+            like = dict(conn.execute(select([shard_likes])).first())
+            like['id'] += 1
+            with self.assertRaises(IntegrityError):
+                conn.execute(shard_likes.insert(), like)
+
+    def test_thread_across_shards(self):
+        root = shards.add_message(self.user_ids[0], "root")
+        texts = []
+        for i in range(4):
+            branch = shards.add_message(self.user_ids[(i + 1) % 3], f"branch {i}", root)
+            shards.add_message(self.user_ids[(i + 2) % 3], f"{i}.0", branch)
+            texts.append([f"branch {i}", f"{i}.0"])
+
+        replies, next_start = shards.thread(root, branches=3)
+        self.assertEqual(len(replies), 6)
+        self.assertEqual([depth for msg, depth in replies], [1, 2] * 3)
+        rest, last = shards.thread(root, next_start, branches=3)
+        self.assertEqual(len(rest), 2)
+        self.assertIsNone(last)
+        self.assertEqual(sorted(msg.text for msg, depth in replies + rest),
+                         sorted(text for branch in texts for text in branch))
+        # siblings come in id order, which across shards isn't posting order
+        branch_ids = [msg.id for msg, depth in replies + rest if depth == 1]
+        self.assertEqual(branch_ids, sorted(branch_ids))
+
+        root = shards.get_message(root.id)
+        self.assertEqual(root.reply_count, 4)
+        shards.delete_message(replies[0][0])
+        self.assertEqual(shards.get_message(root.id).reply_count, 3)
+
+    def test_move_user(self):
+        user_id = self.user_ids[0]
+        src = shards.home_shard(user_id)
+        dest = (src + 1) % 3
+
+        ids = [shards.add_message(user_id, f"moving {i}").id for i in range(5)]
+        shards.toggle_like(user_id, ids[0])
+
+        copied = shards.move_user(user_id, dest, batch_size=2, grace=0, settle=0)
+
+        self.assertEqual(copied, 6)
+        self.assertEqual(shards.shard_for(user_id), dest)
+        self.assertEqual(self.count(shard_messages, src, user_id), 0)
+        self.assertEqual(self.count(shard_messages, dest, user_id), 5)
+        self.assertEqual(self.count(shard_likes, dest, user_id), 1)
+
+        # old ids still resolve, new messages land on the new shard
+        self.assertEqual(shards.get_message(ids[0]).text, "moving 0")
+        shards.add_message(user_id, "after move")
+        self.assertEqual(self.count(shard_messages, dest, user_id), 6)
+
+    def test_move_recopies_changed_rows(self):
+        user_id = self.user_ids[0]
+        src = shards.home_shard(user_id)
+        dest = (src + 1) % 3
+        message_id = shards.add_message(user_id, "replied to later").id
+
+        def reply_during_grace(seconds):
+            # a reply counted after the first copy, before the switch
+            with shards.engines[src].begin() as conn:
+                conn.execute(shard_messages.update()
+                             .where(shard_messages.c.id == message_id)
+                             .values(reply_count=shard_messages.c.reply_count + 1))
+
+        with mock.patch('sharding.time.sleep', side_effect=reply_during_grace):
+            shards.move_user(user_id, dest, grace=0, settle=0)
+
+        self.assertEqual(shards.get_message(message_id).reply_count, 1)
+
+    def test_homepage_reads_shards(self):
+        shards.add_message(self.user_ids[0], "on the timeline")
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_ids[0]
+
+            html = c.get('/').get_data(as_text=True)
+
+        self.assertIn('on the timeline', html)
@@ -0,0 +1,107 @@
+"""Hashtag and mention tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_tags.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Message, Likes, MessageTag, Mention
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from tags import extract, normalize_tag, index_messages, tag_page, mentions_page
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TagsTestCase(TestCase):
+    """Test indexing hashtags and mentions, and the pages reading them."""
+
+    def setUp(self):
+        MessageTag.query.delete()
+        Mention.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.users = [User.signup(f"tagger{i}", f"tagger{i}@test.com", "password", None)
+                      for i in range(2)]
+        db.session.commit()
+        self.me, self.other = [user.id for user in self.users]
+
+        self.client = app.test_client()
+
+    def post(self, text):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.me
+            c.post('/messages/new', data={'text': text})
+        return Message.query.filter_by(text=text).one().id
+
+    def test_extract(self):
+        self.assertEqual(extract("#Flask and #flask, not a#b or #1 but #web2 @tagger1!"),
+                         ({'flask', 'web2'}, {'tagger1'}))
+        self.assertEqual(extract("mail me@example.com &#39; ##x"), (set(), set()))
+        self.assertEqual(normalize_tag('Python'), 'python')
+        self.assertIsNone(normalize_tag('12'))
+        self.assertIsNone(normalize_tag('a b'))
+
+    def test_post_and_delete(self):
+        tagged = self.post("hello #Warbler, says @tagger1 to @nobody")
+        self.post("plain")
+
+        self.assertEqual([(t.tag, t.user_id) for t in MessageTag.query],
+                         [('warbler', self.me)])
+        self.assertEqual([(m.user_id, m.message_id, m.author_id) for m in Mention.query],
+                         [(self.other, tagged, self.me)])
+
+        with self.client as c:
+            resp = c.get('/tags/WARBLER')
+            self.assertIn(b"hello #Warbler", resp.data)
+            self.assertEqual(c.get('/tags/123').status_code, 404)
+            self.assertEqual(c.get('/tags/warbler?before=junk').status_code, 400)
+
+            resp = c.get(f'/users/{self.other}/mentions')
+            self.assertIn(b"hello #Warbler", resp.data)
+
+            data = c.get('/api/v1/tags/warbler').get_json()
+            self.assertEqual([m['id'] for m in data['messages']], [tagged])
+
+            c.post(f'/messages/{tagged}/delete')
+
+        self.assertEqual(MessageTag.query.count(), 0)
+        self.assertEqual(Mention.query.count(), 0)
+
+    def test_pages(self):
+        start = datetime(2020, 1, 1)
+        # the same timestamp twice: the cursor has to break the tie by id
+        db.session.add_all([
+            Message(text=f"#paged {i}", user_id=self.me,
+                    timestamp=start + timedelta(minutes=min(i, 3)))
+            for i in range(5)] + [Message(text="@tagger1 hi", user_id=self.me, timestamp=start)])
+        db.session.commit()
+
+        # written before indexing existed
+        self.assertEqual(index_messages(batch_size=2), (6, 5, 1))
+        self.assertEqual(index_messages(), (6, 5, 1))
+        self.assertEqual(MessageTag.query.count(), 5)
+
+        texts, before = [], None
+        while True:
+            messages, before = tag_page('paged', before, limit=2)
+            texts += [msg.text for msg in messages]
+            if not before:
+                break
+        self.assertEqual(texts, ["#paged 4", "#paged 3", "#paged 2", "#paged 1", "#paged 0"])
+
+        messages, before = mentions_page(self.other)
+        self.assertEqual([msg.text for msg in messages], ["@tagger1 hi"])
+        self.assertIsNone(before)
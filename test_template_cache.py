@@ -0,0 +1,55 @@
+"""Template bytecode cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_template_cache.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from jinja2 import Environment, DictLoader
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import create_app
+from template_cache import SharedBytecodeCache, precompile
+
+
+class TemplateCacheTestCase(TestCase):
+    """Test precompiling templates and loading them from the cache."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_precompile(self):
+        app = create_app({'TEMPLATE_CACHE_DIR': self.directory})
+
+        timings = precompile(app.jinja_env)
+
+        names = [name for name, compile_ms, cached_ms in timings]
+        self.assertIn('base.html', names)
+        self.assertIn('users/detail.html', names)
+        self.assertEqual(len(os.listdir(self.directory)), len(names))
+
+        # a new process loads them from the cache instead of compiling
+        app = create_app({'TEMPLATE_CACHE_DIR': self.directory})
+        app.jinja_env.compile = None
+        app.jinja_env.get_template('base.html')
+
+    def test_edited_template_is_recompiled(self):
+        templates = {'page.html': "old"}
+        env = Environment(loader=DictLoader(templates),
+                          bytecode_cache=SharedBytecodeCache(self.directory))
+        self.assertEqual(env.get_template('page.html').render(), "old")
+
+        templates['page.html'] = "new"
+        env = Environment(loader=DictLoader(templates),
+                          bytecode_cache=SharedBytecodeCache(self.directory))
+        self.assertEqual(env.get_template('page.html').render(), "new")
+        self.assertEqual(len(os.listdir(self.directory)), 1)
@@ -0,0 +1,129 @@
+"""Reply thread tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_threads.py
+
+
+import os
+from unittest import TestCase, mock
+
+from models import db, User, Message, Likes, Notification, MessageTag, Mention
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from sharding import shards
+from threads import segment, path_ids, ancestor_ids, PATH_SEGMENT
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ThreadsTestCase(TestCase):
+    """Test replying, reply counts and loading threads."""
+
+    def setUp(self):
+        Notification.query.delete()
+        MessageTag.query.delete()
+        Mention.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.users = [User.signup(f"threader{i}", f"threader{i}@test.com", "password", None)
+                      for i in range(2)]
+        db.session.commit()
+        self.me, self.other = [user.id for user in self.users]
+
+        self.root = shards.add_message(self.me, "root")
+
+    def reply(self, parent, text, user_id=None):
+        return shards.add_message(user_id or self.other, text, parent)
+
+    def count(self, message_id):
+        db.session.expire_all()
+        return Message.query.get(message_id).reply_count
+
+    def test_paths(self):
+        self.assertEqual(len(segment(2 ** 63 - 1)), PATH_SEGMENT)
+        self.assertEqual(path_ids(segment(5) + segment(36 ** 5)), [5, 36 ** 5])
+        self.assertLess(segment(35), segment(36))
+
+        first = self.reply(self.root, "first")
+        second = self.reply(first, "second")
+        self.assertEqual((second.parent_id, second.thread_id), (first.id, self.root.id))
+        self.assertEqual(path_ids(second.path), [self.root.id, first.id, second.id])
+        self.assertEqual(ancestor_ids(second), [self.root.id, first.id])
+        self.assertEqual(ancestor_ids(self.root), [])
+
+        # past the depth limit replies go to the parent's parent
+        with mock.patch('threads.MAX_THREAD_DEPTH', 2):
+            third = self.reply(second, "third")
+        self.assertEqual(third.parent_id, first.id)
+        self.assertEqual((self.count(first.id), self.count(second.id)), (2, 0))
+
+    def test_thread_pages(self):
+        branches = []
+        for i in range(5):
+            branch = self.reply(self.root, f"branch {i}")
+            branches.append(branch)
+            self.reply(self.reply(branch, f"{i}.0"), f"{i}.0.0")
+            self.reply(branch, f"{i}.1")
+
+        replies, next_start = shards.thread(self.root, branches=2)
+        self.assertEqual([(msg.text, depth) for msg, depth in replies],
+                         [("branch 0", 1), ("0.0", 2), ("0.0.0", 3), ("0.1", 2),
+                          ("branch 1", 1), ("1.0", 2), ("1.0.0", 3), ("1.1", 2)])
+        self.assertEqual(next_start, branches[2].id)
+
+        replies, next_start = shards.thread(self.root, next_start, branches=2)
+        self.assertEqual([msg.text for msg, depth in replies][::4], ["branch 2", "branch 3"])
+        replies, next_start = shards.thread(self.root, next_start, branches=2)
+        self.assertEqual(len(replies), 4)
+        self.assertIsNone(next_start)
+
+        replies, next_start = shards.thread(self.root, branches=None)
+        self.assertEqual(len(replies), 20)
+
+        # a reply's subtree, but not its siblings'
+        replies, next_start = shards.thread(branches[1])
+        self.assertEqual([(msg.text, depth) for msg, depth in replies],
+                         [("1.0", 1), ("1.0.0", 2), ("1.1", 1)])
+        self.assertEqual(self.count(branches[1].id), 2)
+        self.assertEqual(self.count(self.root.id), 5)
+
+        with app.test_client() as c:
+            data = c.get(f'/api/v1/messages/{branches[1].id}/thread?limit=1').get_json()
+            self.assertEqual([m['text'] for m in data['ancestors']], ["root"])
+            self.assertEqual([(m['text'], m['depth']) for m in data['replies']],
+                             [("1.0", 1), ("1.0.0", 2)])
+            self.assertEqual(data['message']['reply_count'], 2)
+            self.assertEqual(data['next'], Message.query.filter_by(text="1.1").one().id)
+
+    def test_reply_views(self):
+        root_id = self.root.id
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.other
+            resp = c.post(f'/messages/{root_id}/reply', data={'text': "hi @threader0"})
+            self.assertEqual(resp.status_code, 302)
+            reply = Message.query.filter_by(text="hi @threader0").one()
+            self.assertIn(f"#message-{reply.id}", resp.location)
+            self.assertEqual(c.post('/messages/0/reply', data={'text': "x"}).status_code, 404)
+
+            resp = c.get(f'/messages/{root_id}')
+            self.assertIn(b"1 reply", resp.data)
+            self.assertIn(b"hi @threader0", resp.data)
+            self.assertIn(b'action="/messages/%d/reply"' % root_id, resp.data)
+
+            resp = c.get(f'/messages/{reply.id}')
+            self.assertIn(b'id="ancestors"', resp.data)
+
+            self.assertEqual(sorted(n.kind for n in Notification.query),
+                             ['mention', 'reply'])
+
+            c.post(f'/messages/{reply.id}/delete')
+        self.assertEqual(self.count(root_id), 0)
@@ -0,0 +1,164 @@
+"""Trending ranking tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_trending.py
+
+
+import os
+import tempfile
+import time
+from unittest import TestCase, mock
+
+from models import db, User, Message, Follows, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import trending as trending_module
+from trending import TrendingSketch, trending, HALF_LIFE_SECONDS
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TrendingSketchTestCase(TestCase):
+    """Test decayed counting in the sketch file."""
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'trending.bin')
+        self.sketch = TrendingSketch(self.path, width=1 << 14, top=4)
+
+    def tearDown(self):
+        self.sketch.close()
+        self.dir.cleanup()
+
+    def test_recent_likes_win(self):
+        now = time.time()
+        for i in range(5):
+            self.sketch.add(1, 1.0, now - 4 * HALF_LIFE_SECONDS)
+        for i in range(2):
+            self.sketch.add(2, 1.0, now)
+
+        (first, first_score), (second, second_score) = self.sketch.top_n(2, now)
+
+        self.assertEqual((first, second), (2, 1))
+        self.assertAlmostEqual(first_score, 2.0)
+        self.assertAlmostEqual(second_score, 5 / 16)
+
+    def test_bounded(self):
+        size = os.path.getsize(self.path)
+        now = time.time()
+
+        for message_id in range(1, 2001):
+            self.sketch.add(message_id, 1.0 + 2 * (message_id == 777), now)
+
+        self.assertEqual(os.path.getsize(self.path), size)
+        self.assertEqual(len(self.sketch.top_n(10, now)), 4)
+        self.assertEqual(self.sketch.top_n(1, now)[0][0], 777)
+
+    def test_shared_between_workers(self):
+        other = TrendingSketch(self.path)
+        self.sketch.add(5, 3.0)
+
+        self.assertEqual(other.top_n(1)[0][0], 5)
+        other.close()
+
+
+class TrendingViewTestCase(TestCase):
+    """Test the trending page and rebuilding from history."""
+
+    def setUp(self):
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        self.dir = tempfile.TemporaryDirectory()
+        trending.configure(os.path.join(self.dir.name, 'trending.bin'))
+
+        users = [User.signup(f"trend{i}", f"trend{i}@test.com", "password", None)
+                 for i in range(3)]
+        db.session.commit()
+        self.user_ids = [user.id for user in users]
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        trending.configure(app.config['TRENDING_PATH'])
+        self.dir.cleanup()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_likes_feed_trending(self):
+        with self.client as c:
+            self.login(c, self.user_ids[0])
+            c.post('/messages/new', data={"text": "quiet one"})
+            c.post('/messages/new', data={"text": "popular one"})
+
+            quiet, popular = Message.query.order_by(Message.id).all()
+
+            for user_id in self.user_ids[1:]:
+                self.login(c, user_id)
+                c.post(f'/users/handle_like/{popular.id}')
+
+            html = c.get('/trending').get_data(as_text=True)
+
+        self.assertIn('popular one', html)
+        self.assertLess(html.index('popular one'), html.index('quiet one'))
+
+    def test_unlike_takes_like_back(self):
+        with self.client as c:
+            self.login(c, self.user_ids[0])
+            c.post('/messages/new', data={"text": "toggled"})
+            c.post('/messages/new', data={"text": "liked once"})
+            toggled, liked = Message.query.order_by(Message.id).all()
+
+            self.login(c, self.user_ids[1])
+            for _ in range(4):
+                c.post(f'/users/handle_like/{toggled.id}')
+            c.post(f'/users/handle_like/{liked.id}')
+
+        scores = dict(trending.top())
+        self.assertLess(scores[toggled.id], scores[liked.id])
+        self.assertAlmostEqual(scores[liked.id] - scores[toggled.id], 1, places=2)
+
+    def test_rebuild(self):
+        msgs = [Message(text=f"m{i}", user_id=self.user_ids[0]) for i in range(3)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        db.session.add_all([Likes(user_id=user_id, message_id=msgs[2].id)
+                            for user_id in self.user_ids[1:]])
+        db.session.commit()
+
+        self.assertEqual(trending.rebuild(hours=1, chunk_rows=2), 5)
+
+        self.assertEqual(trending.top(1)[0][0], msgs[2].id)
+        self.assertEqual(len(trending.top()), 3)
+
+    def test_likes_during_rebuild_kept(self):
+        msgs = [Message(text=f"m{i}", user_id=self.user_ids[0]) for i in range(2)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        db.session.add(Likes(user_id=self.user_ids[1], message_id=msgs[1].id))
+        db.session.commit()
+
+        real_sources = trending_module.sources
+
+        def sources(table):
+            # likes counted by a worker while the rebuild reads the tables
+            if table == 'likes':
+                for _ in range(3):
+                    trending.record_like(msgs[0].id)
+            return real_sources(table)
+
+        with mock.patch('trending.sources', side_effect=sources):
+            trending.rebuild(hours=1)
+
+        self.assertEqual(trending.top(1)[0][0], msgs[0].id)
+        self.assertFalse(os.path.exists(trending.rebuild_path))
@@ -107,6 +107,30 @@ class UserViewTestCase(TestCase):
 
             self.assertIn('@rocky', html)
 
+    def test_page_users(self):
+        """Page through users, following the More link"""
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.secondUser_id
+
+            resp = c.get('/users?limit=1')
+            self.assertTrue(resp.is_streamed)
+            html = resp.get_data(as_text=True)
+
+            self.assertIn('@testuser', html)
+            self.assertNotIn('@rocky', html)
+            self.assertIn('/users/stop-following/1', html)
+            self.assertIn('href="/users?after=1"', html)
+
+            html = c.get('/users?limit=1&after=1').get_data(as_text=True)
+            self.assertIn('@rocky', html)
+            self.assertIn('/users/follow/2', html)
+
+            html = c.get('/users?after=2').get_data(as_text=True)
+            self.assertIn('Sorry, no users found', html)
+
+            self.assertEqual(c.get('/users?limit=100000').status_code, 400)
+
     def test_show_user_profile(self):
         with self.client as c:
             resp = c.get(f'/users/{self.testuser_id}')
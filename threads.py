@@ -0,0 +1,140 @@
+"""Reply threads, stored as materialized paths.
+
+A reply keeps its parent's id (`parent_id`), the id of the message that
+started the thread (`thread_id`) and its `path`: the ids from that
+message down to itself, each written as PATH_SEGMENT fixed-width base-36
+digits. The thread starter has no path of its own; `path_of` gives it
+its single segment.
+
+So a message's replies, and their replies, are exactly the rows of its
+thread whose path starts with its own, and ordering them by path puts
+every reply right after its parent, siblings by id. Loading a thread,
+or any reply's subtree, is one range scan of ix_messages_thread_path
+instead of a query per level. `branches` limits it to the first N
+direct replies (and everything under them): the (N+1)-th reply's path,
+one short scan of ix_messages_parent_path, is the end of the range.
+Each branch is loaded whole.
+
+Paths use only [0-9a-z] and have fixed-width segments, so they compare
+the same way under any collation. Replies deeper than MAX_THREAD_DEPTH
+are attached to their parent's parent instead, which keeps paths (and
+index entries) bounded.
+
+`messages.reply_count` counts each message's direct replies; the
+ShardRouter keeps it up to date as replies are added and deleted.
+"""
+
+from sqlalchemy import func
+
+from models import Message
+
+# base-36 digits per id; 36**13 > 2**63
+PATH_SEGMENT = 13
+PATH_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+MAX_THREAD_DEPTH = 64
+
+# direct replies shown per page of a thread
+THREAD_BRANCHES = 20
+
+
+def segment(message_id):
+    digits = []
+    while message_id:
+        message_id, digit = divmod(message_id, 36)
+        digits.append(PATH_DIGITS[digit])
+    return ''.join(reversed(digits)).rjust(PATH_SEGMENT, '0')
+
+
+def path_of(msg):
+    return msg.path or segment(msg.id)
+
+
+def depth(path):
+    """Replies between the thread starter and the message at `path`."""
+
+    return len(path) // PATH_SEGMENT - 1
+
+
+def path_ids(path):
+    return [int(path[start:start + PATH_SEGMENT], 36)
+            for start in range(0, len(path), PATH_SEGMENT)]
+
+
+def ancestor_ids(msg):
+    """Ids from the thread starter down to `msg`'s parent."""
+
+    return path_ids(msg.path)[:-1] if msg.path else []
+
+
+def reply_fields(parent, reply_id):
+    """parent_id, thread_id and path for a new reply to `parent`."""
+
+    path = path_of(parent)
+    if depth(path) >= MAX_THREAD_DEPTH:
+        path = path[:-PATH_SEGMENT]
+    return {'parent_id': path_ids(path)[-1], 'thread_id': parent.thread_id or parent.id,
+            'path': path + segment(reply_id)}
+
+
+##############################################################################
+# Queries
+
+
+def _start_path(msg, start):
+    """Where a page of `msg`'s replies starts: just after `msg` itself, or
+    at its direct reply `start`."""
+
+    return path_of(msg) + segment(start) if start else path_of(msg)
+
+
+def branch_paths(session, msg, start=None, limit=THREAD_BRANCHES + 1):
+    """Query for the paths of `msg`'s first `limit` direct replies, from
+    the reply with id `start` on."""
+
+    query = session.query(Message.path).filter(Message.parent_id == msg.id)
+    if start:
+        query = query.filter(Message.path >= _start_path(msg, start))
+    return query.order_by(Message.path).limit(limit)
+
+
+def _end_path(msg):
+    """The first path after all of `msg`'s replies: its own with the last
+    id one higher."""
+
+    path = path_of(msg)
+    return path[:-PATH_SEGMENT] + segment(path_ids(path)[-1] + 1)
+
+
+def subtree(session, msg, start=None, end=None):
+    """Query for `msg`'s replies, in thread order, from its direct reply
+    `start` on and up to (not including) the path `end` (None: all)."""
+
+    lower = _start_path(msg, start)
+    return (session.query(Message)
+            .filter(Message.thread_id == (msg.thread_id or msg.id))
+            .filter(Message.path >= lower if start else Message.path > lower)
+            .filter(Message.path < (_end_path(msg) if end is None else end))
+            .order_by(Message.path))
+
+
+def branches_query(session, msg, start=None, branches=THREAD_BRANCHES):
+    """One statement for the first `branches` branches under `msg`: rows
+    of (message, path of the first direct reply left out, or None)."""
+
+    # not correlated: it reads other rows of the same table
+    end = (branch_paths(session, msg, start, limit=1)
+           .offset(branches)
+           .statement
+           .correlate(None)
+           .as_scalar())
+    return (subtree(session, msg, start, func.coalesce(end, _end_path(msg)))
+            .add_columns(end.label('next_path')))
+
+
+def thread_rows(msg, rows, next_path):
+    """([(reply, depth below `msg`)], id to start the next page at)."""
+
+    top = depth(path_of(msg))
+    next_start = path_ids(next_path)[-1] if next_path else None
+    return [(reply, depth(reply.path) - top) for reply in rows], next_start
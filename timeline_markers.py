@@ -0,0 +1,69 @@
+"""Per-user "timeline last updated" markers for polling clients.
+
+Each author's newest message, as (timestamp, id), is kept in the cache.
+A listener sets it whenever a message is inserted (on the primary or a
+shard) and drops it when one is deleted; a miss is filled from the
+database. A user's timeline was last updated by the newest of the markers
+of the users they follow (from the follow graph) and their own. So
+"anything new since message X?" is one cache get_many, not a timeline
+query.
+
+Markers in a per-process cache (lru://) would miss messages other
+processes insert, so with one the markers are read from the database.
+"""
+
+from sqlalchemy import event
+
+from cache import cache
+from follow_graph import follow_graph
+from models import Message
+from sharding import shards
+
+NEWEST_MESSAGE_TTL = 24 * 60 * 60
+
+
+def marker_key(user_id):
+    return f"newest-message:{user_id}"
+
+
+def record_message(mapper, connection, msg):
+    cache.set(marker_key(msg.user_id), (msg.timestamp, msg.id), ttl=NEWEST_MESSAGE_TTL)
+
+
+def forget_message(mapper, connection, msg):
+    cache.delete(marker_key(msg.user_id))
+
+
+event.listen(Message, 'after_insert', record_message)
+event.listen(Message, 'after_delete', forget_message)
+
+
+def newest_messages(user_ids):
+    """{user id: (timestamp, id) of their newest message, or ()}."""
+
+    if not cache.shared:
+        fetched = shards.newest_messages(user_ids)
+        return {user_id: fetched.get(user_id, ()) for user_id in user_ids}
+
+    keys = {user_id: marker_key(user_id) for user_id in user_ids}
+    found = cache.get_many(keys.values())
+    newest = {user_id: found[key] for user_id, key in keys.items() if key in found}
+
+    missing = [user_id for user_id in keys if user_id not in newest]
+    if missing:
+        fetched = shards.newest_messages(missing)
+        for user_id in missing:
+            newest[user_id] = fetched.get(user_id, ())
+            # add, not set: a message inserted since the query wins
+            cache.add(marker_key(user_id), newest[user_id], ttl=NEWEST_MESSAGE_TTL)
+
+    return newest
+
+
+def timeline_newest(user_id):
+    """(timestamp, id) of the newest message on `user_id`'s timeline, or
+    None if it's empty."""
+
+    user_ids = follow_graph.following(user_id).tolist() + [user_id]
+    markers = [marker for marker in newest_messages(user_ids).values() if marker]
+    return max(markers) if markers else None
@@ -0,0 +1,372 @@
+"""Trending messages, ranked by exponentially decayed like velocity.
+
+Likes (as like_buffer writes them; an unlike takes its like back) and
+new messages (from messages_add) are counted in a count-min sketch, and
+the TRENDING_TOP best-scored message ids are kept next to it. Both live in one fixed-size file mapped by every worker,
+so memory stays the same however many events arrive, and reading the top
+N never touches the database.
+
+Decay without touching every counter: an event at time t adds
+exp((t - t0) / tau) instead of 1, so older events are worth exponentially
+less relative to newer ones, and a stored value is turned into a current
+score by multiplying with exp(-(now - t0) / tau). When the weights get
+large, everything is rescaled and t0 moves forward.
+
+`flask rebuild-trending` recomputes the file from the last REBUILD_HOURS of
+messages and likes and swaps it in. While it runs, workers count their
+events into the new file as well, so none are lost at the swap.
+"""
+
+import fcntl
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select
+
+from export import sources
+
+HALF_LIFE_SECONDS = 6 * 60 * 60
+TAU = HALF_LIFE_SECONDS / math.log(2)
+
+SKETCH_WIDTH = 1 << 16
+SKETCH_DEPTH = 4
+TRENDING_TOP = 1024
+
+LIKE_WEIGHT = 1.0
+# lets a brand-new message into the candidates before its first like
+NEW_MESSAGE_WEIGHT = 0.5
+
+RESCALE_AT = 1e12
+REBUILD_HOURS = 48
+REBUILD_CHUNK_ROWS = 100000
+
+# odd multipliers for multiply-shift hashing, one per sketch row
+HASH_SEEDS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F,
+                       0x165667B19E3779F9, 0xD6E8FEB86659FD93,
+                       0xFF51AFD7ED558CCD, 0xC4CEB9FE1A85EC53,
+                       0x94D049BB133111EB, 0xBF58476D1CE4E5B9],
+                      dtype=np.uint64)
+
+
+def _seconds(when):
+    """Unix time of a stored (naive UTC) timestamp."""
+
+    return (when - datetime(1970, 1, 1)).total_seconds()
+
+
+class TrendingSketch:
+    """Count-min sketch plus top-k heap in an mmapped file."""
+
+    MAGIC = b'WRBLTRN1'
+    # magic, width, depth, top, t0
+    HEADER = struct.Struct('<8sIIId')
+    HEADER_SIZE = 64
+
+    def __init__(self, path, width=SKETCH_WIDTH, depth=SKETCH_DEPTH,
+                 top=TRENDING_TOP, t0=None, create=True):
+        self.path = path
+        self._local_lock = threading.Lock()
+
+        self._fd = os.open(path, os.O_RDWR | (os.O_CREAT if create else 0), 0o644)
+        self.inode = os.fstat(self._fd).st_ino
+
+        fcntl.lockf(self._fd, fcntl.LOCK_EX)
+        try:
+            header = os.pread(self._fd, self.HEADER.size, 0)
+            if len(header) == self.HEADER.size and header[:8] == self.MAGIC:
+                # reuse an existing file's geometry
+                _, width, depth, top, t0 = self.HEADER.unpack(header)
+            else:
+                os.ftruncate(self._fd, self._length(width, depth, top))
+                os.pwrite(self._fd, self.HEADER.pack(self.MAGIC, width, depth, top,
+                                                     time.time() if t0 is None else t0), 0)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+        assert width & (width - 1) == 0, "sketch width must be a power of two"
+        self.width, self.depth, self.top = width, depth, top
+        self._shift = np.uint64(64 - width.bit_length() + 1)
+
+        self._map = mmap.mmap(self._fd, self._length(width, depth, top))
+        offset = self.HEADER_SIZE
+        self.counts = np.frombuffer(self._map, np.float64, depth * width,
+                                    offset).reshape(depth, width)
+        offset += self.counts.nbytes
+        self.top_ids = np.frombuffer(self._map, np.int64, top, offset)
+        offset += self.top_ids.nbytes
+        self.top_scores = np.frombuffer(self._map, np.float64, top, offset)
+
+    @classmethod
+    def _length(cls, width, depth, top):
+        return cls.HEADER_SIZE + depth * width * 8 + top * 16
+
+    def close(self):
+        del self.counts, self.top_ids, self.top_scores
+        self._map.close()
+        os.close(self._fd)
+
+    ##########################################################################
+    # Scaled time
+
+    @property
+    def t0(self):
+        return struct.unpack_from('<d', self._map, self.HEADER.size - 8)[0]
+
+    def _weight(self, when):
+        return math.exp((when - self.t0) / TAU)
+
+    def _rescale(self, now):
+        """Move t0 to `now`, scaling stored values to match."""
+
+        factor = 1 / self._weight(now)
+        self.counts *= factor
+        self.top_scores *= factor
+        struct.pack_into('<d', self._map, self.HEADER.size - 8, now)
+
+    ##########################################################################
+    # Sketch
+
+    def _columns(self, ids):
+        """Sketch column of each id in each row, shape (depth, len(ids))."""
+
+        ids = np.asarray(ids, dtype=np.int64).astype(np.uint64)
+        seeds = HASH_SEEDS[:self.depth, None]
+        return ((ids[None, :] * seeds) >> self._shift).astype(np.intp)
+
+    def _estimate(self, columns):
+        rows = np.arange(self.depth)[:, None]
+        return self.counts[rows, columns].min(axis=0)
+
+    def _locked(self, fn):
+        with self._local_lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX)
+            try:
+                return fn()
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN)
+
+    def add(self, message_id, weight, when=None):
+        """Count an event of `weight` for `message_id` at time `when`."""
+
+        self._locked(lambda: self._add(message_id, weight, when))
+
+    def _add(self, message_id, weight, when):
+        now = time.time() if when is None else when
+        scaled = weight * self._weight(now)
+        if scaled > RESCALE_AT:
+            self._rescale(now)
+            scaled = weight
+
+        columns = self._columns([message_id])
+        self.counts[np.arange(self.depth), columns[:, 0]] += scaled
+        self._offer(message_id, self._estimate(columns)[0])
+
+    def _offer(self, message_id, estimate):
+        """Keep `message_id` in the top list if it scores high enough."""
+
+        slot = np.flatnonzero(self.top_ids == message_id)
+        if len(slot):
+            self.top_scores[slot[0]] = estimate
+            return
+
+        weakest = int(np.argmin(self.top_scores))
+        if estimate > self.top_scores[weakest]:
+            self.top_ids[weakest] = message_id
+            self.top_scores[weakest] = estimate
+
+    def add_many(self, message_ids, weights, times):
+        """Count many events at once (rebuilds), then refill the top list."""
+
+        def op():
+            ids = np.asarray(message_ids, dtype=np.int64)
+            if not len(ids):
+                return
+
+            newest = float(np.max(times))
+            if self._weight(newest) > RESCALE_AT:
+                self._rescale(newest)
+
+            scaled = (np.asarray(weights, dtype=np.float64)
+                      * np.exp((np.asarray(times, dtype=np.float64) - self.t0) / TAU))
+            columns = self._columns(ids)
+            for row in range(self.depth):
+                np.add.at(self.counts[row], columns[row], scaled)
+
+            candidates = np.unique(np.concatenate([ids, self.top_ids[self.top_ids > 0]]))
+            estimates = self._estimate(self._columns(candidates))
+            best = np.argsort(-estimates, kind='stable')[:self.top]
+
+            self.top_ids[:] = 0
+            self.top_scores[:] = 0
+            self.top_ids[:len(best)] = candidates[best]
+            self.top_scores[:len(best)] = estimates[best]
+
+        self._locked(op)
+
+    def top_n(self, n, now=None):
+        """[(message_id, score)] of the `n` highest scores, highest first."""
+
+        def op():
+            return self.top_ids.copy(), self.top_scores.copy(), self.t0
+
+        ids, scores, t0 = self._locked(op)
+        present = ids > 0
+        ids, scores = ids[present], scores[present]
+
+        best = np.argsort(-scores, kind='stable')[:n]
+        decay = math.exp(-((time.time() if now is None else now) - t0) / TAU)
+        return [(int(ids[i]), float(scores[i] * decay)) for i in best]
+
+
+class Trending:
+    """The sketch at TRENDING_PATH, reopened when a rebuild replaces it."""
+
+    def __init__(self):
+        self.path = None
+        self._sketch = None
+        self._fresh = None
+        self._lock = threading.Lock()
+
+    def configure(self, path):
+        with self._lock:
+            for sketch in (self._sketch, self._fresh):
+                if sketch is not None:
+                    sketch.close()
+            self.path, self._sketch, self._fresh = path, None, None
+
+    @property
+    def rebuild_path(self):
+        return f"{self.path}.rebuild"
+
+    def sketch(self):
+        with self._lock:
+            try:
+                inode = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                inode = None
+
+            if self._sketch is None or self._sketch.inode != inode:
+                if self._sketch is not None:
+                    self._sketch.close()
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._sketch = TrendingSketch(self.path)
+
+            return self._sketch
+
+    def _rebuilding(self):
+        """The file a running rebuild is filling, or None."""
+
+        with self._lock:
+            try:
+                inode = os.stat(self.rebuild_path).st_ino
+            except FileNotFoundError:
+                inode = None
+
+            if self._fresh is not None and self._fresh.inode != inode:
+                self._fresh.close()
+                self._fresh = None
+            if self._fresh is None and inode is not None:
+                try:
+                    self._fresh = TrendingSketch(self.rebuild_path, create=False)
+                except FileNotFoundError:
+                    pass
+
+            return self._fresh
+
+    def _add(self, message_id, weight, when=None):
+        fresh = self._rebuilding()
+        if fresh is None:
+            self.sketch().add(message_id, weight, when)
+            return
+
+        def both():
+            # the rebuild swaps its file in holding this lock, so the file
+            # is either still the rebuild's (count it in both) or already
+            # live (sketch() opens it)
+            try:
+                swapped = os.stat(fresh.path).st_ino != fresh.inode
+            except FileNotFoundError:
+                swapped = True
+            if not swapped:
+                fresh._add(message_id, weight, when)
+            self.sketch().add(message_id, weight, when)
+
+        fresh._locked(both)
+
+    def record_like(self, message_id, when=None):
+        self._add(message_id, LIKE_WEIGHT, when)
+
+    def remove_like(self, message_id, liked_at):
+        """Take back a like made at `liked_at` (naive UTC), with the weight
+        it was counted at."""
+
+        # a rebuild never counted it, and it's worth next to nothing now
+        if liked_at < datetime.utcnow() - timedelta(hours=REBUILD_HOURS):
+            return
+        self._add(message_id, -LIKE_WEIGHT, _seconds(liked_at))
+
+    def record_message(self, message_id, when=None):
+        self._add(message_id, NEW_MESSAGE_WEIGHT, when)
+
+    def top(self, n=20):
+        return self.sketch().top_n(n)
+
+    def rebuild(self, hours=REBUILD_HOURS, chunk_rows=REBUILD_CHUNK_ROWS):
+        """Recount the last `hours` of messages and likes into a new file.
+
+        Returns the number of events counted.
+        """
+
+        since = datetime.utcnow() - timedelta(hours=hours)
+
+        tmp = self.rebuild_path
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        # from here on workers count new events into `fresh` too; one that
+        # lands in the database before the queries below start is counted
+        # twice, which a count-min sketch's overestimates already allow for
+        fresh = TrendingSketch(tmp, t0=time.time())
+        counted = 0
+
+        def collect(table, id_column, weight, time_column):
+            nonlocal counted
+            for engine, source in sources(table):
+                with engine.connect() as conn:
+                    rows = conn.execution_options(stream_results=True).execute(
+                        select([source.c[id_column], source.c[time_column]])
+                        .where(source.c[time_column] >= since))
+                    while True:
+                        chunk = rows.fetchmany(chunk_rows)
+                        if not chunk:
+                            break
+                        fresh.add_many([event_id for event_id, when in chunk],
+                                       np.full(len(chunk), weight),
+                                       [_seconds(when) for event_id, when in chunk])
+                        counted += len(chunk)
+
+        try:
+            collect('messages', 'id', NEW_MESSAGE_WEIGHT, 'timestamp')
+            collect('likes', 'message_id', LIKE_WEIGHT, 'timestamp')
+            fresh._locked(lambda: os.replace(tmp, self.path))
+        except Exception:
+            os.remove(tmp)
+            raise
+        finally:
+            fresh.close()
+
+        return counted
+
+
+trending = Trending()
+
+
+def connect_trending(app):
+    """Keep the trending sketch at the app's TRENDING_PATH."""
+
+    trending.configure(app.config['TRENDING_PATH'])
@@ -0,0 +1,334 @@
+"""User pages: the directory, profiles, follows, profile edits, deletion."""
+
+from datetime import datetime
+
+from flask import (Blueprint, Response, current_app, render_template, request, flash, redirect,
+                   g, jsonify, abort, stream_with_context)
+
+from auth import add_user_to_g, do_logout
+from follow_graph import follow_graph
+from follows import (follow_users, unfollow_users, follow_page, followed_among, user_cards,
+                     BULK_FOLLOW_LIMIT, USERS_PAGE_SIZE, MAX_USERS_PAGE_SIZE)
+from jobs import queue
+from like_buffer import like_buffer
+from models import db, bcrypt, User
+from notifications import inbox_page, mark_read
+from query_cache import cache_queries
+from sharding import shards
+from tags import mentions_page
+
+# template events rendered before a streamed page sends a chunk
+TEMPLATE_STREAM_BUFFER = 20
+
+bp = Blueprint('users', __name__)
+
+
+def get_active_user_or_404(user_id):
+    """The user, unless missing or deleted (and not yet purged)."""
+
+    user = User.query.get_or_404(user_id)
+    if user.deleted_at:
+        abort(404)
+    return user
+
+
+def stream_template(template_name, **context):
+    """Like render_template, but sends the page as it is rendered."""
+
+    current_app.update_template_context(context)
+    stream = current_app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(TEMPLATE_STREAM_BUFFER)
+    return Response(stream_with_context(stream))
+
+
+@bp.route('/users')
+def list_users():
+    """Page with listing of users.
+
+    Can take a 'q' param in querystring to search by that username, and
+    'after' (a user id) / 'limit' to page through the rest. The page is
+    streamed: cards go out as the rows arrive.
+    """
+
+    search = request.args.get('q')
+
+    try:
+        after = int(request.args.get('after', 0))
+        limit = int(request.args.get('limit', USERS_PAGE_SIZE))
+    except ValueError:
+        abort(400)
+    if not 0 < limit <= MAX_USERS_PAGE_SIZE:
+        abort(400)
+
+    users = (User.query
+             .filter(User.deleted_at.is_(None))
+             .filter(User.id > after)
+             .order_by(User.id))
+
+    if search:
+        users = users.filter(User.username.like(f"%{search}%"))
+
+    cards = user_cards(users.limit(limit), g.user.id if g.user else None)
+
+    return stream_template('users/index.html', cards=cards, search=search, limit=limit)
+
+
+@bp.route('/users/<int:user_id>')
+@cache_queries
+def users_show(user_id):
+    """Show user profile."""
+
+    # if not g.user:
+    #     flash("Access unauthorized.", "danger")
+    #     return redirect("/")
+
+    user = get_active_user_or_404(user_id)
+
+    # snagging messages in order from the database;
+    # user.messages won't be in order by default
+    messages = shards.messages_for([user_id], limit=100)
+
+    like_count = shards.count_likes(user.id)
+
+    return render_template('users/show.html', user=user, messages=messages, like_count=like_count)
+
+@bp.route('/users/<int:user_id>/likes')
+def show_user_likes(user_id):
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user = get_active_user_or_404(user_id)
+
+    # likes and the liked messages may live on different shards
+    liked_ids = like_buffer.overlay(user.id, shards.liked_message_ids(user.id))
+    liked_messages = shards.messages_by_id(liked_ids)
+    like_count = len(liked_messages)
+
+    # map the user info with the message
+
+    return render_template('users/likes.html', user=user, like_count=like_count, liked_messages=liked_messages)
+
+
+@bp.route('/users/<int:user_id>/mentions')
+def show_user_mentions(user_id):
+    """Show messages that @mention this user, newest first."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user = get_active_user_or_404(user_id)
+
+    try:
+        messages, next_cursor = mentions_page(user_id, request.args.get('before'))
+    except ValueError:
+        abort(400)
+
+    like_count = shards.count_likes(user.id)
+
+    return render_template('users/mentions.html', user=user, messages=messages,
+                           next_cursor=next_cursor, like_count=like_count)
+
+@bp.route('/users/<int:user_id>/following')
+@cache_queries
+def show_following(user_id):
+    """Show list of people this user is following."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user = get_active_user_or_404(user_id)
+
+    try:
+        following, next_cursor = follow_page(user_id, 'following', request.args.get('after'))
+    except ValueError:
+        abort(400)
+    followed_ids = followed_among(g.user.id, [other.id for other in following])
+
+    like_count = shards.count_likes(user.id)
+
+    return render_template('users/following.html', user=user, following=following, next_cursor=next_cursor,
+                           followed_ids=followed_ids, like_count=like_count)
+
+
+@bp.route('/users/<int:user_id>/followers')
+@cache_queries
+def users_followers(user_id):
+    """Show list of followers of this user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    user = get_active_user_or_404(user_id)
+
+    try:
+        followers, next_cursor = follow_page(user_id, 'followers', request.args.get('after'))
+    except ValueError:
+        abort(400)
+    followed_ids = followed_among(g.user.id, [other.id for other in followers])
+
+    like_count = shards.count_likes(user.id)
+
+    return render_template('users/followers.html', user=user, followers=followers, next_cursor=next_cursor,
+                           followed_ids=followed_ids, like_count=like_count)
+
+
+@bp.route('/users/follow/<int:follow_id>', methods=['POST'])
+def add_follow(follow_id):
+    """Add a follow for the currently-logged-in user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    get_active_user_or_404(follow_id)
+    follow_users(g.user.id, [follow_id])
+    db.session.commit()
+    follow_graph.add_follow(g.user.id, follow_id)
+
+    return redirect(f"/users/{g.user.id}/following")
+
+
+@bp.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+def stop_following(follow_id):
+    """Have currently-logged-in-user stop following this user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    unfollow_users(g.user.id, [follow_id])
+    db.session.commit()
+    follow_graph.stop_following(g.user.id, follow_id)
+
+    return redirect(f"/users/{g.user.id}/following")
+
+
+@bp.route('/users/follow/bulk', methods=['POST'])
+def bulk_follow():
+    """Follow (or with "unfollow": true, unfollow) many users at once.
+
+    Takes JSON {"user_ids": [...]} or repeated user_ids form fields, at most
+    BULK_FOLLOW_LIMIT of them, and applies them in one transaction.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    if request.is_json:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify(error="Expected a JSON object."), 400
+    else:
+        data = {'user_ids': request.form.getlist('user_ids'),
+                'unfollow': request.form.get('unfollow') == 'true'}
+
+    user_ids = data.get('user_ids') or []
+    if not isinstance(user_ids, list):
+        return jsonify(error="user_ids must be a list."), 400
+    try:
+        user_ids = [int(user_id) for user_id in user_ids]
+    except (TypeError, ValueError):
+        return jsonify(error="user_ids must be integers."), 400
+    if len(user_ids) > BULK_FOLLOW_LIMIT:
+        return jsonify(error=f"At most {BULK_FOLLOW_LIMIT} users at a time."), 400
+
+    if data.get('unfollow'):
+        changed = unfollow_users(g.user.id, user_ids)
+        db.session.commit()
+        follow_graph.remove_follows(g.user.id, user_ids)
+        return jsonify(unfollowed=changed)
+
+    followed = follow_users(g.user.id, user_ids)
+    db.session.commit()
+    follow_graph.add_follows(g.user.id, followed)
+    return jsonify(followed=len(followed))
+
+
+@bp.route('/notifications')
+def show_notifications():
+    """Show the current user's notifications, and mark them read."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    try:
+        items, next_cursor = inbox_page(g.user.id, request.args.get('before'))
+    except ValueError:
+        abort(400)
+
+    # rendered first, so it still shows which ones are new
+    page = render_template('notifications.html', items=items, next_cursor=next_cursor)
+    if g.user.unread_notifications:
+        mark_read(g.user.id)
+        db.session.commit()
+
+    return page
+
+
+@bp.route('/users/profile', methods=["GET", "POST"])
+def profile():
+    """Update profile for current user."""
+
+    add_user_to_g()
+    user = g.user
+
+    from forms import UpdateUserForm
+
+    form = UpdateUserForm()
+
+    if form.validate_on_submit():
+
+        username = form.username.data
+        user = User.query.filter_by(username=username)
+
+        hashed_password = user[0].password
+        submitted_password = form.password.data
+
+        password_check = bcrypt.check_password_hash(hashed_password,submitted_password)
+
+        if not password_check:
+            flash('Username/password combination incorrect')
+            return redirect('/')
+
+        user[0].email = form.email.data
+        user[0].image_url = form.image_url.data
+        user[0].header_image_url = form.header_image_url.data
+        user[0].bio = form.bio.data
+
+        db.session.add(user[0])
+        db.session.commit()
+
+        return redirect(f'/users/{user[0].id}')
+
+    # auto populate the fields if data exists
+    form.username.data = user.username
+    form.email.data = user.email
+    form.image_url.data = user.image_url
+    form.header_image_url.data = user.header_image_url
+    form.bio.data = user.bio
+
+    return render_template('/users/edit.html', form=form, user=g.user)
+
+
+@bp.route('/users/delete', methods=["POST"])
+def delete_user():
+    """Delete user."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    do_logout()
+
+    # the rows go in the background; see deletion.py
+    g.user.deleted_at = datetime.utcnow()
+    db.session.commit()
+    queue.enqueue('purge-deleted-users', dedupe_key='purge-deleted-users')
+
+    return redirect("/signup")